@@ -1,26 +1,661 @@
 """Handling requests to API"""
 
+import asyncio
+import contextvars
+import fcntl
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import NamedTuple
+
 import requests
-from secret import API_KEY
+from requests.adapters import HTTPAdapter
+from hero_cache import HeroCache, SQLiteTier, NOT_FOUND
+from per_process import PerProcess
+import metrics
+
+
+class HeroNotFound(LookupError):
+    """Raised when the API has no superhero with the requested id"""
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when the API can't be reached (or the circuit breaker is open)"""
+
+
+# The error the API answers with for ids it has no hero for. Any other
+# error (e.g. "access denied" for a bad key, or rate limiting) means the
+# API can't be used right now, not that the hero doesn't exist.
+UNKNOWN_ID_ERROR = "invalid id"
+
+
+def is_unknown_id(data):
+    """True if decoded API JSON is the error for an id with no hero"""
+
+    return str(data.get("error", "")).strip().lower() == UNKNOWN_ID_ERROR
+
+
+class Superhero(NamedTuple):
+    """Superhero object that contains their info.
+
+    An immutable record of only the fields the app shows. As a tuple it
+    has no per-instance __dict__, so many can be kept in memory cheaply.
+    """
+
+    id: int
+    name: str
+    aliases: tuple
+    birth_place: str
+    first_appear: str
+    job: str
+    image: str
+
+    @classmethod
+    def from_json(cls, data):
+        """Build from decoded API JSON"""
+
+        biography = data["biography"]
+
+        return cls(int(data["id"]), data["name"], tuple(biography["aliases"] or ()),
+                   biography["place-of-birth"], biography["first-appearance"],
+                   data["work"]["occupation"], data["image"]["url"])
+
+
+# Set HERO_CACHE_DB to a file path to share cached lookups between workers
+# on the same machine, keeping at most HERO_CACHE_DB_MAX_ROWS of them
+_shared_tier = None
+if os.environ.get('HERO_CACHE_DB'):
+    _shared_tier = SQLiteTier(os.environ['HERO_CACHE_DB'],
+                              max_rows=int(os.environ.get('HERO_CACHE_DB_MAX_ROWS', 100_000)))
+
+# Cache shared by every request in this worker
+hero_cache = HeroCache(
+    maxsize=int(os.environ.get('HERO_CACHE_SIZE', 1024)),
+    ttl=int(os.environ.get('HERO_CACHE_TTL', 3600)),
+    stale_ttl=int(os.environ.get('HERO_CACHE_STALE_TTL', 86400)),
+    negative_ttl=int(os.environ.get('HERO_CACHE_NEGATIVE_TTL', 300)),
+    shared=_shared_tier,
+)
+
+# Bounded pool used to fetch several heroes at once, one per worker process
+FETCH_WORKERS = int(os.environ.get('HERO_FETCH_WORKERS', 8))
+
+fetch_pool = PerProcess(lambda: ThreadPoolExecutor(max_workers=FETCH_WORKERS,
+                                                   thread_name_prefix="hero-fetch"))
+
+
+def load_api_key():
+    """API key from SUPERHERO_API_KEY, or else secret.py"""
+
+    if os.environ.get('SUPERHERO_API_KEY'):
+        return os.environ['SUPERHERO_API_KEY']
+
+    from secret import API_KEY
+    return API_KEY
+
+
+# Marks an API call that raised, for metrics
+_FAILED = object()
+
+
+class CircuitBreaker:
+    """Stops calling the API after repeated failures.
+
+    After `failure_threshold` failures in a row the breaker opens and every
+    call fails fast for `reset_timeout` seconds. Then one trial call is let
+    through (half-open); success closes the breaker, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Return True if a call to the API may go ahead"""
+
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """End a call that was cut short without a verdict (e.g. cancelled)"""
+
+        with self._lock:
+            self._trial_running = False
+
+
+class _Call:
+    """One in-flight load that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Collapses concurrent loads of the same key into one.
+
+    The first caller for a key (the leader) runs the load; anyone asking
+    for that key while it's running waits for the leader's result instead
+    of making their own call, and gets the leader's exception if it fails.
+    Waiters give up with UpstreamUnavailable after `timeout` seconds.
+
+    With `lease_dir` set, leaders in different processes on the same
+    machine (e.g. gunicorn workers) also take a lock file per key, so only
+    one of them goes upstream; the rest re-check the cache with `recheck`
+    once the lock is free, where they'll usually find what it stored
+    (this needs a cache shared between workers, see HERO_CACHE_DB).
+    """
+
+    def __init__(self, timeout=10.0, lease_dir=None):
+        self.timeout = timeout
+        self.lease_dir = lease_dir
+        self.counters = dict.fromkeys(
+            ("leaders", "collapsed", "timeouts", "shared_errors",
+             "lease_waits", "lease_hits"), 0)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _join(self, key):
+        """(call, is_leader) for key, starting a new call if none is running"""
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.counters["leaders"] += 1
+                return call, True
+
+            call.waiters += 1
+            self.counters["collapsed"] += 1
+            return call, False
+
+    def _finish(self, key, call, value=None, error=None):
+        call.value, call.error = value, error
+
+        with self._lock:
+            del self._calls[key]
+            if error is not None:
+                self.counters["shared_errors"] += call.waiters
+
+        call.done.set()
+
+    def _result(self, key, call, finished):
+        if not finished:
+            self._count("timeouts")
+            raise UpstreamUnavailable(f"timed out waiting for in-flight load of {key}")
+
+        if call.error is not None:
+            raise call.error
+
+        return call.value
+
+    def do(self, key, load, recheck=None):
+        """Return load(), shared with concurrent callers for the same key.
+
+        recheck() is called after waiting for another process's lease; if
+        it returns a cache entry, its value is used instead of calling load().
+        """
+
+        key = str(key)
+        call, leader = self._join(key)
+
+        if not leader:
+            return self._result(key, call, call.done.wait(self.timeout))
+
+        try:
+            with self._lease(key) as waited:
+                entry = recheck() if waited and recheck is not None else None
+                if entry is not None:
+                    self._count("lease_hits")
+                    value = entry.value
+                else:
+                    value = load()
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+
+        self._finish(key, call, value=value)
+        return value
+
+    async def do_async(self, key, load):
+        """Async version of do(); load() is a coroutine function.
+
+        Shares in-flight loads with do() callers in this process, but doesn't
+        take a cross-process lease (that would block the event loop).
+        """
+
+        key = str(key)
+        call, leader = self._join(key)
+
+        if not leader:
+            finished = await asyncio.to_thread(call.done.wait, self.timeout)
+            return self._result(key, call, finished)
+
+        try:
+            value = await load()
+        except Exception as e:
+            self._finish(key, call, error=e)
+            raise
+        except BaseException:
+            # e.g. CancelledError when get_many_async gives up on its batch.
+            # That only concerns the leader; waiters (possibly sync request
+            # threads) get the failure they already handle instead
+            self._finish(key, call, error=UpstreamUnavailable(f"load of {key} was cancelled"))
+            raise
+
+        self._finish(key, call, value=value)
+        return value
+
+    @contextmanager
+    def _lease(self, key):
+        """Hold the cross-process lock for key; yields True if we had to wait"""
+
+        if not self.lease_dir:
+            yield False
+            return
+
+        path = os.path.join(self.lease_dir, re.sub(r"[^\w-]", "_", key) + ".lock")
+        deadline = time.monotonic() + self.timeout
+        waited = False
+
+        with open(path, "a") as f:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        self._count("timeouts")
+                        raise UpstreamUnavailable(
+                            f"timed out waiting for another worker to load {key}") from None
+                    if not waited:
+                        waited = True
+                        self._count("lease_waits")
+                    time.sleep(0.01)
+
+            try:
+                yield waited
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._calls))
+
+
+class SuperheroClient:
+    """Client for superheroapi.com
+
+    Keeps one pooled keep-alive session, applies connect/read timeouts,
+    retries failed GETs with jittered backoff and trips a circuit breaker
+    when the API keeps failing. Pass base_url to point it at a stub server.
+    """
+
+    def __init__(self, api_key=None, base_url="https://superheroapi.com/api",
+                 connect_timeout=2.0, read_timeout=5.0, retries=2, backoff=0.2,
+                 pool_size=FETCH_WORKERS, breaker=None, session=None):
+        self._api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.pool_size = pool_size
+        self._ssl_context = None
+        self._session = PerProcess(self._new_session, session)
 
-class Superhero:
-    """Superhero object that contains their info"""
+    @property
+    def api_key(self):
+        # Loaded on first request rather than at import
+        if self._api_key is None:
+            self._api_key = load_api_key()
+        return self._api_key
 
-    def __init__(self, data):
-        self.id = data["id"]
-        self.name = data["name"]
-        self.aliases = data["biography"]["aliases"]
-        self.birth_place = data["biography"]["place-of-birth"]
-        self.first_appear = data["biography"]["first-appearance"]
-        self.job = data["work"]["occupation"]
-        self.image = data["image"]["url"]
+    @property
+    def session(self):
+        """Pooled session for this process.
+
+        A forked worker gets its own, rather than sharing keep-alive
+        sockets with its parent.
+        """
+
+        return self._session.get()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def url_for(self, hero_id):
+        return f"{self.base_url}/{self.api_key}/{hero_id}"
+
+    def _observe(self, start, data):
+        """Record an API call's time, by outcome"""
+
+        seconds = time.perf_counter() - start
+        outcome = "error" if data is _FAILED else "not_found" if data is NOT_FOUND else "ok"
+        metrics.record("api", seconds)
+        metrics.api_call_seconds.observe(seconds, outcome)
+
+    def fetch(self, hero_id):
+        """Return the raw superhero JSON, or NOT_FOUND for unknown ids.
+
+        Raises UpstreamUnavailable if the API couldn't be reached.
+        """
+
+        start = time.perf_counter()
+        data = _FAILED
+
+        try:
+            data = self._fetch(hero_id)
+            return data
+        finally:
+            self._observe(start, data)
+
+    def _fetch(self, hero_id):
+        if not self.breaker.allow():
+            raise UpstreamUnavailable("circuit breaker is open")
+
+        # Every way out of the call has to settle the breaker, or a
+        # half-open trial that ended some other way would block it for good
+        try:
+            return self._fetch_with_retries(hero_id)
+        except UpstreamUnavailable:
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+
+    def _fetch_with_retries(self, hero_id):
+        for attempt in range(self.retries + 1):
+            try:
+                resp = self.session.get(self.url_for(hero_id), timeout=self.timeout)
+
+                # Only server errors are worth retrying
+                if resp.status_code >= 500:
+                    raise requests.HTTPError(f"{resp.status_code} from API", response=resp)
+
+                data = resp.json()
+                if not isinstance(data, dict):
+                    raise ValueError("API response isn't a JSON object")
+
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError, ValueError) as e:
+                if attempt == self.retries:
+                    self.breaker.record_failure()
+                    raise UpstreamUnavailable(str(e)) from e
+
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                continue
+
+            return self._settle(data)
+
+    def _settle(self, data):
+        """data (or NOT_FOUND for unknown ids), recorded with the breaker.
+
+        Only the API's unknown-id error means not found. Any other error
+        body raises UpstreamUnavailable and counts as a failed call, so a
+        bad key or rate limiting isn't cached as every hero missing.
+        """
+
+        if data.get("response") == "error" and not is_unknown_id(data):
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(f"API error: {data.get('error')}")
+
+        self.breaker.record_success()
+
+        if data.get("response") == "error":
+            return NOT_FOUND
+
+        return data
+
+    def async_session(self):
+        """httpx client for fetch_async.
+
+        httpx connections belong to the event loop that opened them, and
+        Flask runs each async view in its own loop, so open one of these per
+        view (async with client.async_session() as http: ...).
+        """
+
+        # Only needed for async views, so not imported until then
+        import httpx
+
+        connect_timeout, read_timeout = self.timeout
+
+        # Building an SSL context is slow, so share one across sessions
+        if self._ssl_context is None:
+            self._ssl_context = httpx.create_ssl_context()
+
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self.pool_size),
+            verify=self._ssl_context,
+        )
+
+    async def fetch_async(self, hero_id, http):
+        """Async version of fetch, using http from async_session()"""
+
+        start = time.perf_counter()
+        data = _FAILED
+
+        try:
+            data = await self._fetch_async(hero_id, http)
+            return data
+        finally:
+            self._observe(start, data)
+
+    async def _fetch_async(self, hero_id, http):
+        if not self.breaker.allow():
+            raise UpstreamUnavailable("circuit breaker is open")
+
+        try:
+            return await self._fetch_with_retries_async(hero_id, http)
+        except UpstreamUnavailable:
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # e.g. CancelledError when get_many_async gives up on the batch
+            self.breaker.release_trial()
+            raise
+
+    async def _fetch_with_retries_async(self, hero_id, http):
+        import httpx
+
+        for attempt in range(self.retries + 1):
+            try:
+                resp = await http.get(self.url_for(hero_id))
+
+                if resp.status_code >= 500:
+                    raise httpx.HTTPStatusError(
+                        f"{resp.status_code} from API", request=resp.request, response=resp)
+
+                data = resp.json()
+                if not isinstance(data, dict):
+                    raise ValueError("API response isn't a JSON object")
+
+            except (httpx.TransportError, httpx.HTTPStatusError, ValueError) as e:
+                if attempt == self.retries:
+                    self.breaker.record_failure()
+                    raise UpstreamUnavailable(str(e)) from e
+
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                continue
+
+            return self._settle(data)
+
+
+client = SuperheroClient(
+    base_url=os.environ.get('SUPERHERO_API_URL', "https://superheroapi.com/api"),
+    connect_timeout=float(os.environ.get('SUPERHERO_API_CONNECT_TIMEOUT', 2.0)),
+    read_timeout=float(os.environ.get('SUPERHERO_API_READ_TIMEOUT', 5.0)),
+)
+
+
+# Concurrent lookups of the same hero share one API call. Set
+# HERO_SINGLEFLIGHT_DIR to a directory to also share them between workers.
+single_flight = SingleFlight(
+    timeout=float(os.environ.get('HERO_SINGLEFLIGHT_TIMEOUT', 10.0)),
+    lease_dir=os.environ.get('HERO_SINGLEFLIGHT_DIR') or None,
+)
+
+
+def set_client(new_client):
+    """Swap the module-level API client (e.g. for a stub server in tests)"""
+
+    global client
+    client = new_client
+
+
+def fetch_hero_data(hero_id):
+    """Sends request to API and return the raw superhero JSON.
+
+    Returns NOT_FOUND if the API doesn't know the id.
+    """
+
+    return client.fetch(hero_id)
+
+
+def get_hero_data(hero_id):
+    """Return raw superhero JSON, using the cache before the API"""
+
+    def load():
+        # Cached while the lease is still held, so a worker that was waiting
+        # on it finds the value instead of calling the API again
+        return hero_cache.set(hero_id, fetch_hero_data(hero_id)).value
+
+    with metrics.timed("cache", metrics.cache_lookup_seconds):
+        data = hero_cache.get_or_load(hero_id, lambda: single_flight.do(
+            hero_id, load, recheck=lambda: hero_cache.peek(hero_id)), store=False)
+
+    if data is NOT_FOUND:
+        raise HeroNotFound(hero_id)
+
+    return data
 
 
 def get_request(hero_id):
-    """Sends request to API and return superhero object"""
+    """Return superhero object, using the cache before the API"""
+
+    return Superhero.from_json(get_hero_data(hero_id))
+
+
+def get_many(hero_ids, timeout=5.0, raw=False):
+    """Fetch several superheros concurrently.
+
+    Returns a list in the same order as hero_ids, of Superhero objects (or
+    raw JSON if raw=True). Any hero that wasn't found, failed, or didn't
+    finish within `timeout` seconds is None, so one slow hero doesn't fail
+    the whole batch.
+    """
+
+    hero_ids = list(hero_ids)
+    fetch = get_hero_data if raw else get_request
+    # Run each fetch in a copy of this context so its timings count towards the request
+    pool = fetch_pool.get()
+    futures = [pool.submit(contextvars.copy_context().run, fetch, hero_id)
+               for hero_id in hero_ids]
+    wait(futures, timeout=timeout)
+
+    results = []
+    for future in futures:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            results.append(future.result())
+        else:
+            # Still running futures finish in the background and fill the cache
+            results.append(None)
+
+    return results
+
+
+async def get_hero_data_async(hero_id, http=None):
+    """Async version of get_hero_data, using http from client.async_session()"""
+
+    if http is None:
+        async with client.async_session() as http:
+            return await get_hero_data_async(hero_id, http)
+
+    with metrics.timed("cache", metrics.cache_lookup_seconds):
+        data = await hero_cache.get_or_load_async(
+            hero_id,
+            lambda: single_flight.do_async(hero_id, lambda: client.fetch_async(hero_id, http)),
+            refresh=lambda: fetch_hero_data(hero_id))
+
+    if data is NOT_FOUND:
+        raise HeroNotFound(hero_id)
+
+    return data
+
+
+async def get_many_async(hero_ids, timeout=5.0, raw=False):
+    """Async version of get_many.
+
+    All fetches share one connection pool and are in flight at once on the
+    event loop, instead of each taking a thread.
+    """
+
+    hero_ids = list(hero_ids)
+    if not hero_ids:
+        return []
+
+    async with client.async_session() as http:
+        tasks = [asyncio.create_task(get_hero_data_async(hero_id, http)) for hero_id in hero_ids]
+        await asyncio.wait(tasks, timeout=timeout)
+
+        results = []
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                data = task.result()
+                results.append(data if raw else Superhero.from_json(data))
+            else:
+                task.cancel()
+                results.append(None)
 
-    resp = requests.get(
-        f"https://superheroapi.com/api/{API_KEY}/{hero_id}")
-    
-    data = resp.json()
-    return Superhero(data)
\ No newline at end of file
+    return results
@@ -1,45 +1,166 @@
+"""Superhero Encyclopedia
+
+Build the app with create_app(config). Importing this module doesn't
+create one; `app` is built from environment settings the first time it's
+used (gunicorn app:app, flask run), so a preloading gunicorn master does
+that once and every forked worker shares it.
+"""
+
+import logging
 import os
+import time
+from functools import lru_cache
+from math import ceil
 
-from flask import Flask, render_template, flash, redirect, session, g
+from flask import (Blueprint, Flask, render_template, flash, redirect, session, g, abort, request,
+                   jsonify)
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 from forms import UserAddForm, LoginForm, UserEditForm
 from models import db, connect_db, User, Favorites
-from api_requests import get_request
-
-CURR_USER_KEY = "curr_user"
-
-app = Flask(__name__)
-app.app_context().push()
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///superheros'))
+from api_requests import HeroNotFound, UpstreamUnavailable, hero_cache, single_flight
+from catalog import (catalog_cli, get_hero, get_heroes, get_hero_async, get_heroes_async,
+                     catalog_version, grid_page,
+                     FEATURED_HERO_IDS, GRID_PAGE_SIZE)
+from current_user import CURR_USER_KEY, LazyUserGlobals, invalidate_user
+from search import search_heroes
+from popularity import popularity_cli, popular_heroes, MAX_LIMIT as POPULAR_MAX_LIMIT
+from passwords import login_limiter
+from ratings import (ratings_cli, hero_rating, top_rated_heroes, MIN_RATING, MAX_RATING,
+                     MAX_LIMIT as TOP_RATED_MAX_LIMIT)
+from prefetch import prefetcher, prefetch_favorites
+from recommendations import (recommendations_cli, favorites_changed, recommended_for_hero,
+                             recommended_for_user, refresh as refresh_recommendations)
+import http_cache
+from http_cache import cache_policy, conditional_response
+import instrumentation
+import metrics
+import profiler
+import thumbnails
+from db_pool import pool_status
+from schema_upgrade import schema_cli
+
+logger = logging.getLogger(__name__)
+
+views = Blueprint("views", __name__)
+
+
+def create_app(config=None):
+    """Create and set up the app.
+
+    Settings come from environment variables; anything in config overrides
+    them before the database is connected, so tests can use their own.
+    """
+
+    start = time.perf_counter()
+
+    app = Flask(__name__)
+    app.app_ctx_globals_class = LazyUserGlobals
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgresql:///superheros'))
+
+    # Connection pool per worker; size it so that
+    # workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) fits Postgres' max_connections
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "SUPER TOP SECRET")
+
+    # Usernames allowed to use the /admin routes (comma-separated)
+    app.config['ADMIN_USERS'] = {
+        name.strip() for name in os.environ.get('ADMIN_USERS', '').split(',') if name.strip()}
+
+    # Async views overlap API requests on an event loop instead of tying up
+    # a thread per request
+    app.config['ASYNC_VIEWS'] = os.environ.get('ASYNC_VIEWS') == '1'
+
+    # Number of reverse proxies in front of the app. Behind one, every
+    # request comes from the proxy's address, and login limits are per IP,
+    # so say how many X-Forwarded-For hops to trust
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+    app.config.update(config or {})
+
+    if app.config['TRUSTED_PROXIES']:
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
+    connect_db(app)
+    http_cache.init_app(app)
+    with app.app_context():
+        instrumentation.init_app(app, db.engine)
+    profiler.init_app(app)
+    thumbnails.init_app(app)
+    app.register_blueprint(views)
+    app.cli.add_command(catalog_cli)
+    app.cli.add_command(popularity_cli)
+    app.cli.add_command(recommendations_cli)
+    app.cli.add_command(ratings_cli)
+    app.cli.add_command(schema_cli)
+
+    if app.config['ASYNC_VIEWS']:
+        app.view_functions["views.user_favs"] = user_favs_async
+        app.view_functions["views.hero_info"] = hero_info_async
+
+    def engine_pool_status():
+        with app.app_context():
+            return pool_status(db.engine)
+
+    metrics.register_gauges("superheros_hero_cache", "Hero cache counters", hero_cache.stats)
+    metrics.register_gauges("superheros_single_flight", "Collapsed hero lookups",
+                            single_flight.stats)
+    metrics.register_gauges("superheros_thumbnails", "Portrait thumbnail cache",
+                            thumbnails.thumbnailer.stats)
+    metrics.register_gauges("superheros_prefetch", "Cache warming jobs", prefetcher.stats)
+    metrics.register_gauges("superheros_db_pool", "Database connection pool usage",
+                            engine_pool_status)
+
+    seconds = time.perf_counter() - start
+    metrics.register_gauges("superheros_startup", "Seconds taken to create the app",
+                            lambda: {"create_app": round(seconds, 4)})
+    logger.info("app created in %.3fs", seconds)
+
+    return app
+
+
+def __getattr__(name):
+    """Build the default app on first use of `app`"""
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "SUPER TOP SECRET")
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
 
-connect_db(app)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 ############################################################################
 # User signup/login/logout
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user id to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user itself is loaded lazily the first time a view uses it.
+    """
 
-    else:
-        g.user = None
+    g.pop("user", None)
+    g.user_id = session.get(CURR_USER_KEY)
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    g.user_id = user.id
+    g.user = user
 
 def do_logout():
     """Logout user."""
@@ -47,8 +168,11 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    g.user_id = None
 
-@app.route('/signup', methods=['GET', 'POST'])
+
+@views.route('/signup', methods=['GET', 'POST'])
+@cache_policy("no-store")
 def signup():
     """Route to sign up new user"""
 
@@ -75,7 +199,7 @@ def signup():
     return render_template("signup.html", form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -87,7 +211,7 @@ def logout():
 ############################################################################
 # User routes:
 
-@app.route("/users/<int:user_id>")
+@views.route("/users/<int:user_id>")
 def show_details(user_id):
     """Show user profile"""
 
@@ -95,11 +219,17 @@ def show_details(user_id):
         flash("Access unauthorized.", "danger")
         return redirect('/')
     
-    user = User.query.get_or_404(user_id)
+    # Own profile is already loaded as g.user
+    if user_id == g.user_id:
+        user = g.user
+    else:
+        user = User.query.get_or_404(user_id)
+
     return render_template('profile.html', user=user)
 
 
-@app.route("/users/edit", methods=['GET', 'POST'])
+@views.route("/users/edit", methods=['GET', 'POST'])
+@cache_policy("no-store")
 def edit_user():
     """Route to edit user profile"""
 
@@ -118,12 +248,14 @@ def edit_user():
         user.bio = form.bio.data
 
         db.session.commit()
+        invalidate_user(user.id)
         return redirect(f"/users/{user.id}")
     
     return render_template('edit.html', form=form, user=user)
 
 
-@app.route("/users/delete", methods=["GET", "POST"])
+@views.route("/users/delete", methods=["GET", "POST"])
+@cache_policy("no-store")
 def delete_user():
     """Delete User"""
 
@@ -131,19 +263,27 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect('/')
     
+    user = g.user
+    hero_ids = favorite_hero_ids()
     do_logout()
     
-    # Deleting user favorites
-    Favorites.query.filter_by(user_id=g.user.id).delete()
+    # Deleting user favorites (and their popularity and co-favorite counts)
+    Favorites.remove_all(user.id)
+    refresh_recommendations(hero_ids)
 
-    db.session.delete(g.user)
+    db.session.delete(user)
     db.session.commit()
+    invalidate_user(user.id)
 
     flash("User Deleted", "info")
     return redirect("/")
 
 
-@app.route("/users/favorites")
+# Co-favorite recommendations shown on hero and favorites pages (one grid row)
+RECOMMENDATIONS_SHOWN = 7
+
+
+@views.route("/users/favorites")
 def user_favs():
     """Page for user favorites"""
 
@@ -151,37 +291,225 @@ def user_favs():
         flash("Access unauthorized.", "danger")
         return redirect('/')
     
-    # To store the user favorite heros and send to page
-    fav_heros = []
-    
+    # Load all favorites from the local catalog in one query
+    hero_ids = favorite_hero_ids()
+    fav_heros = get_heroes(hero_ids)
+    recommended = get_heroes(recommended_for_user(hero_ids, RECOMMENDATIONS_SHOWN))
+
+    return render_template("favorites.html", fav_heros=fav_heros, recommended=recommended,
+                           user=g.user)
+
+
+async def user_favs_async():
+    """Async version of user_favs, used when ASYNC_VIEWS is on"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    hero_ids = favorite_hero_ids()
+    fav_heros = await get_heroes_async(hero_ids)
+    recommended = await get_heroes_async(recommended_for_user(hero_ids, RECOMMENDATIONS_SHOWN))
+
+    return render_template("favorites.html", fav_heros=fav_heros, recommended=recommended,
+                           user=g.user)
+
+
+def favorite_hero_ids():
+    """Hero ids of the current user's favorites, in the order they were added"""
+
     # Retrieve list of hero ids from user favorites to get superhero info
     fav_list = g.user.favorites
-    id_list = [fav.hero_id for fav in fav_list]
-
-    # Create superhero object from API request and add to list for page
-    for hero_id in id_list:
-        superhero = get_request(hero_id)
-        fav_heros.append(superhero)
+    return [fav.hero_id for fav in fav_list]
 
-    return render_template("favorites.html", fav_heros=fav_heros, user=g.user)
 ############################################################################
 # Main encyclopedia routes:
 
-@app.route('/superheros')
+@lru_cache(maxsize=64)
+def render_grid(page, version):
+    """Render one page of the superhero grid.
+
+    Cached per page and catalog version, so the grid is only re-rendered
+    after the catalog changes.
+    """
+
+    count, last_updated = version
+    pages = max(1, ceil(count / GRID_PAGE_SIZE))
+
+    return render_template("grid.html", heroes=grid_page(page), page=page, pages=pages)
+
+
+@views.route('/superheros')
 def info():
     """Shows grid of superheros to select from"""
 
-    if not g.user:
+    if not g.user_id:
         flash("Access unauthorized.", "danger")
         return redirect('/')
-    
-    user = User.query.get_or_404(g.user.id)
-    print(f"user is {user}")
 
-    return render_template("info.html", user=user)
+    page = max(request.args.get("page", 1, type=int), 1)
+    version = catalog_version()
+
+    # Nothing ingested yet, so at least show the featured heroes
+    if not version[0]:
+        get_heroes(FEATURED_HERO_IDS)
+        version = catalog_version()
+
+    count, last_updated = version
+    etag = f"grid-{g.user_id}-{page}-{count}-{last_updated.timestamp() if last_updated else 0:.0f}"
+
+    return conditional_response(
+        etag, last_updated,
+        lambda: render_template("info.html", grid=render_grid(page, version), user=g.user))
+
+
+@views.route("/superheros/search")
+def search():
+    """Show superheros matching the search query"""
+
+    if not g.user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    query = request.args.get("q", "")
+    heroes = search_heroes(query, limit=GRID_PAGE_SIZE)
+
+    return render_template("search.html", heroes=heroes, query=query, user=g.user)
+
+
+@views.route("/api/superheros/search")
+def search_api():
+    """Search superheros as JSON, for typeahead"""
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
+
+    limit = min(max(request.args.get("limit", 10, type=int), 1), 50)
+    heroes = search_heroes(request.args.get("q", ""), limit=limit)
+
+    return jsonify(heroes=heroes)
+
+
+@views.route("/superheros/popular")
+def popular():
+    """Show the most favorited superheros"""
+
+    if not g.user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    heroes = popular_heroes(limit=GRID_PAGE_SIZE)
+
+    return render_template("popular.html", heroes=heroes, user=g.user)
+
+
+@views.route("/api/superheros/popular")
+def popular_api():
+    """Most favorited superheros as JSON"""
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
+
+    limit = min(max(request.args.get("limit", 10, type=int), 1), POPULAR_MAX_LIMIT)
+    heroes = [{"id": hero.id, "name": hero.name, "image": hero.image, "favorites": favorites}
+              for hero, favorites in popular_heroes(limit)]
+
+    return jsonify(heroes=heroes)
+
+
+@views.route("/superheros/top-rated")
+def top_rated():
+    """Show the best rated superheros"""
+
+    if not g.user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    heroes = top_rated_heroes(limit=GRID_PAGE_SIZE)
+
+    return render_template("top_rated.html", heroes=heroes, user=g.user)
+
+
+@views.route("/api/superheros/top-rated")
+def top_rated_api():
+    """Best rated superheros as JSON"""
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
 
+    limit = min(max(request.args.get("limit", 10, type=int), 1), TOP_RATED_MAX_LIMIT)
+    heroes = [{"id": hero.id, "name": hero.name, "image": hero.image,
+               "average": round(average, 2), "ratings": ratings}
+              for hero, average, ratings in top_rated_heroes(limit)]
 
-@app.route("/superheros/<int:hero_id>")
+    return jsonify(heroes=heroes)
+
+
+# Most heroes /superheros/compare takes at once, and /similar returns
+MAX_COMPARE = 20
+MAX_SIMILAR = 50
+
+# Largest id a hero can have (ids are 32-bit integer columns)
+MAX_HERO_ID = 2 ** 31 - 1
+
+
+@views.route("/superheros/<int:hero_id>/similar")
+def similar_heroes(hero_id):
+    """Heroes with the most similar powerstats, as JSON"""
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
+
+    # numpy is slow to import, so only load it once someone asks for stats
+    from powerstats import powerstats, METRICS
+
+    metric = request.args.get("metric", "cosine")
+    if metric not in METRICS:
+        return jsonify(error=f"metric must be one of: {', '.join(METRICS)}"), 400
+
+    limit = min(max(request.args.get("limit", 10, type=int), 1), MAX_SIMILAR)
+    similar = powerstats.current().similar(hero_id, limit, metric)
+    if similar is None:
+        abort(404)
+
+    heroes = {hero.id: hero for hero in get_heroes([other_id for other_id, _ in similar])}
+
+    return jsonify(hero_id=hero_id, metric=metric, heroes=[
+        {"id": other_id, "name": heroes[other_id].name, "image": heroes[other_id].image,
+         "score": score}
+        for other_id, score in similar if other_id in heroes])
+
+
+@views.route("/superheros/compare")
+def compare_heroes():
+    """Powerstats of several heroes side by side, as JSON"""
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
+
+    from powerstats import powerstats
+
+    try:
+        hero_ids = [int(hero_id) for hero_id in request.args.get("ids", "").split(",") if hero_id]
+    except ValueError:
+        hero_ids = None
+
+    # Out-of-range ids would overflow numpy's int64 lookups
+    if hero_ids is None or not all(1 <= hero_id <= MAX_HERO_ID for hero_id in hero_ids):
+        return jsonify(error="ids must be comma-separated hero ids"), 400
+
+    if not hero_ids or len(hero_ids) > MAX_COMPARE:
+        return jsonify(error=f"give between 1 and {MAX_COMPARE} hero ids"), 400
+
+    comparison = powerstats.current().compare(hero_ids)
+    names = {hero.id: hero.name for hero in get_heroes(hero["id"] for hero in comparison["heroes"])}
+    for hero in comparison["heroes"]:
+        hero["name"] = names.get(hero["id"])
+
+    return jsonify(comparison)
+
+
+@views.route("/superheros/<int:hero_id>")
 def hero_info(hero_id):
     """Show detailed info of superhero"""
 
@@ -189,78 +517,187 @@ def hero_info(hero_id):
         flash("Access unauthorized.", "danger")
         return redirect('/')
 
-    # Make API request then store response in data
-    superhero = get_request(hero_id)
+    # Look up superhero in the local catalog (only calls the API if missing)
+    try:
+        superhero = get_hero(hero_id)
+    except HeroNotFound:
+        abort(404)
+    except UpstreamUnavailable:
+        abort(503)
 
-    # Retrieve list of hero ids from user favorites
-    # To check if this superhero is a user favorite
-    fav_list = g.user.favorites
-    id_list = [str(fav.hero_id) for fav in fav_list]
+    return hero_page(superhero)
+
+
+async def hero_info_async(hero_id):
+    """Async version of hero_info, used when ASYNC_VIEWS is on"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    try:
+        superhero = await get_hero_async(hero_id)
+    except HeroNotFound:
+        abort(404)
+    except UpstreamUnavailable:
+        abort(503)
+
+    return hero_page(superhero)
+
+
+def hero_page(superhero):
+    """Hero detail page for the current user (or a 304 if they have it)"""
+
+    hero_id = superhero.id
+
+    # Check if this superhero is a user favorite, and how they rated it
+    is_favorite, rating = g.user.favorite_rating(hero_id)
+    average, ratings = hero_rating(hero_id)
 
-    return render_template("hero.html", superhero=superhero, id_list=id_list, user=g.user)
+    recommended_ids = [other_id for other_id, _ in
+                       recommended_for_hero(hero_id, RECOMMENDATIONS_SHOWN)]
 
+    # Page only changes when the hero is refreshed, (un)favorited or
+    # rated, or its recommendations change
+    etag = (f"hero-{g.user_id}-{hero_id}-{superhero.updated_at.timestamp():.0f}-{int(is_favorite)}"
+            f"-{rating or 0}-{ratings}-{average or 0:.4f}-{'.'.join(map(str, recommended_ids))}")
 
-@app.route("/superheros/<int:hero_id>/fav", methods=['POST'])
+    return conditional_response(
+        etag, None,
+        lambda: render_template("hero.html", superhero=superhero, is_favorite=is_favorite,
+                                rating=rating, average=average, ratings=ratings,
+                                rating_choices=range(MIN_RATING, MAX_RATING + 1),
+                                recommended=get_heroes(recommended_ids), user=g.user))
+
+
+@views.route("/superheros/<int:hero_id>/fav", methods=['POST'])
 def fav_hero(hero_id):
     """Adding/removing superhero from user favorites"""
 
-    if not g.user:
+    if not g.user_id:
         flash("Access unauthorized.", "danger")
         return redirect('/')
-    
-    # Retrieve the superhero that was favorited if it already is
-    fav_hero = Favorites.query.filter_by(hero_id=hero_id, user_id=g.user.id).first()
 
-    # If that superhero is already favorited, then un-favorite it
-    # If favorite doesn't exist, then add to favorites
-    fav_list = g.user.favorites
+    # Add or remove the favorite in one go, without loading user favorites
+    try:
+        Favorites.toggle(g.user_id, hero_id)
+        db.session.commit()
+    except IntegrityError:
+        # Session points at a user that no longer exists
+        db.session.rollback()
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    invalidate_user(g.user_id)
+    favorites_changed(g.user_id, [hero_id])
+    return redirect(f"/superheros/{hero_id}")
+
+
+@views.route("/superheros/<int:hero_id>/rate", methods=['POST'])
+def rate_hero(hero_id):
+    """Rate a favorite superhero 1-5 stars (0 or nothing clears the rating)"""
 
-    if fav_hero in fav_list:
-        print("Favorite has to be unliked")
-        Favorites.query.filter_by(hero_id=hero_id, user_id=g.user.id).delete()
+    if not g.user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect('/')
+
+    # Only an explicit 0 or an empty field clears the rating; anything
+    # else that isn't a number of stars is an error, not a clear
+    value = request.form.get("rating")
+    try:
+        rating = int(value or 0) or None
+        valid = value is not None and (rating is None or MIN_RATING <= rating <= MAX_RATING)
+    except ValueError:
+        valid = False
+
+    if not valid:
+        flash(f"Ratings go from {MIN_RATING} to {MAX_RATING} stars.", "danger")
+        return redirect(f"/superheros/{hero_id}")
+
+    # The rating and the hero's rating totals are written together
+    if Favorites.rate(g.user_id, hero_id, rating):
+        db.session.commit()
     else:
-        add_fav = Favorites(hero_id=hero_id, user_id=g.user.id)
-        db.session.add(add_fav)
-    
-    db.session.commit()
+        db.session.rollback()
+        flash("Favorite a superhero to rate it.", "danger")
+
     return redirect(f"/superheros/{hero_id}")
 
 
+def is_hero_id_list(value):
+    """True if value is a list of integers that could be hero ids"""
+
+    # bool is an int subclass, but true isn't a hero id
+    return isinstance(value, list) and all(
+        type(hero_id) is int and 1 <= hero_id <= MAX_HERO_ID for hero_id in value)
+
+
+@views.route("/api/users/favorites", methods=['POST'])
+def sync_favs():
+    """Add and/or remove many favorites at once.
+
+    Expects JSON like {"add": [30, 303], "remove": [489]} and returns the
+    user's favorite hero ids afterwards.
+    """
+
+    if not g.user_id:
+        return jsonify(error="Access unauthorized."), 401
+
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+
+    add_ids = data.get("add", []) if isinstance(data, dict) else None
+    remove_ids = data.get("remove", []) if isinstance(data, dict) else None
+
+    if not (is_hero_id_list(add_ids) and is_hero_id_list(remove_ids)):
+        return jsonify(error='Expected {"add": [hero ids], "remove": [hero ids]}.'), 400
+
+    try:
+        Favorites.remove_many(g.user_id, remove_ids)
+        Favorites.add_many(g.user_id, add_ids)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify(error="Access unauthorized."), 401
+
+    invalidate_user(g.user_id)
+    favorites_changed(g.user_id, add_ids + remove_ids)
+
+    favorites = db.session.execute(
+        db.select(Favorites.hero_id).filter_by(user_id=g.user_id).order_by(Favorites.id))
+    return jsonify(favorites=favorites.scalars().all())
+
 
 ############################################################################
 # Homepage w/ login
 
-@app.route('/', methods=['GET', 'POST'])
+@views.route('/', methods=['GET', 'POST'])
+@cache_policy("no-store")
 def homepage():
     """Show homepage with login and sign-up options"""
 
     form = LoginForm()
 
     if form.validate_on_submit():
+        # Limit failed logins per username and per IP, before doing any hashing
+        limit_keys = (f"user:{form.username.data}", f"ip:{request.remote_addr}")
+
+        if not login_limiter.allow(*limit_keys):
+            flash("Too many login attempts. Please try again later.", "danger")
+            return render_template("login.html", form=form), 429
+
         user = User.authenticate(form.username.data, form.password.data)
         
         if user:
+            login_limiter.reset(limit_keys[0])
             do_login(user)
+            # Their favorites page is the likely next stop
+            prefetch_favorites(user.id)
             flash(f"Hello, {user.username}!", "success")
             return redirect('/superheros') # TODO - add page and route to list all superheros
         
+        login_limiter.record_failure(*limit_keys)
         flash("Invalid credentials.", "danger")
 
     return render_template("login.html", form=form)
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
\ No newline at end of file
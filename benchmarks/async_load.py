@@ -0,0 +1,114 @@
+"""Load test: sync vs async favorites page against a slow stub API
+
+Starts the stub superhero API with added latency, then for each mode runs
+the app under gunicorn (one worker, a few threads) and requests every test
+user's /users/favorites page concurrently. Each user favorites heroes that
+aren't in the catalog yet, so every page has to fetch all of them from the
+API. Prints requests/sec, latency and the worker's memory for each mode.
+
+Run from the repo root:
+
+    python3 benchmarks/async_load.py --users 40 --favorites 20 --latency 0.2
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from harness import gunicorn, percentile, worker_rss_kb
+from stub_api import StubServer
+
+
+def setup_database(db_url, users, favorites, mode_offset):
+    """Create users whose favorites are heroes nobody has fetched yet.
+
+    Returns a session cookie for each user.
+    """
+
+    from app import create_app, CURR_USER_KEY
+    from models import db, User, Favorites
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': db_url})
+    app.app_context().push()
+
+    db.create_all()
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = []
+
+    for i in range(users):
+        user = User(username=f"load{mode_offset}-{i}", email=f"load{mode_offset}-{i}@test.com",
+                    password="unused")
+        db.session.add(user)
+        db.session.flush()
+
+        first_hero = mode_offset + i * favorites + 1
+        Favorites.add_many(user.id, range(first_hero, first_hero + favorites))
+        cookies.append(serializer.dumps({CURR_USER_KEY: user.id}))
+
+    db.session.commit()
+    return cookies
+
+
+def run_mode(mode, args, stub, db_url, cookies):
+    env = dict(DATABASE_URL=db_url,
+               SUPERHERO_API_URL=stub.url,
+               SUPERHERO_API_KEY="stub",
+               ASYNC_VIEWS="1" if mode == "async" else "0",
+               HERO_FETCH_WORKERS=str(args.favorites))
+
+    url = f"http://127.0.0.1:{args.port}/users/favorites"
+
+    with gunicorn(env, args.port, threads=args.threads) as server:
+        def fetch(cookie):
+            start = time.perf_counter()
+            resp = requests.get(url, cookies={"session": cookie}, timeout=60)
+            resp.raise_for_status()
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            latencies = list(pool.map(fetch, cookies))
+        elapsed = time.perf_counter() - start
+
+        rss = worker_rss_kb(server.pid)
+
+    return {
+        "mode": mode,
+        "requests_per_sec": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "worker_rss_mb": round(rss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--favorites", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            StubServer(latency=args.latency, max_id=10 ** 6) as stub:
+        db_url = f"sqlite:///{os.path.join(tmp, 'load.db')}"
+        results = []
+
+        for n, mode in enumerate(("sync", "async")):
+            # Each mode gets its own users and heroes so neither starts warm
+            cookies = setup_database(db_url, args.users, args.favorites,
+                                     mode_offset=n * args.users * args.favorites)
+            results.append(run_mode(mode, args, stub, db_url, cookies))
+
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
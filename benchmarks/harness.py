@@ -0,0 +1,89 @@
+"""Shared helpers for the benchmark scripts
+
+Starts the app under gunicorn against a given database and superhero API
+and summarizes request latencies.
+"""
+
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values"""
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles for one batch of requests"""
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1) if latencies else 0.0,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1) if latencies else 0.0,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1) if latencies else 0.0,
+    }
+
+
+def git_revision():
+    """Current commit, with "-dirty" if the tree has uncommitted changes"""
+
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return f"{rev}-dirty" if dirty else rev
+
+
+def worker_rss_kb(master_pid):
+    """Resident memory of gunicorn's worker processes, in KB"""
+
+    out = subprocess.run(["ps", "-o", "rss=", "--ppid", str(master_pid)],
+                         capture_output=True, text=True).stdout
+    return sum(int(line) for line in out.split())
+
+
+@contextmanager
+def gunicorn(env, port, workers=1, threads=4):
+    """Run app:app under gunicorn until the block exits; yields the process"""
+
+    server = subprocess.Popen(
+        ["gunicorn", "-w", str(workers), "--threads", str(threads), "-b", f"127.0.0.1:{port}",
+         "app:app"],
+        cwd=REPO_ROOT, env=dict(os.environ, **env),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        # Wait for gunicorn to come up
+        for _ in range(100):
+            try:
+                requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("gunicorn didn't start")
+
+        yield server
+
+    finally:
+        server.terminate()
+        server.wait()
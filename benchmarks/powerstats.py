@@ -0,0 +1,69 @@
+"""Compute time of the powerstats similar/compare queries
+
+Builds a memory-mapped PowerStats matrix for N heroes shaped like API
+responses (731 is the real catalog), then times PowerStats.similar() for
+both metrics and PowerStats.compare() for 20 heroes, per call. This is
+the compute only; the endpoints also look up names in the catalog. Run
+from the repo root:
+
+    python3 benchmarks/powerstats.py --heroes 731 10000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import harness  # noqa: F401  (puts the repo root on sys.path)
+from powerstats import PowerStats
+from stub_api import make_hero
+
+
+def per_call_us(func, repeat):
+    """Best of 5 runs of repeat calls, in microseconds per call"""
+
+    best = float("inf")
+
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        best = min(best, time.perf_counter() - start)
+
+    return best / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--heroes", type=int, nargs="+", default=[731, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+
+    for count in args.heroes:
+        rows = [(hero_id, make_hero(hero_id)) for hero_id in range(1, count + 1)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "matrix")
+
+            start = time.perf_counter()
+            PowerStats.build(rows).save(path)
+            build_ms = (time.perf_counter() - start) * 1000
+
+            matrix = PowerStats.load(path)
+            compared = rand.sample(range(1, count + 1), 20)
+
+            cosine = per_call_us(lambda: matrix.similar(rand.randint(1, count)), args.repeat)
+            euclidean = per_call_us(
+                lambda: matrix.similar(rand.randint(1, count), metric="euclidean"), args.repeat)
+            compare = per_call_us(lambda: matrix.compare(compared), args.repeat)
+
+        print(f"{count:>7} heroes: build {build_ms:7.1f} ms | similar cosine {cosine:6.1f} us, "
+              f"euclidean {euclidean:6.1f} us | compare 20 {compare:6.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Build time and memory of the co-favorite recommendations rebuild
+
+Generates a favorites table with skewed hero popularity (a few heroes
+are in most users' favorites, like the real thing) and measures:
+
+1. compute: the sparse user x hero matrix, blocked co-favorite counts
+   and per-hero top-N, on arrays already in memory
+2. rebuild: the whole `flask recommendations rebuild` job against a
+   database (loading favorites, computing, writing co_favorites and
+   hero_recommendations)
+
+with wall time and peak traced memory (tracemalloc sees numpy's buffers
+as well as Python objects). Uses a throwaway SQLite database unless
+--database-url is given (its tables are dropped and recreated). Run from
+the repo root:
+
+    python3 benchmarks/recommendations.py --favorites 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import harness  # noqa: F401  (puts the repo root on sys.path)
+
+
+def generate(favorites, users, heroes, seed):
+    """(user_ids, hero_ids) of about `favorites` distinct favorites"""
+
+    rng = np.random.default_rng(seed)
+
+    # Zipf-like popularity: the k-th most popular hero is picked ~1/k as often
+    weights = 1 / np.arange(1, heroes + 1)
+    weights /= weights.sum()
+
+    # Draw extra to make up for duplicates, then keep distinct pairs
+    draws = int(favorites * 1.3)
+    pairs = np.unique(np.stack([rng.integers(1, users + 1, draws),
+                                rng.choice(np.arange(1, heroes + 1), draws, p=weights)],
+                               axis=1), axis=0)
+    pairs = pairs[rng.permutation(len(pairs))[:favorites]]
+
+    return pairs[:, 0], pairs[:, 1]
+
+
+def measure(func):
+    """(result, seconds, peak MB) of calling func"""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, seconds, peak / 1024 / 1024
+
+
+def compute(user_ids, hero_ids):
+    from recommendations import sparse_favorites, co_favorite_counts, top_similar
+
+    heroes, indptr, columns = sparse_favorites(user_ids, hero_ids)
+    return top_similar(co_favorite_counts(heroes, indptr, columns))
+
+
+def load_database(db_url, user_ids, hero_ids):
+    """Create the tables and bulk insert users and favorites"""
+
+    from app import create_app
+    from models import db, User, Favorites
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': db_url})
+    app.app_context().push()
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        {"id": user_id, "username": f"bench{user_id}", "email": f"bench{user_id}@test.com",
+         "password": "unused"} for user_id in np.unique(user_ids).tolist()])
+    rows = [{"user_id": user_id, "hero_id": hero_id}
+            for user_id, hero_id in zip(user_ids.tolist(), hero_ids.tolist())]
+    for start in range(0, len(rows), 50000):
+        db.session.execute(db.insert(Favorites), rows[start:start + 50000])
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", help="database to use instead of a temporary SQLite file")
+    parser.add_argument("--favorites", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--heroes", type=int, default=731)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-database", action="store_true", help="only time the compute step")
+    args = parser.parse_args()
+
+    user_ids, hero_ids = generate(args.favorites, args.users, args.heroes, args.seed)
+    print(f"{len(user_ids)} favorites, {len(np.unique(user_ids))} users, "
+          f"{len(np.unique(hero_ids))} heroes")
+
+    _, seconds, peak = measure(lambda: compute(user_ids, hero_ids))
+    print(f"compute: {seconds:.2f}s, peak {peak:.1f} MB")
+
+    if args.skip_database:
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        load_database(db_url, user_ids, hero_ids)
+
+        from recommendations import rebuild
+
+        stats, seconds, peak = measure(rebuild)
+        print(f"rebuild: {seconds:.2f}s (load {stats['load_seconds']}s, "
+              f"compute {stats['compute_seconds']}s, write {stats['write_seconds']}s), "
+              f"peak {peak:.1f} MB, {stats['pairs']} co-favorite pairs, "
+              f"{stats['recommendations']} recommendations")
+
+
+if __name__ == "__main__":
+    main()
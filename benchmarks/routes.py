@@ -0,0 +1,189 @@
+"""Benchmark the hot routes against a local stub superhero API
+
+Starts the stub API (with optional latency and injected errors) and the
+app under gunicorn, then drives each route at a fixed concurrency and
+writes throughput and p50/p95/p99 latency per route to a JSON report.
+Requests are generated from a fixed seed, so two runs with the same
+settings send the same requests and reports can be compared across
+commits.
+
+Routes:
+    login       GET /
+    grid        GET /superheros
+    hero        GET /superheros/<id>
+    favorite    POST /superheros/<id>/fav
+    favorites   GET /users/favorites
+
+Uses a throwaway SQLite database unless --database-url is given (e.g. a
+local Postgres; its tables are dropped and recreated). Run from the repo
+root:
+
+    python3 benchmarks/routes.py --requests 500 --concurrency 8 --output report.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+from harness import git_revision, gunicorn, summarize
+from stub_api import StubServer
+
+ROUTES = ("login", "grid", "hero", "favorite", "favorites")
+
+
+def setup_database(db_url, users, favorites, max_id, seed):
+    """Create users with random favorites; returns a session cookie for each"""
+
+    from app import create_app, CURR_USER_KEY
+    from models import db, User, Favorites
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': db_url})
+    app.app_context().push()
+
+    db.drop_all()
+    db.create_all()
+
+    rand = random.Random(seed)
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = []
+
+    for i in range(users):
+        user = User(username=f"bench{i}", email=f"bench{i}@test.com", password="unused")
+        db.session.add(user)
+        db.session.flush()
+
+        Favorites.add_many(user.id, rand.sample(range(1, max_id + 1), favorites))
+        cookies.append(serializer.dumps({CURR_USER_KEY: user.id}))
+
+    db.session.commit()
+    return cookies
+
+
+def plan(route, count, cookies, max_id, rand):
+    """The (method, path, cookie) requests to send for route"""
+
+    requests_ = []
+
+    for i in range(count):
+        cookie = cookies[i % len(cookies)]
+
+        if route == "login":
+            requests_.append(("GET", "/", None))
+        elif route == "grid":
+            requests_.append(("GET", "/superheros", cookie))
+        elif route == "hero":
+            requests_.append(("GET", f"/superheros/{rand.randint(1, max_id)}", cookie))
+        elif route == "favorite":
+            requests_.append(("POST", f"/superheros/{rand.randint(1, max_id)}/fav", cookie))
+        elif route == "favorites":
+            requests_.append(("GET", "/users/favorites", cookie))
+
+    return requests_
+
+
+def run_route(base_url, requests_, concurrency):
+    """Send requests_ concurrently; returns (latencies, errors, elapsed)"""
+
+    def send(request):
+        method, path, cookie = request
+        cookies = {"session": cookie} if cookie else None
+
+        start = time.perf_counter()
+        try:
+            resp = requests.request(method, base_url + path, cookies=cookies,
+                                    allow_redirects=False, timeout=60)
+            ok = resp.status_code < 500
+        except requests.RequestException:
+            ok = False
+
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, requests_))
+    elapsed = time.perf_counter() - start
+
+    latencies = [seconds for seconds, ok in results if ok]
+    errors = sum(1 for _, ok in results if not ok)
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", help="database to use instead of a temporary SQLite file")
+    parser.add_argument("--routes", default=",".join(ROUTES),
+                        help="comma-separated routes to run (default: all)")
+    parser.add_argument("--requests", type=int, default=300, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=30, help="unmeasured requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--favorites", type=int, default=10)
+    parser.add_argument("--max-id", type=int, default=731, help="heroes served by the stub API")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of stub API requests that fail with a 502")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    routes = [route for route in args.routes.split(",") if route]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+
+    rand = random.Random(args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            StubServer(latency=args.latency, error_rate=args.error_rate,
+                       max_id=args.max_id) as stub:
+        db_url = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        cookies = setup_database(db_url, args.users, args.favorites, args.max_id, args.seed)
+
+        env = dict(DATABASE_URL=db_url, SUPERHERO_API_URL=stub.url, SUPERHERO_API_KEY="stub")
+        base_url = f"http://127.0.0.1:{args.port}"
+
+        with gunicorn(env, args.port, workers=args.workers, threads=args.threads):
+            for route in routes:
+                run_route(base_url, plan(route, args.warmup, cookies, args.max_id, rand),
+                          args.concurrency)
+
+                latencies, errors, elapsed = run_route(
+                    base_url, plan(route, args.requests, cookies, args.max_id, rand),
+                    args.concurrency)
+                results[route] = summarize(latencies, errors, elapsed)
+
+        upstream_requests = stub.request_count
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "database": db_url.split(":", 1)[0],
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("database_url", "output")},
+        "upstream_requests": upstream_requests,
+        "routes": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
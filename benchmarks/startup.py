@@ -0,0 +1,126 @@
+"""Startup time and worker memory, with and without gunicorn --preload
+
+Measures two things:
+
+1. Cold start: importing app and calling create_app() in a fresh
+   interpreter, median of several runs.
+2. gunicorn with N workers, preloaded and not: time until the first
+   request is served, and the workers' proportional set size (PSS), which
+   counts memory shared copy-on-write between processes only once.
+
+Run from the repo root:
+
+    python3 benchmarks/startup.py --workers 4
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from harness import REPO_ROOT
+
+COLD_START = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def cold_start(runs, env):
+    """Median (import, create_app) seconds in a fresh interpreter"""
+
+    imports, creates = [], []
+
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", COLD_START], cwd=REPO_ROOT, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        import_seconds, create_seconds = map(float, out.split())
+        imports.append(import_seconds)
+        creates.append(create_seconds)
+
+    return statistics.median(imports), statistics.median(creates)
+
+
+def pss_kb(pid):
+    """Proportional set size of a process, in KB"""
+
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+    return 0
+
+
+def child_pids(pid):
+    out = subprocess.run(["ps", "-o", "pid=", "--ppid", str(pid)],
+                         capture_output=True, text=True).stdout
+    return [int(line) for line in out.split()]
+
+
+def run_gunicorn(preload, args, env):
+    """Seconds until the first response, and total PSS of master + workers"""
+
+    env = dict(env, GUNICORN_PRELOAD="1" if preload else "0", PREFETCH="0")
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        ["gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}", "app:app"],
+        cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while True:
+            try:
+                requests.get(f"http://127.0.0.1:{args.port}/", timeout=10)
+                break
+            except requests.ConnectionError:
+                if time.perf_counter() - start > 30:
+                    raise RuntimeError("gunicorn didn't start")
+                time.sleep(0.01)
+        first_response = time.perf_counter() - start
+
+        # Let every worker finish booting and serve something
+        time.sleep(1)
+        for _ in range(args.workers * 4):
+            requests.get(f"http://127.0.0.1:{args.port}/", timeout=5)
+
+        workers = child_pids(server.pid)
+        pss = pss_kb(server.pid) + sum(pss_kb(pid) for pid in workers)
+
+    finally:
+        server.terminate()
+        server.wait()
+
+    return first_response, pss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5058)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+
+        import_seconds, create_seconds = cold_start(args.runs, env)
+        print(f"cold start: import {import_seconds * 1000:.0f} ms, "
+              f"create_app {create_seconds * 1000:.0f} ms")
+
+        for preload in (False, True):
+            first_response, pss = run_gunicorn(preload, args, env)
+            print(f"gunicorn -w {args.workers} {'--preload' if preload else '(no preload)'}: "
+                  f"first response {first_response * 1000:.0f} ms, "
+                  f"PSS {pss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
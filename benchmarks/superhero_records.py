@@ -0,0 +1,93 @@
+"""Memory and build speed: Superhero records vs the old class
+
+Builds N heroes shaped like API responses and compares:
+
+    raw json    the decoded API JSON (what was kept around before)
+    legacy      the old Superhero, a regular class with a __dict__
+    record      the current Superhero, an immutable NamedTuple
+
+Memory is measured with tracemalloc while holding all N, build time
+(from decoded JSON) is per hero. Run from the repo root:
+
+    python3 benchmarks/superhero_records.py --heroes 10000
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import harness  # noqa: F401  (puts the repo root on sys.path)
+from api_requests import Superhero
+from stub_api import make_hero
+
+
+class LegacySuperhero:
+    """Superhero as it was before it became a NamedTuple"""
+
+    def __init__(self, data):
+        self.id = data["id"]
+        self.name = data["name"]
+        self.aliases = data["biography"]["aliases"]
+        self.birth_place = data["biography"]["place-of-birth"]
+        self.first_appear = data["biography"]["first-appearance"]
+        self.job = data["work"]["occupation"]
+        self.image = data["image"]["url"]
+
+
+def held_bytes(build):
+    """Memory still allocated after build() returns its objects"""
+
+    tracemalloc.start()
+    objects = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del objects
+    return size
+
+
+def per_item_us(build, items, repeat):
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            build(item)
+        best = min(best, time.perf_counter() - start)
+
+    return best / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--heroes", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = [json.dumps(make_hero(hero_id)).encode("utf-8")
+              for hero_id in range(1, args.heroes + 1)]
+    decoded = [json.loads(body) for body in bodies]
+
+    memory = {
+        "raw json": held_bytes(lambda: [json.loads(body) for body in bodies]),
+        "legacy": held_bytes(lambda: [LegacySuperhero(json.loads(body)) for body in bodies]),
+        "record": held_bytes(lambda: [Superhero.from_json(json.loads(body)) for body in bodies]),
+    }
+
+    build = {
+        "legacy": per_item_us(LegacySuperhero, decoded, args.repeat),
+        "record": per_item_us(Superhero.from_json, decoded, args.repeat),
+    }
+
+    print(f"{args.heroes} heroes, memory held:")
+    for name, size in memory.items():
+        print(f"  {name:<10} {size / 1024:10.1f} KB  {size / args.heroes:8.1f} B/hero")
+
+    print("build time per hero:")
+    for name, micros in build.items():
+        print(f"  {name:<10} {micros:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Local superhero catalog
+
+Heroes are read from the `heroes` table. Anything missing is fetched from
+the API once (through the cache) and stored, so after the catalog has
+been ingested hero pages never have to call the API.
+
+Fill or refresh the table with:
+
+    flask catalog ingest            # every id from 1 to 731
+    flask catalog refresh --days 7  # only rows older than 7 days
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+
+from models import db, Hero, upsert
+from api_requests import (Superhero, UpstreamUnavailable, get_hero_data, get_many,
+                          fetch_hero_data, get_hero_data_async, get_many_async)
+from hero_cache import NOT_FOUND
+
+# Highest id the API currently has
+MAX_HERO_ID = 731
+
+# Heroes that were hand-picked for the original grid, used to seed the
+# catalog if nothing has been ingested yet
+FEATURED_HERO_IDS = [489, 30, 303, 251, 527, 313, 107, 332, 579, 333, 346, 149,
+                     213, 226, 470, 717, 620, 659]
+
+# Heroes per page of the /superheros grid (3 rows of 7)
+GRID_PAGE_SIZE = 21
+
+HERO_COLUMNS = ("name", "aliases", "birth_place", "first_appear", "job", "image",
+                "data", "updated_at")
+
+
+def hero_row(data):
+    """Turn raw API JSON into a row for the heroes table"""
+
+    superhero = Superhero.from_json(data)
+
+    return {
+        "id": superhero.id,
+        "name": superhero.name,
+        "aliases": list(superhero.aliases),
+        "birth_place": superhero.birth_place,
+        "first_appear": superhero.first_appear,
+        "job": superhero.job,
+        "image": superhero.image,
+        "data": data,
+        "updated_at": datetime.utcnow(),
+    }
+
+
+def save_heroes(data_list):
+    """Upsert raw API JSON for several heroes into the catalog"""
+
+    upsert(Hero, [hero_row(data) for data in data_list], ["id"], HERO_COLUMNS)
+    db.session.commit()
+
+
+def get_hero(hero_id):
+    """Return Hero for hero_id, fetching and storing it if it's not local yet.
+
+    Raises HeroNotFound if the API doesn't know the id.
+    """
+
+    hero = db.session.get(Hero, hero_id)
+
+    if hero is None:
+        save_heroes([get_hero_data(hero_id)])
+        hero = db.session.get(Hero, hero_id)
+
+    return hero
+
+
+async def get_hero_async(hero_id):
+    """Async version of get_hero"""
+
+    hero = db.session.get(Hero, hero_id)
+
+    if hero is None:
+        save_heroes([await get_hero_data_async(hero_id)])
+        hero = db.session.get(Hero, hero_id)
+
+    return hero
+
+
+def _local_heroes(hero_ids):
+    """Heroes already in the catalog, by id, with one query"""
+
+    return {hero.id: hero for hero in Hero.query.filter(Hero.id.in_(hero_ids))}
+
+
+def get_heroes(hero_ids, timeout=5.0):
+    """Return Heroes for hero_ids in the same order, with one query.
+
+    Missing heroes are fetched concurrently and stored; any that can't be
+    fetched are left out.
+    """
+
+    hero_ids = list(hero_ids)
+    heroes = _local_heroes(hero_ids)
+
+    missing = [hero_id for hero_id in hero_ids if hero_id not in heroes]
+    if missing:
+        save_heroes([data for data in get_many(missing, timeout=timeout, raw=True) if data])
+        heroes.update(_local_heroes(missing))
+
+    return [heroes[hero_id] for hero_id in hero_ids if hero_id in heroes]
+
+
+async def get_heroes_async(hero_ids, timeout=5.0):
+    """Async version of get_heroes"""
+
+    hero_ids = list(hero_ids)
+    heroes = _local_heroes(hero_ids)
+
+    missing = [hero_id for hero_id in hero_ids if hero_id not in heroes]
+    if missing:
+        fetched = await get_many_async(missing, timeout=timeout, raw=True)
+        save_heroes([data for data in fetched if data])
+        heroes.update(_local_heroes(missing))
+
+    return [heroes[hero_id] for hero_id in hero_ids if hero_id in heroes]
+
+
+def catalog_version():
+    """Return (row count, last update time) of the catalog.
+
+    Changes whenever heroes are added or refreshed, so it can key caches
+    of anything rendered from the catalog.
+    """
+
+    query = db.select(db.func.count(Hero.id), db.func.max(Hero.updated_at))
+    return tuple(db.session.execute(query).one())
+
+
+def grid_page(page):
+    """Heroes shown on one page of the grid, ordered by id"""
+
+    return (Hero.query.order_by(Hero.id)
+            .offset((page - 1) * GRID_PAGE_SIZE)
+            .limit(GRID_PAGE_SIZE)
+            .all())
+
+
+def ingest(hero_ids, workers=8, batch_size=100):
+    """Fetch hero_ids straight from the API and upsert them in batches.
+
+    Returns (saved, failed) counts. Ids the API doesn't know are skipped.
+    """
+
+    failed_marker = object()
+
+    def fetch(hero_id):
+        try:
+            return fetch_hero_data(hero_id)
+        except UpstreamUnavailable:
+            return failed_marker
+
+    saved = failed = 0
+    batch = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for data in pool.map(fetch, hero_ids):
+            if data is failed_marker:
+                failed += 1
+                continue
+            if data is NOT_FOUND:
+                continue
+
+            batch.append(data)
+            if len(batch) >= batch_size:
+                save_heroes(batch)
+                saved += len(batch)
+                batch = []
+
+    save_heroes(batch)
+    saved += len(batch)
+
+    return saved, failed
+
+
+def stale_hero_ids(max_age):
+    """Ids of catalog rows last fetched more than max_age (timedelta) ago"""
+
+    cutoff = datetime.utcnow() - max_age
+    rows = db.session.query(Hero.id).filter(Hero.updated_at < cutoff).order_by(Hero.id)
+    return [hero_id for (hero_id,) in rows]
+
+
+############################################################################
+# CLI commands, registered on the app as `flask catalog ...`
+
+catalog_cli = AppGroup("catalog", help="Manage the local superhero catalog.")
+
+
+@catalog_cli.command("ingest")
+@click.option("--start", default=1, help="First hero id to fetch.")
+@click.option("--end", default=MAX_HERO_ID, help="Last hero id to fetch.")
+@click.option("--workers", default=8, help="Concurrent API requests.")
+@click.option("--batch-size", default=100, help="Rows per upsert.")
+def ingest_command(start, end, workers, batch_size):
+    """Fetch every hero in the id range and store it."""
+
+    db.create_all()
+    saved, failed = ingest(range(start, end + 1), workers, batch_size)
+    click.echo(f"Saved {saved} heroes, {failed} failed")
+
+
+@catalog_cli.command("refresh")
+@click.option("--days", default=7, help="Re-fetch rows older than this many days.")
+@click.option("--workers", default=8, help="Concurrent API requests.")
+@click.option("--batch-size", default=100, help="Rows per upsert.")
+def refresh_command(days, workers, batch_size):
+    """Re-fetch only catalog rows that have gone stale."""
+
+    hero_ids = stale_hero_ids(timedelta(days=days))
+    saved, failed = ingest(hero_ids, workers, batch_size)
+    click.echo(f"Refreshed {saved} of {len(hero_ids)} stale heroes, {failed} failed")
@@ -0,0 +1,74 @@
+"""Lazy loading of the logged in user
+
+`g.user` is only loaded from the database the first time a view touches
+it, so requests that never use it (static files, redirects, views that
+only need `g.user_id`) don't pay for a query.
+
+Set USER_CACHE_TTL (seconds) to also keep a short-lived per-worker
+snapshot of each session user, so back-to-back requests don't reload the
+same row. Call invalidate_user() whenever the user's data changes.
+"""
+
+import os
+
+from flask import session
+from flask.ctx import _AppCtxGlobals
+from sqlalchemy.orm import Session
+
+from models import db, User
+from ttl_cache import TTLCache
+
+CURR_USER_KEY = "curr_user"
+
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 0))
+
+# Snapshots are detached User rows
+user_cache = TTLCache(maxsize=1024, ttl=USER_CACHE_TTL)
+
+
+def detached_user(user_id):
+    """Load user (or None) in a throwaway session so it can be cached across requests"""
+
+    with Session(db.engine, expire_on_commit=False) as snapshot_session:
+        return snapshot_session.get(User, user_id)
+
+
+def load_session_user():
+    """Return the User for the current session, or None if not logged in"""
+
+    user_id = session.get(CURR_USER_KEY)
+
+    if user_id is None:
+        return None
+
+    if not USER_CACHE_TTL:
+        return db.session.get(User, user_id)
+
+    snapshot = user_cache.get(user_id)
+
+    if snapshot is None:
+        # Users that don't exist (any more) aren't cached
+        snapshot = detached_user(user_id)
+        if snapshot is None:
+            return None
+        user_cache.set(user_id, snapshot)
+
+    # Attach a copy to this request's session without querying the database
+    return db.session.merge(snapshot, load=False)
+
+
+def invalidate_user(user_id):
+    """Drop cached snapshot after the user (or their favorites) changed"""
+
+    user_cache.invalidate(user_id)
+
+
+class LazyUserGlobals(_AppCtxGlobals):
+    """Flask `g` that loads `g.user` on first access"""
+
+    def __getattr__(self, name):
+        if name == "user":
+            self.user = load_session_user()
+            return self.user
+
+        return super().__getattr__(name)
@@ -0,0 +1,149 @@
+"""Database connection pool setup and metrics
+
+Builds SQLAlchemy engine options from app config so the pool can be
+sized against the number of gunicorn workers:
+
+    total Postgres connections ~= workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+Also makes engines safe to use after fork (connections opened in the
+parent are never reused by a child) and records how long requests wait
+to check a connection out of the pool.
+"""
+
+import os
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """Counters for connection pool activity"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.checkout_timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checkout_timeouts": self.checkout_timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            pool_stats.incr("checkout_timeouts")
+            raise
+        finally:
+            pool_stats.record_wait(time.perf_counter() - start)
+
+
+def engine_options(config):
+    """SQLAlchemy engine options for the configured database"""
+
+    # SQLite (used for local testing) keeps Flask-SQLAlchemy's defaults
+    if config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+        return {}
+
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "pool_recycle": config['DB_POOL_RECYCLE'],
+        "pool_pre_ping": config['DB_POOL_PRE_PING'],
+    }
+
+    if config['DB_STATEMENT_TIMEOUT_MS']:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"}
+
+    return options
+
+
+def watch_engine(engine):
+    """Count pool events on engine and drop inherited connections after fork"""
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_conn, record):
+        pool_stats.incr("connects")
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_conn, record, proxy):
+        pool_stats.incr("checkouts")
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_conn, record):
+        pool_stats.incr("checkins")
+
+    _watched_engines.add(engine)
+
+
+# Engines to reset after fork. Weak, so an engine from an app that's gone
+# (e.g. one create_app() per test module) isn't kept alive by the hook.
+_watched_engines = weakref.WeakSet()
+
+
+def _dispose_after_fork():
+    # The child gets a fresh pool; close=False leaves the parent's
+    # connections alone instead of closing them out from under it
+    for engine in list(_watched_engines):
+        engine.dispose(close=False)
+
+
+# One hook for every engine: fork hooks can't be unregistered
+os.register_at_fork(after_in_child=_dispose_after_fork)
+
+
+def pool_status(engine):
+    """Current pool usage plus the counters"""
+
+    status = pool_stats.snapshot()
+    pool = engine.pool
+
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            idle=pool.checkedin(),
+        )
+
+    return status
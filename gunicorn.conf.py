@@ -0,0 +1,27 @@
+"""gunicorn settings, picked up automatically when run from the repo root"""
+
+import gc
+import os
+
+# Build the app once in the master and fork workers from it, so they start
+# faster and share its memory copy-on-write. Database engines, thread and
+# process pools and HTTP sessions are recreated in each worker after fork.
+# Set GUNICORN_PRELOAD=0 to have every worker build its own app instead.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def pre_fork(server, worker):
+    """Keep the collector away from objects the workers share"""
+
+    # A GC pass writes to every object it scans, which would copy the shared
+    # pages into each worker
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    """Start warming this worker's caches as soon as the app is loaded"""
+
+    from app import app
+    from prefetch import warm_at_boot
+
+    warm_at_boot(app)
@@ -0,0 +1,338 @@
+"""Caching layer for superhero API responses
+
+Two tiers:
+    - an in-process LRU (per worker, bounded by size)
+    - an optional shared SQLite tier so every gunicorn worker on the box
+      can reuse each other's lookups
+
+Entries are fresh for `ttl` seconds, then served stale for up to
+`stale_ttl` more seconds while a background thread refreshes them.
+Unknown ids are cached as negative entries for `negative_ttl` seconds.
+If a reload fails, the last known value is served (degraded) rather than
+failing the request.
+"""
+
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Cached value used for ids that the API says don't exist
+NOT_FOUND = None
+
+
+class CacheEntry:
+    """Value stored in the cache along with when it goes stale/expires"""
+
+    __slots__ = ("value", "fresh_until", "expires_at")
+
+    def __init__(self, value, fresh_until, expires_at):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.expires_at = expires_at
+
+    def is_fresh(self, now):
+        return now < self.fresh_until
+
+    def is_expired(self, now):
+        return now >= self.expires_at
+
+
+class SQLiteTier:
+    """Shared cache tier stored in a local SQLite file.
+
+    Values must be JSON serializable. Each call opens its own connection
+    so the tier is safe to use across threads and forked workers.
+
+    Every `purge_every` sets, expired rows are deleted and the table is cut
+    back to `max_rows`, dropping the rows that expire soonest, so requests
+    for made-up ids can't grow the file forever.
+    """
+
+    def __init__(self, path, max_rows=100_000, purge_every=1000):
+        self.path = path
+        self.max_rows = max_rows
+        self.purge_every = purge_every
+        self._sets = itertools.count(1)
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hero_cache ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT,"
+                " fresh_until REAL NOT NULL,"
+                " expires_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_hero_cache_expires_at ON hero_cache (expires_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, fresh_until, expires_at FROM hero_cache WHERE key = ?",
+                (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        value, fresh_until, expires_at = row
+        return CacheEntry(json.loads(value), fresh_until, expires_at)
+
+    def set(self, key, entry):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO hero_cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(entry.value), entry.fresh_until, entry.expires_at))
+
+        if next(self._sets) % self.purge_every == 0:
+            self.purge()
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM hero_cache WHERE key = ?", (key,))
+
+    def purge(self):
+        """Delete expired rows, then the soonest to expire past max_rows"""
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM hero_cache WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM hero_cache WHERE key IN ("
+                " SELECT key FROM hero_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT count(*) FROM hero_cache").fetchone()[0]
+
+
+class HeroCache:
+    """LRU cache with TTL, stale-while-revalidate and negative caching."""
+
+    def __init__(self, maxsize=1024, ttl=3600, stale_ttl=86400,
+                 negative_ttl=300, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.shared = shared
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+        self.counters = dict.fromkeys(
+            ("hits", "stale_hits", "negative_hits", "shared_hits",
+             "degraded_hits", "misses", "evictions", "refreshes",
+             "refresh_errors"), 0)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _make_entry(self, value):
+        now = time.time()
+
+        if value is NOT_FOUND:
+            return CacheEntry(value, now + self.negative_ttl, now + self.negative_ttl)
+
+        return CacheEntry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+
+    def _lookup(self, key):
+        """Find entry in local LRU, falling back to the shared tier.
+
+        A local entry that's no longer fresh is checked against the shared
+        tier too, since another worker may have reloaded it since.
+        """
+
+        with self._lock:
+            local = self._entries.get(key)
+            if local is not None:
+                self._entries.move_to_end(key)
+
+        if self.shared is None or (local is not None and local.is_fresh(time.time())):
+            return local
+
+        try:
+            entry = self.shared.get(key)
+        except sqlite3.Error:
+            return local
+
+        if entry is None or (local is not None and entry.fresh_until <= local.fresh_until):
+            return local
+
+        self._count("shared_hits")
+        self._store_local(key, entry)
+        return entry
+
+    def _store_local(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def set(self, key, value):
+        """Store value (or NOT_FOUND) under key in every tier."""
+
+        key = str(key)
+        entry = self._make_entry(value)
+        self._store_local(key, entry)
+
+        if self.shared is not None:
+            try:
+                self.shared.set(key, entry)
+            except sqlite3.Error:
+                pass
+
+        return entry
+
+    def invalidate(self, key):
+        key = str(key)
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except sqlite3.Error:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _check(self, key, refresh):
+        """Look key up, counting the result.
+
+        Returns (True, value) for a usable entry, refreshing it in the
+        background with refresh() if it's stale. Otherwise returns
+        (False, expired entry or None).
+        """
+
+        now = time.time()
+        entry = self._lookup(key)
+
+        if entry is not None and not entry.is_expired(now):
+            if entry.value is NOT_FOUND:
+                self._count("negative_hits")
+            elif entry.is_fresh(now):
+                self._count("hits")
+            else:
+                self._count("stale_hits")
+                self._refresh_in_background(key, refresh)
+
+            return True, entry.value
+
+        self._count("misses")
+        return False, entry
+
+    def peek(self, key):
+        """Fresh entry for key (from any tier), or None.
+
+        Doesn't count as a lookup; for re-checking the cache after waiting
+        for someone else to load key. Stale and expired entries don't
+        count, since that wait is for a newer value than ours.
+        """
+
+        entry = self._lookup(str(key))
+
+        if entry is None or not entry.is_fresh(time.time()):
+            return None
+
+        return entry
+
+    def _degraded(self, entry):
+        """Serve an expired copy (if we still have one) after a failed load"""
+
+        if entry is None:
+            return False
+
+        self._count("degraded_hits")
+        return True
+
+    def get_or_load(self, key, loader, store=True):
+        """Return cached value for key, calling loader() on a miss.
+
+        loader() should return the value to cache, or NOT_FOUND for ids that
+        don't exist; pass store=False if loader() caches it itself. Stale
+        entries are returned right away and refreshed on a background thread.
+        """
+
+        key = str(key)
+        hit, found = self._check(key, loader)
+        if hit:
+            return found
+
+        try:
+            value = loader()
+        except Exception:
+            # Upstream is down: fall back to an expired copy if we still have one
+            if self._degraded(found):
+                return found.value
+            raise
+
+        return self.set(key, value).value if store else value
+
+    async def get_or_load_async(self, key, loader, refresh):
+        """Async version of get_or_load.
+
+        loader() is a coroutine function used on a miss; refresh() is a
+        plain function used to refresh stale entries on a background thread.
+        """
+
+        key = str(key)
+        hit, found = self._check(key, refresh)
+        if hit:
+            return found
+
+        try:
+            value = await loader()
+        except Exception:
+            if self._degraded(found):
+                return found.value
+            raise
+
+        return self.set(key, value).value
+
+    def _refresh_in_background(self, key, loader):
+        """Reload key on a daemon thread, at most one refresh per key."""
+
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.set(key, loader())
+                self._count("refreshes")
+            except Exception:
+                # Keep serving the stale copy until it expires
+                self._count("refresh_errors")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def stats(self):
+        """Snapshot of counters plus current size, for sizing the cache"""
+
+        with self._lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self._entries)
+            stats["maxsize"] = self.maxsize
+
+        lookups = stats["hits"] + stats["stale_hits"] + stats["negative_hits"] + stats["misses"]
+        stats["hit_ratio"] = round(1 - stats["misses"] / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,131 @@
+"""HTTP caching policies
+
+Every response gets a Cache-Control header picked per route:
+
+    - fingerprinted static files (?v=<hash>) are cached for a year as immutable
+    - other static files are cached publicly for an hour
+    - views marked @cache_policy("no-store") (pages with forms) are never stored
+    - everything else must be revalidated, which is cheap for views that
+      use conditional_response() since a matching ETag gets a 304 before
+      the template is rendered
+
+Views can also set Cache-Control themselves, in which case it's left alone.
+"""
+
+import hashlib
+import os
+from datetime import timezone
+from functools import lru_cache
+
+from flask import current_app, request, make_response, session, url_for
+
+POLICIES = {
+    "immutable": "public, max-age=31536000, immutable",
+    "static": "public, max-age=3600",
+    "revalidate": "private, no-cache",
+    "no-store": "no-store",
+}
+
+DEFAULT_POLICY = "revalidate"
+
+
+def cache_policy(name):
+    """Decorator picking the caching policy for a view"""
+
+    if name not in POLICIES:
+        raise ValueError(f"Unknown cache policy: {name}")
+
+    def decorator(view):
+        view.cache_policy = name
+        return view
+
+    return decorator
+
+
+@lru_cache(maxsize=256)
+def _fingerprint(path, mtime):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def static_url(filename):
+    """URL for a static file with a content hash, so it can be cached forever"""
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        version = _fingerprint(path, os.path.getmtime(path))
+    except OSError:
+        return url_for("static", filename=filename)
+
+    return url_for("static", filename=filename, v=version)
+
+
+def http_datetime(dt):
+    """Make a naive UTC datetime usable as Last-Modified (aware, whole seconds)"""
+
+    if dt is None:
+        return None
+
+    return dt.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def not_modified(etag, last_modified=None):
+    """Does the client already have the version with this ETag/Last-Modified?"""
+
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if last_modified and request.if_modified_since:
+        return request.if_modified_since >= last_modified
+
+    return False
+
+
+def conditional_response(etag, last_modified, render):
+    """Respond 304 if the client is up to date, otherwise call render().
+
+    render() is only called when the page actually has to be sent. With
+    flashed messages waiting, the page is always rendered (so they're shown
+    now, not on some later page) and sent without validators or caching.
+    """
+
+    if session.get("_flashes"):
+        resp = make_response(render())
+        resp.headers["Cache-Control"] = POLICIES["no-store"]
+        return resp
+
+    last_modified = http_datetime(last_modified)
+
+    if not_modified(etag, last_modified):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(render())
+
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    return resp
+
+
+def apply_cache_policy(resp):
+    """Set Cache-Control for the response based on its route's policy"""
+
+    if request.endpoint == "static":
+        name = "immutable" if request.args.get("v") else "static"
+        resp.headers["Cache-Control"] = POLICIES[name]
+        return resp
+
+    if "Cache-Control" in resp.headers:
+        return resp
+
+    view = current_app.view_functions.get(request.endpoint)
+    name = getattr(view, "cache_policy", DEFAULT_POLICY)
+    resp.headers["Cache-Control"] = POLICIES[name]
+    return resp
+
+
+def init_app(app):
+    """Register caching policy hook and static_url() template helper"""
+
+    app.after_request(apply_cache_policy)
+    app.jinja_env.globals["static_url"] = static_url
@@ -0,0 +1,123 @@
+"""Per-request instrumentation
+
+Times every request and splits it into database, superhero API and cache
+time, then reports it three ways:
+
+- a Server-Timing header, so the breakdown shows up in browser dev tools
+- one JSON log line per request on the "superheros.requests" logger
+- Prometheus metrics at /metrics (latency histograms, hero cache and
+  connection pool counters)
+"""
+
+import json
+import logging
+import time
+
+from flask import g, request, Response
+from sqlalchemy import event
+
+import metrics
+from http_cache import cache_policy
+from metrics import RequestTimings, current_timings
+
+logger = logging.getLogger("superheros.requests")
+
+# Order of the parts in Server-Timing
+TIMING_KINDS = ("db", "api", "cache")
+
+
+def watch_queries(engine):
+    """Time each SQL statement on engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def finish(conn):
+        starts = conn.info.get("query_start")
+        if starts:
+            seconds = time.perf_counter() - starts.pop()
+            metrics.record("db", seconds)
+            metrics.db_query_seconds.observe(seconds)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        finish(conn)
+
+    @event.listens_for(engine, "handle_error")
+    def on_error(context):
+        if context.connection is not None:
+            finish(context.connection)
+
+
+def start_timing():
+    g.timings = RequestTimings()
+    current_timings.set(g.timings)
+
+
+def server_timing(timings, total):
+    """Server-Timing header value: total app time, then each kind of work"""
+
+    parts = [f"app;dur={total * 1000:.1f}"]
+
+    for kind in TIMING_KINDS:
+        if kind in timings.totals:
+            count, seconds = timings.totals[kind]
+            parts.append(f'{kind};dur={seconds * 1000:.1f};desc="{count} calls"')
+
+    return ", ".join(parts)
+
+
+def finish_timing(resp):
+    timings = g.get("timings")
+    if timings is None:
+        return resp
+
+    total = timings.elapsed()
+    endpoint = request.endpoint or "unmatched"
+
+    resp.headers["Server-Timing"] = server_timing(timings, total)
+    # Kept for existing load tests that check database savings
+    resp.headers["X-DB-Queries"] = str(timings.count("db"))
+
+    metrics.request_seconds.observe(total, endpoint, request.method, resp.status_code)
+
+    if logger.isEnabledFor(logging.INFO):
+        line = {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": endpoint,
+            "status": resp.status_code,
+            "ms": round(total * 1000, 1),
+            "user_id": g.get("user_id"),
+        }
+        for kind, (count, seconds) in timings.totals.items():
+            line[f"{kind}_calls"] = count
+            line[f"{kind}_ms"] = round(seconds * 1000, 1)
+
+        logger.info(json.dumps(line))
+
+    return resp
+
+
+def reset_timing(exc):
+    # Don't let a finished request's timings leak into work done outside one
+    current_timings.set(None)
+
+
+@cache_policy("no-store")
+def metrics_view():
+    """Prometheus scrape endpoint"""
+
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app, engine):
+    """Time app's requests and the SQL run on engine, and serve /metrics"""
+
+    watch_queries(engine)
+
+    app.before_request(start_timing)
+    app.after_request(finish_timing)
+    app.teardown_request(reset_timing)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,160 @@
+"""Lightweight performance metrics
+
+Process-wide counters and latency histograms, exported in Prometheus
+text format, plus a per-request breakdown of where time went (database,
+superhero API, cache). Nothing here depends on Flask; the request side
+lives in instrumentation.py.
+
+Per-request timings are kept in a context variable, so they follow the
+request into get_many's worker threads and async tasks.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Latency buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Prometheus-style histogram, one series per label set"""
+
+    def __init__(self, name, help_text, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+
+            i = bisect_left(self.buckets, seconds)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                base = list(zip(self.label_names, labels))
+                cumulative = 0
+
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_format_labels(base + [("le", bound)])} {cumulative}')
+
+                lines.append(f'{self.name}_bucket{_format_labels(base + [("le", "+Inf")])} {count}')
+                lines.append(f"{self.name}_sum{_format_labels(base)} {total:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(base)} {count}")
+
+        return lines
+
+
+def _format_labels(pairs):
+    """Format label pairs as {a="1",b="2"}"""
+
+    if not pairs:
+        return ""
+
+    inner = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + inner + "}"
+
+
+request_seconds = Histogram(
+    "superheros_request_seconds", "Time to handle a request", ("endpoint", "method", "status"))
+db_query_seconds = Histogram(
+    "superheros_db_query_seconds", "Time per SQL statement")
+api_call_seconds = Histogram(
+    "superheros_api_call_seconds", "Time per superhero API call", ("outcome",))
+cache_lookup_seconds = Histogram(
+    "superheros_cache_lookup_seconds", "Time per hero cache lookup, including loads on a miss")
+
+HISTOGRAMS = [request_seconds, db_query_seconds, api_call_seconds, cache_lookup_seconds]
+
+# Extra sources of counters/gauges, as (name, help, function returning {key: value})
+GAUGE_SOURCES = []
+
+
+class RequestTimings:
+    """Time spent per kind of work ("db", "api", "cache") in one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds):
+        with self._lock:
+            count, total = self.totals.get(kind, (0, 0.0))
+            self.totals[kind] = (count + 1, total + seconds)
+
+    def count(self, kind):
+        return self.totals.get(kind, (0, 0.0))[0]
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+current_timings = ContextVar("current_timings", default=None)
+
+
+def record(kind, seconds):
+    """Add seconds of `kind` work to the current request, if there is one"""
+
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(kind, seconds)
+
+
+@contextmanager
+def timed(kind, histogram, *labels):
+    """Time the block into the current request and a histogram"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        record(kind, seconds)
+        histogram.observe(seconds, *labels)
+
+
+def register_gauges(name, help_text, source):
+    """Export the dict returned by source() as name{key="..."} at scrape time.
+
+    Registering a name again replaces its source.
+    """
+
+    GAUGE_SOURCES[:] = [gauge for gauge in GAUGE_SOURCES if gauge[0] != name]
+    GAUGE_SOURCES.append((name, help_text, source))
+
+
+def render_prometheus():
+    """All metrics in Prometheus text exposition format"""
+
+    lines = []
+
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    for name, help_text, source in GAUGE_SOURCES:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+
+        for key, value in sorted(source().items()):
+            if isinstance(value, (int, float)):
+                lines.append(f'{name}{{key="{key}"}} {value}')
+
+    return "\n".join(lines) + "\n"
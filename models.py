@@ -2,10 +2,11 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
-bcrypt = Bcrypt()
+from passwords import hasher
+from db_pool import engine_options, watch_engine
+
 db = SQLAlchemy()
 
 class User(db.Model):
@@ -58,6 +59,31 @@ class User(db.Model):
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}"
+
+    def has_favorite(self, hero_id):
+        """Is hero a favorite of this user?
+
+        Uses an EXISTS check on the (user_id, hero_id) index instead of
+        loading the user's favorites.
+        """
+
+        query = db.select(
+            db.exists().where(Favorites.user_id == self.id, Favorites.hero_id == hero_id))
+        return db.session.scalar(query)
+
+    def favorite_ids(self):
+        """Set of hero ids this user has favorited, without loading Favorites rows"""
+
+        query = db.select(Favorites.hero_id).where(Favorites.user_id == self.id)
+        return set(db.session.scalars(query))
+
+    def favorite_rating(self, hero_id):
+        """(is hero a favorite, this user's rating of it or None), in one lookup"""
+
+        row = db.session.execute(
+            db.select(Favorites.rating)
+            .where(Favorites.user_id == self.id, Favorites.hero_id == hero_id)).first()
+        return (row is not None, row.rating if row else None)
     
     @classmethod
     def signup(cls, username, password, email, image_url):
@@ -66,7 +92,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -83,13 +109,17 @@ class User(db.Model):
         """Find user with 'username' and 'password'.
 
         If can't find matching user (or if password is wrong), return False.
+        If the password was hashed with an old cost factor, it's re-hashed.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.verify(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
+                    db.session.commit()
                 return user
             
         return False
@@ -100,6 +130,11 @@ class Favorites(db.Model):
 
     __tablename__ = 'favorites'
 
+    # A user can only favorite each hero once; also serves lookups by user
+    __table_args__ = (
+        db.Index('ix_favorites_user_hero', 'user_id', 'hero_id', unique=True),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -115,17 +150,481 @@ class Favorites(db.Model):
         db.Integer,
     )
 
+    # 1-5 stars, or None if not rated; counted in HeroRating
     rating = db.Column(
         db.Integer,
     )
 
     user = db.relationship("User")
 
+    @classmethod
+    def rate(cls, user_id, hero_id, rating):
+        """Set user's rating of a favorite hero (None to clear it).
+
+        Updates the hero's HeroRating totals in the same transaction.
+        Returns False, changing nothing, if the hero isn't a favorite.
+        """
+
+        # Locks the favorite so a concurrent rating can't be counted twice
+        row = db.session.execute(
+            db.select(cls.id, cls.rating)
+            .where(cls.user_id == user_id, cls.hero_id == hero_id)
+            .with_for_update()).first()
+
+        if row is None:
+            return False
+        if row.rating == rating:
+            return True
+
+        db.session.execute(
+            db.update(cls).where(cls.id == row.id).values(rating=rating)
+            .execution_options(synchronize_session=False))
+
+        if row.rating is None:
+            HeroRating.added(hero_id, rating)
+        elif rating is None:
+            HeroRating.removed([(hero_id, row.rating)])
+        else:
+            HeroRating.changed(hero_id, rating - row.rating)
+
+        return True
+
+    @classmethod
+    def toggle(cls, user_id, hero_id):
+        """Favorite hero for user, or un-favorite it if it already is.
+
+        Doesn't load anything: tries the delete first and only inserts if
+        nothing was deleted. Returns True if the hero is now a favorite.
+        """
+
+        deleted = db.session.execute(
+            db.delete(cls).where(cls.user_id == user_id, cls.hero_id == hero_id)
+            .returning(cls.rating)).first()
+
+        if deleted:
+            HeroPopularity.decrement([hero_id])
+            CoFavorite.favorites_removed(user_id, [hero_id])
+            if deleted.rating is not None:
+                HeroRating.removed([(hero_id, deleted.rating)])
+            return False
+
+        cls.add_many(user_id, [hero_id])
+        return True
+
+    @classmethod
+    def add_many(cls, user_id, hero_ids):
+        """Favorite several heroes at once, ignoring ones already favorited"""
+
+        rows = [{"user_id": user_id, "hero_id": hero_id} for hero_id in sorted(set(hero_ids))]
+        if not rows:
+            return
+
+        stmt = (dialect_insert(cls).values(rows)
+                .on_conflict_do_nothing(index_elements=["user_id", "hero_id"])
+                .returning(cls.hero_id))
+        added = db.session.scalars(stmt).all()
+        HeroPopularity.increment(added)
+        CoFavorite.favorites_added(user_id, added)
+
+    @classmethod
+    def remove_many(cls, user_id, hero_ids):
+        """Un-favorite several heroes at once"""
+
+        hero_ids = set(hero_ids)
+        if not hero_ids:
+            return
+
+        cls._delete_where(cls.user_id == user_id, cls.hero_id.in_(hero_ids))
+
+    @classmethod
+    def remove_all(cls, user_id):
+        """Un-favorite everything for user (before deleting them)"""
+
+        cls._delete_where(cls.user_id == user_id)
+
+    @classmethod
+    def _delete_where(cls, *criteria):
+        deleted = db.session.execute(
+            db.delete(cls).where(*criteria).returning(cls.user_id, cls.hero_id, cls.rating)).all()
+        HeroPopularity.decrement([hero_id for _, hero_id, _ in deleted])
+
+        by_user = {}
+        for user_id, hero_id, _ in deleted:
+            by_user.setdefault(user_id, []).append(hero_id)
+        for user_id, hero_ids in by_user.items():
+            CoFavorite.favorites_removed(user_id, hero_ids)
+        HeroRating.removed([(hero_id, rating) for _, hero_id, rating in deleted
+                            if rating is not None])
+
+
+class HeroPopularity(db.Model):
+    """How many users have favorited each hero.
+
+    Kept up to date by the Favorites helpers as favorites come and go, so
+    the leaderboard reads the top rows of an index instead of counting the
+    favorites table. popularity.reconcile() recounts it to fix any drift.
+    """
+
+    __tablename__ = 'hero_popularity'
+
+    # id from API
+    hero_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    favorites = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        index=True,
+    )
+
+    @classmethod
+    def increment(cls, hero_ids):
+        """Count one more favorite for each hero"""
+
+        # Sorted so concurrent transactions lock rows in the same order
+        rows = [{"hero_id": hero_id, "favorites": 1} for hero_id in sorted(hero_ids)]
+        if not rows:
+            return
+
+        stmt = dialect_insert(cls).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["hero_id"],
+            set_={"favorites": cls.favorites + stmt.excluded.favorites},
+        )
+        db.session.execute(stmt)
+
+    @classmethod
+    def decrement(cls, hero_ids):
+        """Count one less favorite for each hero"""
+
+        hero_ids = sorted(hero_ids)
+        if not hero_ids:
+            return
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.hero_id.in_(hero_ids), cls.favorites > 0)
+            .values(favorites=cls.favorites - 1)
+            .execution_options(synchronize_session=False))
+
+
+class HeroRating(db.Model):
+    """Running totals of each hero's ratings.
+
+    Kept up to date by Favorites.rate() and the delete helpers in the same
+    transaction as the rating itself, so hero pages and the top-rated list
+    read one row or the top of an index instead of averaging the favorites
+    table. ratings.reaggregate() recounts it to fix any drift.
+    """
+
+    __tablename__ = 'hero_ratings'
+
+    # id from API
+    hero_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    ratings = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    rating_sum = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # rating_sum / ratings, stored so it can be indexed; None with no ratings
+    average = db.Column(
+        db.Float,
+    )
+
+    @staticmethod
+    def average_of(rating_sum, ratings):
+        """SQL expression for the average of rating_sum over ratings"""
+
+        return db.case((ratings > 0, db.cast(rating_sum, db.Float) / ratings), else_=None)
+
+    @classmethod
+    def added(cls, hero_id, rating):
+        """Count a new rating of hero"""
+
+        stmt = dialect_insert(cls).values(
+            hero_id=hero_id, ratings=1, rating_sum=rating, average=float(rating))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["hero_id"],
+            set_={
+                "ratings": cls.ratings + 1,
+                "rating_sum": cls.rating_sum + stmt.excluded.rating_sum,
+                "average": cls.average_of(cls.rating_sum + stmt.excluded.rating_sum,
+                                          cls.ratings + 1),
+            },
+        )
+        db.session.execute(stmt)
+
+    @classmethod
+    def changed(cls, hero_id, delta):
+        """Count an existing rating of hero going up (or down) by delta"""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.hero_id == hero_id, cls.ratings > 0)
+            .values(rating_sum=cls.rating_sum + delta,
+                    average=cls.average_of(cls.rating_sum + delta, cls.ratings))
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def removed(cls, ratings):
+        """Stop counting ratings, an iterable of (hero_id, rating) being removed"""
+
+        totals = {}
+        for hero_id, rating in ratings:
+            rating_sum, count = totals.get(hero_id, (0, 0))
+            totals[hero_id] = (rating_sum + rating, count + 1)
+
+        # One statement per distinct change (usually one per star), not per hero
+        by_change = {}
+        for hero_id, change in totals.items():
+            by_change.setdefault(change, []).append(hero_id)
+
+        for (rating_sum, count), hero_ids in sorted(by_change.items()):
+            db.session.execute(
+                db.update(cls)
+                .where(cls.hero_id.in_(sorted(hero_ids)), cls.ratings >= count)
+                .values(ratings=cls.ratings - count,
+                        rating_sum=cls.rating_sum - rating_sum,
+                        average=cls.average_of(cls.rating_sum - rating_sum, cls.ratings - count))
+                .execution_options(synchronize_session=False))
+
+
+# Top-rated list in index order: best average first, more ratings breaking ties
+db.Index('ix_hero_ratings_top', HeroRating.average.desc(), HeroRating.ratings.desc(),
+         HeroRating.hero_id)
+
+
+class CoFavorite(db.Model):
+    """How many users have favorited both of two heroes.
+
+    Stored both ways round, so a hero's pairs are one index range. Kept up
+    to date by the Favorites helpers; recommendations.rebuild() recounts
+    it from scratch.
+    """
+
+    __tablename__ = 'co_favorites'
+
+    hero_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    other_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    together = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Most pairs written per statement
+    BATCH_SIZE = 1000
+
+    @classmethod
+    def favorites_added(cls, user_id, hero_ids):
+        """Count user's new favorites hero_ids together with their others"""
+
+        cls._adjust(cls._pairs(user_id, hero_ids), 1)
+
+    @classmethod
+    def favorites_removed(cls, user_id, hero_ids):
+        """Stop counting user's just-removed favorites hero_ids with their others"""
+
+        cls._adjust(cls._pairs(user_id, hero_ids), -1)
+
+    @classmethod
+    def _pairs(cls, user_id, changed):
+        """Both-ways pairs of each changed hero with user's other favorites and each other.
+
+        Call after the favorites table has been changed.
+        """
+
+        changed = set(changed)
+        if not changed:
+            return []
+
+        current = set(db.session.scalars(
+            db.select(Favorites.hero_id).where(Favorites.user_id == user_id)))
+        involved = current | changed
+
+        pairs = {(hero_id, other_id) for hero_id in changed for other_id in involved
+                 if other_id != hero_id}
+        pairs |= {(other_id, hero_id) for hero_id, other_id in pairs}
+
+        # Sorted so concurrent transactions lock rows in the same order
+        return sorted(pairs)
+
+    @classmethod
+    def _adjust(cls, pairs, delta):
+        for start in range(0, len(pairs), cls.BATCH_SIZE):
+            batch = pairs[start:start + cls.BATCH_SIZE]
+
+            if delta > 0:
+                stmt = dialect_insert(cls).values(
+                    [{"hero_id": hero_id, "other_id": other_id, "together": delta}
+                     for hero_id, other_id in batch])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["hero_id", "other_id"],
+                    set_={"together": cls.together + stmt.excluded.together},
+                )
+            else:
+                stmt = (db.update(cls)
+                        .where(db.tuple_(cls.hero_id, cls.other_id).in_(batch))
+                        .values(together=cls.together + delta)
+                        .execution_options(synchronize_session=False))
+
+            db.session.execute(stmt)
+
+
+class HeroRecommendation(db.Model):
+    """A hero's most co-favorited heroes, best first.
+
+    Written by recommendations.py so a hero page reads its list straight
+    off the primary key.
+    """
+
+    __tablename__ = 'hero_recommendations'
+
+    hero_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    other_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # Cosine similarity of the two heroes' sets of fans
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class Hero(db.Model):
+    """Superhero from the API, stored locally so pages don't have to call it"""
+
+    __tablename__ = 'heroes'
+
+    # id from API
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    aliases = db.Column(
+        db.JSON,
+        nullable=False,
+        default=list,
+    )
+
+    birth_place = db.Column(
+        db.Text,
+    )
+
+    first_appear = db.Column(
+        db.Text,
+    )
+
+    job = db.Column(
+        db.Text,
+    )
+
+    image = db.Column(
+        db.Text,
+    )
+
+    # Full JSON response from the API
+    data = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # When this row was last fetched from the API, for incremental refresh
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"<Hero #{self.id}: {self.name}>"
+
+
+def dialect_insert(model):
+    """INSERT for model that supports ON CONFLICT.
+
+    Works on both PostgreSQL and SQLite (used for local testing).
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    return insert(model)
+
+
+def upsert(model, rows, index_elements, update_columns):
+    """Insert rows into model's table, updating update_columns on conflict."""
+
+    if not rows:
+        return
+
+    stmt = dialect_insert(model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={col: stmt.excluded[col] for col in update_columns},
+    )
+    db.session.execute(stmt)
+
 
 def connect_db(app):
     """Connecting this database to the lask app."""
 
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
     db.app = app
     db.init_app(app)
 
+    with app.app_context():
+        for engine in db.engines.values():
+            watch_engine(engine)
+
 
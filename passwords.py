@@ -0,0 +1,170 @@
+"""Password hashing and login rate limiting
+
+bcrypt is deliberately slow, so hashing runs on a small process pool
+instead of the request thread. A burst of logins then queues up for the
+pool rather than starving every other route on the worker.
+
+Settings (environment):
+    BCRYPT_LOG_ROUNDS       bcrypt cost factor (default 12). Hashes made with
+                            a different cost are upgraded on the next login.
+    PASSWORD_HASH_WORKERS   processes in the pool (default 2, 0 = hash inline)
+    LOGIN_MAX_ATTEMPTS      failed logins allowed per username/IP per window
+    LOGIN_WINDOW            length of that window in seconds
+    LOGIN_MAX_TRACKED       most usernames/IPs to remember failures for
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from per_process import PerProcess
+
+
+# bcrypt is imported where it's used, so it only loads in processes that hash
+def _hash(password, rounds):
+    import bcrypt
+
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check(hashed, password):
+    import bcrypt
+
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    except ValueError:
+        # Stored value isn't a bcrypt hash
+        return False
+
+
+class PasswordHasher:
+    """Hashes and checks passwords with bcrypt on a bounded process pool"""
+
+    def __init__(self, rounds=12, workers=2):
+        self.rounds = rounds
+        self.workers = workers
+        self._pool = PerProcess(lambda: ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ))
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        return self._pool.get().submit(func, *args).result()
+
+    def hash(self, password):
+        """Return bcrypt hash of password"""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+
+        return self._run(_hash, password, self.rounds)
+
+    def verify(self, hashed, password):
+        """Does password match the stored hash?"""
+
+        if not password or not hashed:
+            return False
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was hashed made with a different cost factor than the current one?"""
+
+        # bcrypt hashes look like $2b$12$<salt+hash>
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        pool = self._pool.reset()
+        if pool is not None:
+            pool.shutdown()
+
+
+class LoginRateLimiter:
+    """Limits failed login attempts per key (username or IP address).
+
+    Keeps a sliding window of failure times per key, in memory per worker.
+    Keys are swept once their last failure leaves the window, and at most
+    `max_keys` are tracked (the least recently failed go first), so
+    failures for endless made-up usernames can't grow the worker.
+    """
+
+    def __init__(self, max_attempts=5, window=300, max_keys=100_000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_keys = max_keys
+        # key -> deque of its latest failure times, least recently failed key first
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _prune(self, key, now):
+        failures = self._failures[key]
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+
+        if not failures:
+            del self._failures[key]
+            return 0
+
+        return len(failures)
+
+    def _sweep(self, now):
+        """Forget keys with no failures in the window, then any past max_keys"""
+
+        while self._failures:
+            key, failures = next(iter(self._failures.items()))
+            if failures[-1] > now - self.window and len(self._failures) <= self.max_keys:
+                break
+            del self._failures[key]
+
+    def allow(self, *keys):
+        """Can a login be attempted for all of these keys?"""
+
+        now = time.monotonic()
+
+        with self._lock:
+            return all(self._prune(key, now) < self.max_attempts
+                       for key in keys if key in self._failures)
+
+    def record_failure(self, *keys):
+        now = time.monotonic()
+
+        with self._lock:
+            for key in keys:
+                # Only the latest max_attempts failures decide whether key is blocked
+                failures = self._failures.pop(key, None) or deque(maxlen=self.max_attempts)
+                failures.append(now)
+                self._failures[key] = failures
+
+            self._sweep(now)
+
+    def reset(self, *keys):
+        """Forget failures after a successful login"""
+
+        with self._lock:
+            for key in keys:
+                self._failures.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._failures)
+
+
+hasher = PasswordHasher(
+    rounds=int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)),
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+)
+
+login_limiter = LoginRateLimiter(
+    max_attempts=int(os.environ.get('LOGIN_MAX_ATTEMPTS', 5)),
+    window=int(os.environ.get('LOGIN_WINDOW', 300)),
+    max_keys=int(os.environ.get('LOGIN_MAX_TRACKED', 100_000)),
+)
@@ -0,0 +1,43 @@
+"""Resources that each process makes for itself
+
+Thread and process pools, HTTP sessions and the like can't be shared with
+a forked child: the pool's threads and the session's sockets belong to the
+parent. Anything created before gunicorn forks its workers (with preload,
+or at import) would be broken in every worker, so these are made on first
+use in each process instead.
+"""
+
+import os
+import threading
+
+
+class PerProcess:
+    """factory() called on first use in each process, then reused there.
+
+    Pass `value` to start with one already made for this process.
+    """
+
+    def __init__(self, factory, value=None):
+        self.factory = factory
+        self._value = value
+        self._pid = os.getpid() if value is not None else None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """This process's resource, made now if it doesn't have one yet"""
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._value = self.factory()
+                self._pid = os.getpid()
+
+            return self._value
+
+    def reset(self):
+        """Forget this process's resource and return it (or None), e.g. to shut it down"""
+
+        with self._lock:
+            value = self._value if self._pid == os.getpid() else None
+            self._value = self._pid = None
+
+            return value
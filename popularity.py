@@ -0,0 +1,77 @@
+"""Most-favorited heroes
+
+Reads the hero_popularity counters that the Favorites helpers keep up to
+date, so the leaderboard costs the same however many favorites there are.
+
+Favorites written some other way (direct inserts, manual fixes) aren't
+counted, so recount now and then, e.g. nightly from cron:
+
+    flask popularity reconcile
+"""
+
+import click
+from flask.cli import AppGroup
+
+from models import db, Favorites, HeroPopularity, upsert
+from catalog import get_heroes
+
+# Most heroes the leaderboard will return
+MAX_LIMIT = 100
+
+
+def top_hero_counts(limit=10):
+    """[(hero_id, favorites)] for the most favorited heroes"""
+
+    query = (db.select(HeroPopularity.hero_id, HeroPopularity.favorites)
+             .where(HeroPopularity.favorites > 0)
+             .order_by(HeroPopularity.favorites.desc(), HeroPopularity.hero_id)
+             .limit(limit))
+
+    return [tuple(row) for row in db.session.execute(query)]
+
+
+def popular_heroes(limit=10):
+    """[(Hero, favorites)] for the most favorited heroes, most first"""
+
+    counts = top_hero_counts(limit)
+    heroes = {hero.id: hero for hero in get_heroes([hero_id for hero_id, _ in counts])}
+
+    return [(heroes[hero_id], favorites) for hero_id, favorites in counts if hero_id in heroes]
+
+
+def reconcile():
+    """Recount favorites per hero and fix any counters that drifted.
+
+    Returns the number of counters corrected. Favorites toggled while this
+    runs can be miscounted; the next run fixes them.
+    """
+
+    actual = dict(db.session.execute(
+        db.select(Favorites.hero_id, db.func.count()).group_by(Favorites.hero_id)).all())
+    stored = dict(db.session.execute(
+        db.select(HeroPopularity.hero_id, HeroPopularity.favorites)).all())
+
+    fixes = {hero_id: count for hero_id, count in actual.items() if stored.get(hero_id) != count}
+    fixes.update({hero_id: 0 for hero_id, count in stored.items()
+                  if hero_id not in actual and count})
+
+    upsert(HeroPopularity, [{"hero_id": hero_id, "favorites": count}
+                            for hero_id, count in sorted(fixes.items())],
+           ["hero_id"], ["favorites"])
+    db.session.commit()
+
+    return len(fixes)
+
+
+############################################################################
+# CLI commands, registered on the app as `flask popularity ...`
+
+popularity_cli = AppGroup("popularity", help="Manage the favorites leaderboard.")
+
+
+@popularity_cli.command("reconcile")
+def reconcile_command():
+    """Recount favorites per hero and fix the leaderboard counters."""
+
+    db.create_all()
+    click.echo(f"Corrected {reconcile()} hero counters")
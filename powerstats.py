@@ -0,0 +1,278 @@
+"""Hero powerstats as a matrix
+
+The API rates every hero 0-100 on six stats, kept in each catalog row's
+raw JSON. This keeps them as a heroes x stats float32 matrix so "similar
+heroes" and side-by-side comparisons are a few vectorized operations
+over the whole catalog instead of a loop over JSON.
+
+The matrix is written to disk once per catalog version and memory-mapped,
+so every gunicorn worker on the box shares one copy in the page cache.
+Whichever worker first sees a new catalog version builds it; the others
+pick it up from disk. Each worker checks the catalog version at most every
+POWERSTATS_SYNC_INTERVAL seconds.
+
+Settings (environment):
+    POWERSTATS_DIR              where matrices are stored (default: a
+                                directory in the system temp dir)
+    POWERSTATS_SYNC_INTERVAL    seconds between catalog checks (default 60)
+"""
+
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from models import db, Hero
+from catalog import catalog_version
+
+STATS = ("intelligence", "strength", "speed", "durability", "power", "combat")
+
+METRICS = ("cosine", "euclidean")
+
+SYNC_INTERVAL = int(os.environ.get('POWERSTATS_SYNC_INTERVAL', 60))
+
+
+def parse_stats(data):
+    """Powerstats from raw API JSON, as floats (NaN where the API says "null")"""
+
+    powerstats = data.get("powerstats") or {}
+    values = []
+
+    for stat in STATS:
+        try:
+            values.append(float(powerstats.get(stat)))
+        except (TypeError, ValueError):
+            values.append(np.nan)
+
+    return values
+
+
+class PowerStats:
+    """Powerstats of every catalog hero with at least one known stat.
+
+    ids are sorted so a hero's row is found with a binary search. stats
+    has NaN for unknown values and filled has 0 instead; the rest is
+    worked out once at build time so queries don't have to: unit is each
+    filled row scaled to length 1 (for cosine similarity), sqnorm each
+    filled row's squared length (for euclidean distance), and average the
+    catalog average of each stat.
+    """
+
+    FILES = ("ids", "stats", "filled", "unit", "sqnorm", "average")
+
+    def __init__(self, ids, stats, filled, unit, sqnorm, average):
+        self.ids = ids
+        self.stats = stats
+        self.filled = filled
+        self.unit = unit
+        self.sqnorm = sqnorm
+        self.average = average
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, rows):
+        """Build from (hero_id, raw API JSON) pairs"""
+
+        ids, values = [], []
+
+        for hero_id, data in sorted(rows, key=lambda row: row[0]):
+            stats = parse_stats(data)
+            if not all(np.isnan(stats)):
+                ids.append(hero_id)
+                values.append(stats)
+
+        ids = np.array(ids, dtype=np.int32)
+        stats = np.array(values, dtype=np.float32).reshape(len(ids), len(STATS))
+
+        filled = np.nan_to_num(stats)
+        sqnorm = np.einsum("ij,ij->i", filled, filled)
+        norms = np.sqrt(sqnorm)[:, None]
+        unit = np.divide(filled, norms, out=np.zeros_like(filled), where=norms > 0)
+        average = (np.nanmean(stats, axis=0) if len(ids)
+                   else np.full(len(STATS), np.nan, dtype=np.float32))
+
+        return cls(ids, stats, filled, unit, sqnorm, average)
+
+    def save(self, path):
+        """Write to directory path (which mustn't exist yet) atomically"""
+
+        parent = os.path.dirname(path)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".building-")
+
+        for name in self.FILES:
+            np.save(os.path.join(tmp, f"{name}.npy"), getattr(self, name))
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another worker got there first; theirs is the same
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a matrix written by save()"""
+
+        return cls(*(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                     for name in cls.FILES))
+
+    def row(self, hero_id):
+        """Row index of hero_id, or None if it has no stats"""
+
+        i = int(np.searchsorted(self.ids, hero_id))
+
+        if i < len(self.ids) and self.ids[i] == hero_id:
+            return i
+
+        return None
+
+    def similar(self, hero_id, limit=10, metric="cosine"):
+        """[(hero_id, score)] of the heroes most like hero_id, best first.
+
+        cosine scores are similarity (1 is the same mix of stats); euclidean
+        scores are distance (0 is identical stats). Unknown stats count as 0.
+        Returns None if hero_id has no stats.
+        """
+
+        i = self.row(hero_id)
+        if i is None:
+            return None
+
+        if metric == "cosine":
+            # Negate so the best is smallest, as with distances
+            scores = -(self.unit @ self.unit[i])
+        elif metric == "euclidean":
+            # Squared distances from |a - b|^2 = |a|^2 + |b|^2 - 2a.b, as one
+            # matrix-vector product; square roots are only taken of the best
+            scores = self.sqnorm + self.sqnorm[i] - 2 * (self.filled @ self.filled[i])
+        else:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        # Never suggest the hero itself
+        scores[i] = np.inf
+        limit = min(limit, len(scores) - 1)
+        if limit <= 0:
+            return []
+
+        # Top `limit` in one pass, then sort only those
+        best = np.argpartition(scores, limit - 1)[:limit]
+        best = best[np.lexsort((self.ids[best], scores[best]))]
+
+        if metric == "cosine":
+            values = -scores[best]
+        else:
+            # Rounding can take identical stats slightly below 0
+            values = np.sqrt(np.maximum(scores[best], 0))
+
+        return [(int(self.ids[j]), round(float(value), 4)) for j, value in zip(best, values)]
+
+    def compare(self, hero_ids):
+        """Side-by-side stats for hero_ids.
+
+        Returns a dict with the heroes found (in the order asked for) and
+        their stats, each hero's total, which of them leads each stat, and
+        the catalog average of each stat; ids without stats are listed
+        under "missing".
+        """
+
+        hero_ids = np.asarray(list(hero_ids), dtype=np.int64)
+
+        # Look every id up at once
+        rows = np.searchsorted(self.ids, hero_ids)
+        ok = rows < len(self.ids)
+        ok[ok] = self.ids[rows[ok]] == hero_ids[ok]
+        rows, found = rows[ok], hero_ids[ok].tolist()
+
+        stats = self.stats[rows]
+        totals = np.nansum(stats, axis=1).tolist()
+
+        # Highest value per stat among the compared heroes (ties all lead)
+        best = np.max(np.where(np.isnan(stats), -np.inf, stats), axis=0, initial=-np.inf)
+        leads = stats == best
+
+        return {
+            "stats": list(STATS),
+            "heroes": [{"id": hero_id,
+                        "powerstats": {stat: _value(value) for stat, value in zip(STATS, values)},
+                        "total": _value(total)}
+                       for hero_id, values, total in zip(found, stats.tolist(), totals)],
+            "leaders": {stat: [found[h] for h in np.flatnonzero(leads[:, s])]
+                        for s, stat in enumerate(STATS)},
+            "average": {stat: _value(value, 1)
+                        for stat, value in zip(STATS, self.average.tolist())},
+            "missing": hero_ids[~ok].tolist(),
+        }
+
+
+def _value(x, digits=0):
+    """A stat as JSON: int (or rounded float), None if unknown"""
+
+    if math.isnan(x):
+        return None
+
+    return int(x) if digits == 0 else round(x, digits)
+
+
+class PowerStatsStore:
+    """The current catalog's PowerStats for this worker, rebuilt as it changes"""
+
+    def __init__(self, root):
+        self.root = root
+        self.matrix = None
+        self.version = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def _build(self, path, database):
+        rows = db.session.execute(db.select(Hero.id, Hero.data)).all()
+        PowerStats.build(rows).save(path)
+
+        # Drop this database's older versions. Workers that have one mapped
+        # can keep reading it (on POSIX) until they next sync.
+        for name in os.listdir(self.root):
+            if name.startswith(database) and name != os.path.basename(path):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def sync(self):
+        """Load the matrix for the current catalog version, building it if needed"""
+
+        # Versions are per database, so apps on other databases can share root
+        database = hashlib.sha1(str(db.engine.url).encode()).hexdigest()[:8]
+        count, last_updated = catalog_version()
+        version = f"{database}-{count}-{last_updated.timestamp() if last_updated else 0:.6f}"
+
+        if version != self.version:
+            os.makedirs(self.root, exist_ok=True)
+            path = os.path.join(self.root, version)
+
+            try:
+                self.matrix = PowerStats.load(path)
+            except FileNotFoundError:
+                self._build(path, database)
+                self.matrix = PowerStats.load(path)
+
+            self.version = version
+
+        self.checked_at = time.monotonic()
+        return self.matrix
+
+    def current(self):
+        """The matrix, checking for catalog changes at most every SYNC_INTERVAL"""
+
+        with self._lock:
+            if self.checked_at is None or time.monotonic() - self.checked_at >= SYNC_INTERVAL:
+                self.sync()
+
+            return self.matrix
+
+
+# Shared by every request in this worker
+powerstats = PowerStatsStore(
+    os.environ.get('POWERSTATS_DIR') or os.path.join(tempfile.gettempdir(),
+                                                     "superhero-powerstats"))
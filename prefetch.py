@@ -0,0 +1,127 @@
+"""Cache warming
+
+Fetches heroes into the local catalog in the background before anyone
+asks for them:
+
+- when a gunicorn worker boots (see gunicorn.conf.py), the heroes the
+  /superheros grid starts with, and the search index
+- right after a user logs in, that user's favorites
+
+Jobs run on a small thread pool and are dropped, not queued, once too
+many are pending, so a burst of logins can't pile up work.
+
+Settings (environment):
+    PREFETCH                set to 0 to turn warming off
+    PREFETCH_WORKERS        background threads (default 2)
+    PREFETCH_MAX_PENDING    jobs waiting or running before new ones are
+                            dropped (default 16)
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from models import db, Favorites
+from catalog import get_heroes, FEATURED_HERO_IDS
+from search import hero_index
+from per_process import PerProcess
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Runs warming jobs in the background with bounded concurrency"""
+
+    def __init__(self, workers=2, max_pending=16, enabled=True):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self.counters = dict(submitted=0, completed=0, failed=0, dropped=0)
+        self.pending = 0
+        self._pool = PerProcess(lambda: ThreadPoolExecutor(max_workers=self.workers,
+                                                           thread_name_prefix="prefetch"))
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, app, func, *args):
+        """Run func(*args) in app's context in the background.
+
+        Returns False if warming is off or too many jobs are pending.
+        """
+
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.counters["dropped"] += 1
+                return False
+
+            self.pending += 1
+            self.counters["submitted"] += 1
+            self._pool.get().submit(self._run, app, func, args)
+
+        return True
+
+    def _run(self, app, func, args):
+        outcome = "completed"
+
+        try:
+            with app.app_context():
+                func(*args)
+        except Exception:
+            outcome = "failed"
+            logger.exception("prefetch %s%r failed", func.__name__, args)
+
+        with self._lock:
+            self.counters[outcome] += 1
+            self.pending -= 1
+            self._idle.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until no jobs are pending; returns False on timeout"""
+
+        with self._lock:
+            return self._idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=self.pending)
+
+
+prefetcher = Prefetcher(
+    workers=int(os.environ.get('PREFETCH_WORKERS', 2)),
+    max_pending=int(os.environ.get('PREFETCH_MAX_PENDING', 16)),
+    enabled=os.environ.get('PREFETCH', '1') == '1',
+)
+
+
+def warm_grid():
+    """Make sure the heroes the grid starts with are local, and index them"""
+
+    # The grid shows catalog rows, seeded with the featured heroes
+    get_heroes(FEATURED_HERO_IDS)
+    hero_index.ensure_fresh()
+
+
+def warm_favorites(user_id):
+    """Fetch any of user's favorites that aren't in the catalog yet"""
+
+    hero_ids = db.session.scalars(
+        db.select(Favorites.hero_id).where(Favorites.user_id == user_id)).all()
+    get_heroes(hero_ids)
+
+
+def warm_at_boot(app):
+    """Start warming the grid for a freshly booted worker"""
+
+    return prefetcher.submit(app, warm_grid)
+
+
+def prefetch_favorites(user_id):
+    """Start fetching a just-logged-in user's favorites"""
+
+    return prefetcher.submit(current_app._get_current_object(), warm_favorites, user_id)
@@ -0,0 +1,312 @@
+"""Opt-in sampling profiler for live workers
+
+Off by default and costs nothing until an admin starts it. While running,
+a background thread samples the Python stack of every thread that is
+handling a profiled request, every `interval` seconds, and counts the
+stacks per route. Reports come out as collapsed stacks (for flamegraph.pl
+or speedscope) or speedscope's JSON format.
+
+Admin routes (users listed in ADMIN_USERS):
+    GET  /admin/profile/capture?seconds=10      profile every request for N
+                                                seconds (up to
+                                                PROFILE_CAPTURE_MAX_SECONDS),
+                                                then return the report
+    POST /admin/profile/start?seconds=300&rate=0.05
+                                                profile a fraction of requests
+                                                in the background
+    POST /admin/profile/stop
+    GET  /admin/profile?format=speedscope&route=hero_info
+                                                report so far
+
+Each gunicorn worker has its own profiler, so these only see the worker
+that handles the admin request. Async views run on asgiref's event loop
+thread and aren't sampled.
+"""
+
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import abort, current_app, g, jsonify, request, Response
+
+from http_cache import cache_policy
+
+# Deepest stack kept per sample
+MAX_DEPTH = 128
+
+# Longest a profile can run
+MAX_SECONDS = 600
+
+# Longest /admin/profile/capture holds its worker. Keep it under gunicorn's
+# worker timeout (30s unless --timeout says otherwise), or the worker is
+# killed mid-capture; use start/report for longer profiles.
+MAX_CAPTURE_SECONDS = float(os.environ.get('PROFILE_CAPTURE_MAX_SECONDS', 20))
+
+
+class SamplingProfiler:
+    """Samples stacks of request threads and aggregates them per route"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.rate = 0.0
+        self.deadline = 0.0
+        self.stacks = Counter()      # (route, stack) -> samples
+        self._threads = {}           # thread id -> route being profiled
+        self._sampler = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._sampler is not None and time.monotonic() < self.deadline
+
+    def start(self, seconds, rate=1.0, interval=None):
+        """Profile `rate` of requests for the next `seconds`"""
+
+        with self._lock:
+            self.rate = rate
+            self.deadline = time.monotonic() + seconds
+            if interval:
+                self.interval = interval
+
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._sampler.start()
+
+    def stop(self):
+        with self._lock:
+            self.deadline = 0.0
+            sampler = self._sampler
+
+        if sampler is not None:
+            sampler.join()
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+
+    def begin_request(self, route):
+        """Profile the current thread's request, if it's picked"""
+
+        if self.deadline and time.monotonic() < self.deadline and random.random() < self.rate:
+            self._threads[threading.get_ident()] = route
+
+    def end_request(self):
+        self._threads.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            # Decide to exit under the lock, so start() never sees a sampler that's leaving
+            with self._lock:
+                if time.monotonic() >= self.deadline:
+                    self._sampler = None
+                    return
+
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        """Record one stack for each thread in a profiled request"""
+
+        frames = sys._current_frames()
+        samples = []
+
+        for thread_id, route in list(self._threads.items()):
+            frame = frames.get(thread_id)
+            if frame is not None:
+                samples.append((route, stack_of(frame)))
+
+        with self._lock:
+            self.stacks.update(samples)
+
+    def collapsed(self, route=None):
+        """Report in collapsed-stack format: route;outer;...;inner count"""
+
+        with self._lock:
+            items = sorted(self.stacks.items())
+
+        lines = []
+        for (stack_route, stack), count in items:
+            if route is None or stack_route == route:
+                names = [stack_route] + [frame_label(frame) for frame in stack]
+                lines.append(f"{';'.join(names)} {count}")
+
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def speedscope(self, route=None):
+        """Report in speedscope's file format, one profile per route"""
+
+        with self._lock:
+            items = sorted(self.stacks.items())
+
+        frames = []
+        frame_index = {}
+        profiles = {}
+
+        for (stack_route, stack), count in items:
+            if route is not None and stack_route != route:
+                continue
+
+            indexes = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    name, filename, line = frame
+                    frames.append({"name": name, "file": filename, "line": line})
+                indexes.append(frame_index[frame])
+
+            profile = profiles.setdefault(stack_route, {
+                "type": "sampled", "name": stack_route, "unit": "seconds",
+                "startValue": 0, "endValue": 0, "samples": [], "weights": []})
+            weight = count * self.interval
+            profile["samples"].append(indexes)
+            profile["weights"].append(weight)
+            profile["endValue"] += weight
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": "superheros",
+            "exporter": "superheros profiler",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": list(profiles.values()),
+        }
+
+    def status(self):
+        with self._lock:
+            samples = sum(self.stacks.values())
+            routes = sorted({route for route, _ in self.stacks})
+
+        return {
+            "running": self.running,
+            "rate": self.rate,
+            "interval": self.interval,
+            "seconds_left": round(max(0.0, self.deadline - time.monotonic()), 1),
+            "samples": samples,
+            "routes": routes,
+        }
+
+
+def stack_of(frame):
+    """Stack of (function, file, first line) from the outermost frame in"""
+
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        code = frame.f_code
+        stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+
+    stack.reverse()
+    return tuple(stack)
+
+
+def frame_label(frame):
+    name, filename, line = frame
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+profiler = SamplingProfiler(interval=float(os.environ.get('PROFILER_INTERVAL', 0.005)))
+
+############################################################################
+# Hooks and admin routes
+
+
+def begin_request():
+    if request.endpoint and not request.endpoint.startswith("profile"):
+        profiler.begin_request(request.endpoint)
+
+
+def end_request(exc):
+    profiler.end_request()
+
+
+def require_admin():
+    """404 unless the current user is listed in ADMIN_USERS"""
+
+    # Hide the routes entirely from everyone else
+    if not g.user or g.user.username not in current_app.config['ADMIN_USERS']:
+        abort(404)
+
+
+def report():
+    """Current profile in ?format=collapsed (default) or speedscope"""
+
+    route = request.args.get("route")
+
+    if request.args.get("format") == "speedscope":
+        return Response(json.dumps(profiler.speedscope(route)), mimetype="application/json")
+
+    return Response(profiler.collapsed(route), mimetype="text/plain")
+
+
+def option(name, default, maximum):
+    """Number from the query string, clamped to 0..maximum (400 if it isn't one)"""
+
+    try:
+        value = float(request.args.get(name, default))
+    except ValueError:
+        abort(400)
+
+    if not math.isfinite(value):
+        abort(400)
+
+    return min(max(value, 0), maximum)
+
+
+@cache_policy("no-store")
+def profile_report():
+    require_admin()
+    return report()
+
+
+@cache_policy("no-store")
+def profile_capture():
+    """Profile every request for ?seconds, then return the report"""
+
+    require_admin()
+
+    seconds = option("seconds", 10, MAX_CAPTURE_SECONDS)
+    profiler.reset()
+    profiler.start(seconds, rate=1.0, interval=option("interval", 0, 1))
+    time.sleep(seconds)
+    profiler.stop()
+
+    return report()
+
+
+@cache_policy("no-store")
+def profile_start():
+    """Start profiling ?rate of requests for ?seconds in the background"""
+
+    require_admin()
+
+    if request.args.get("reset", "1") == "1":
+        profiler.reset()
+    profiler.start(option("seconds", 60, MAX_SECONDS), rate=option("rate", 1.0, 1.0),
+                   interval=option("interval", 0, 1))
+
+    return jsonify(profiler.status())
+
+
+@cache_policy("no-store")
+def profile_stop():
+    require_admin()
+
+    profiler.stop()
+    return jsonify(profiler.status())
+
+
+def init_app(app):
+    """Register profiler hooks and admin routes"""
+
+    app.before_request(begin_request)
+    app.teardown_request(end_request)
+
+    app.add_url_rule("/admin/profile", "profile_report", profile_report)
+    app.add_url_rule("/admin/profile/capture", "profile_capture", profile_capture)
+    app.add_url_rule("/admin/profile/start", "profile_start", profile_start, methods=["POST"])
+    app.add_url_rule("/admin/profile/stop", "profile_stop", profile_stop, methods=["POST"])
@@ -0,0 +1,101 @@
+"""Hero ratings: users rate their favorite heroes 1-5 stars
+
+A rating lives on the user's Favorites row, so un-favoriting a hero drops
+its rating too. Each hero's running total and count are kept in
+hero_ratings by the Favorites helpers, in the same transaction as the
+rating, so a hero page reads one row and the top-rated list reads the top
+of an index however many ratings there are.
+
+Ratings written some other way (direct updates, manual fixes) aren't
+counted, so re-aggregate now and then, e.g. nightly from cron:
+
+    flask ratings reaggregate
+"""
+
+import click
+from flask.cli import AppGroup
+
+from models import db, Favorites, HeroRating, upsert
+from catalog import get_heroes
+
+MIN_RATING = 1
+MAX_RATING = 5
+
+# Fewest ratings for a hero to make the top-rated list, so one 5-star
+# rating doesn't top it
+MIN_RATINGS = 3
+
+# Most heroes the top-rated list will return
+MAX_LIMIT = 100
+
+
+def hero_rating(hero_id):
+    """(average, ratings) of hero; (None, 0) if nobody has rated it"""
+
+    row = db.session.execute(
+        db.select(HeroRating.average, HeroRating.ratings)
+        .where(HeroRating.hero_id == hero_id)).first()
+
+    return (row.average, row.ratings) if row and row.ratings else (None, 0)
+
+
+def top_rated_counts(limit=10, min_ratings=MIN_RATINGS):
+    """[(hero_id, average, ratings)] for the best rated heroes"""
+
+    query = (db.select(HeroRating.hero_id, HeroRating.average, HeroRating.ratings)
+             .where(HeroRating.average.is_not(None), HeroRating.ratings >= min_ratings)
+             .order_by(HeroRating.average.desc(), HeroRating.ratings.desc(), HeroRating.hero_id)
+             .limit(limit))
+
+    return [tuple(row) for row in db.session.execute(query)]
+
+
+def top_rated_heroes(limit=10, min_ratings=MIN_RATINGS):
+    """[(Hero, average, ratings)] for the best rated heroes, best first"""
+
+    counts = top_rated_counts(limit, min_ratings)
+    heroes = {hero.id: hero for hero in get_heroes([hero_id for hero_id, _, _ in counts])}
+
+    return [(heroes[hero_id], average, ratings)
+            for hero_id, average, ratings in counts if hero_id in heroes]
+
+
+def reaggregate():
+    """Recount every hero's ratings and fix any totals that drifted.
+
+    Returns the number of heroes corrected. Ratings changed while this
+    runs can be miscounted; the next run fixes them.
+    """
+
+    actual = {hero_id: (ratings, rating_sum) for hero_id, ratings, rating_sum in db.session.execute(
+        db.select(Favorites.hero_id, db.func.count(), db.func.sum(Favorites.rating))
+        .where(Favorites.rating.is_not(None))
+        .group_by(Favorites.hero_id))}
+    stored = {hero_id: (ratings, rating_sum) for hero_id, ratings, rating_sum in db.session.execute(
+        db.select(HeroRating.hero_id, HeroRating.ratings, HeroRating.rating_sum))}
+
+    fixes = {hero_id: totals for hero_id, totals in actual.items() if stored.get(hero_id) != totals}
+    fixes.update({hero_id: (0, 0) for hero_id, totals in stored.items()
+                  if hero_id not in actual and totals != (0, 0)})
+
+    upsert(HeroRating, [{"hero_id": hero_id, "ratings": ratings, "rating_sum": rating_sum,
+                         "average": rating_sum / ratings if ratings else None}
+                        for hero_id, (ratings, rating_sum) in sorted(fixes.items())],
+           ["hero_id"], ["ratings", "rating_sum", "average"])
+    db.session.commit()
+
+    return len(fixes)
+
+
+############################################################################
+# CLI commands, registered on the app as `flask ratings ...`
+
+ratings_cli = AppGroup("ratings", help="Manage hero rating totals.")
+
+
+@ratings_cli.command("reaggregate")
+def reaggregate_command():
+    """Recount ratings per hero and fix the stored totals."""
+
+    db.create_all()
+    click.echo(f"Corrected {reaggregate()} hero rating totals")
@@ -0,0 +1,354 @@
+"""Co-favorite recommendations: fans of this hero also favorited...
+
+Two heroes are similar when the same users favorite them, scored by the
+cosine similarity of their sets of fans:
+
+    together / sqrt(fans of one * fans of the other)
+
+rebuild() recounts everything from the favorites table: it builds a
+sparse user x hero matrix, multiplies it by its transpose in blocks of
+users to get co-favorite counts for every pair of heroes, and stores the
+counts (co_favorites) and each hero's top PER_HERO list
+(hero_recommendations), so pages read a ready list off an index.
+
+Between rebuilds the Favorites helpers keep co_favorites counts exact,
+and refresh() re-ranks the lists of the heroes a change touched: right
+away for the hero that was (un)favorited, in the background for the
+user's other favorites. Rebuild nightly, e.g. from cron:
+
+    flask recommendations rebuild
+"""
+
+import heapq
+import logging
+import math
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Favorites, CoFavorite, HeroRecommendation, HeroPopularity, upsert
+from prefetch import prefetcher
+
+logger = logging.getLogger(__name__)
+
+# Heroes stored per hero
+PER_HERO = 10
+
+# Fewest shared fans for a pair to count, so one user's odd pair isn't a trend
+MIN_TOGETHER = 2
+
+# Users multiplied at once when rebuilding; bounds memory to about
+# BLOCK_USERS x heroes x 4 bytes
+BLOCK_USERS = 4096
+
+# Rows written per statement when rebuilding
+WRITE_BATCH = 10000
+
+
+def sparse_favorites(user_ids, hero_ids):
+    """The user x hero favorites matrix in compressed sparse row form.
+
+    Takes parallel arrays of favorites and returns (heroes, indptr,
+    columns): heroes maps column numbers to hero ids, and user i's
+    favorites are columns[indptr[i]:indptr[i + 1]].
+    """
+
+    # numpy is imported where it's used, so only processes that rebuild load it
+    import numpy as np
+
+    heroes, columns = np.unique(np.asarray(hero_ids), return_inverse=True)
+    users, rows = np.unique(np.asarray(user_ids), return_inverse=True)
+
+    order = np.argsort(rows, kind="stable")
+    indptr = np.searchsorted(rows[order], np.arange(len(users) + 1))
+
+    return heroes, indptr, columns[order].astype(np.int32)
+
+
+def co_favorite_counts(heroes, indptr, columns, block_users=BLOCK_USERS):
+    """hero x hero matrix of how many users favorited both (diagonal: fans of each)"""
+
+    import numpy as np
+
+    count = len(heroes)
+    counts = np.zeros((count, count), dtype=np.float32)
+
+    for start in range(0, len(indptr) - 1, block_users):
+        stop = min(start + block_users, len(indptr) - 1)
+        lo, hi = indptr[start], indptr[stop]
+
+        # This block of users as a dense 0/1 matrix; A.T @ A counts the
+        # users in the block who favorited both of each pair
+        block = np.zeros((stop - start, count), dtype=np.float32)
+        row_of = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+        block[row_of, columns[lo:hi]] = 1
+        counts += block.T @ block
+
+    # float32 counts are exact up to 16M users per pair
+    return counts.astype(np.int32)
+
+
+def top_similar(counts, per_hero=PER_HERO, min_together=MIN_TOGETHER):
+    """(columns, scores) of each hero's per_hero most similar heroes, best first.
+
+    Both are heroes x per_hero arrays; columns is -1 where a hero has
+    fewer than per_hero heroes sharing min_together fans.
+    """
+
+    import numpy as np
+
+    fans = np.diag(counts).astype(np.float32)
+    together = counts.astype(np.float32)
+    np.fill_diagonal(together, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = together / np.sqrt(np.outer(fans, fans))
+    scores[together < min_together] = 0
+    scores = np.nan_to_num(scores)
+
+    count = len(counts)
+    per_hero = min(per_hero, max(count - 1, 0))
+    if not per_hero:
+        return np.zeros((count, 0), dtype=np.int64), np.zeros((count, 0), dtype=np.float32)
+
+    # Each row's best per_hero in one pass, then sort just those (ties by
+    # more shared fans, then by column)
+    best = np.argpartition(-scores, per_hero - 1, axis=1)[:, :per_hero]
+    rows = np.arange(count)[:, None]
+    order = np.lexsort((best, -together[rows, best], -scores[rows, best]), axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+    best_scores = scores[rows, best]
+
+    best[best_scores <= 0] = -1
+    return best, best_scores
+
+
+def _load_favorites():
+    """(user_ids, hero_ids) arrays of every favorite"""
+
+    import numpy as np
+
+    # Streamed in chunks so a million favorites never exist as Python tuples at once
+    query = (db.select(Favorites.user_id, Favorites.hero_id)
+             .where(Favorites.user_id.is_not(None), Favorites.hero_id.is_not(None))
+             .execution_options(yield_per=WRITE_BATCH))
+    # (numpy probes Row objects for the array protocol one by one; plain
+    # tuples convert about 30x faster)
+    chunks = [np.array([tuple(row) for row in chunk], dtype=np.int64)
+              for chunk in db.session.execute(query).partitions()]
+
+    favorites = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64)
+    return favorites[:, 0], favorites[:, 1]
+
+
+def _write(table, rows):
+    # Core inserts on the table skip the ORM's per-row bulk insert bookkeeping
+    for start in range(0, len(rows), WRITE_BATCH):
+        db.session.execute(db.insert(table), rows[start:start + WRITE_BATCH])
+
+
+def _staging_table():
+    """An empty copy of co_favorites to rebuild into"""
+
+    table = CoFavorite.__table__.to_metadata(
+        db.MetaData(), name=f"{CoFavorite.__tablename__}_staging")
+
+    connection = db.session.connection()
+    table.drop(connection, checkfirst=True)
+    table.create(connection)
+
+    return table
+
+
+def _swap_in(staging):
+    """Replace co_favorites with the staging table, holding its lock only briefly"""
+
+    live = CoFavorite.__tablename__
+    old = f"{live}_old"
+
+    db.session.execute(db.text(f"DROP TABLE IF EXISTS {old}"))
+    db.session.execute(db.text(f"ALTER TABLE {live} RENAME TO {old}"))
+    db.session.execute(db.text(f"ALTER TABLE {staging.name} RENAME TO {live}"))
+    db.session.execute(db.text(f"DROP TABLE {old}"))
+
+    # Postgres keeps the staging table's primary key index name; give it
+    # back the live name so the next rebuild's staging table can be created
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(db.text(
+            f"ALTER INDEX IF EXISTS {staging.name}_pkey RENAME TO {live}_pkey"))
+
+
+def rebuild(per_hero=PER_HERO, min_together=MIN_TOGETHER):
+    """Recount co-favorites and every hero's recommendations from scratch.
+
+    Counts are written to a staging table in their own transaction and
+    then swapped in, so favoriting isn't held up waiting for the rewrite.
+    Returns a dict of what was done and how long it took. Favorites
+    toggled while this runs can be miscounted; the next run fixes them.
+    """
+
+    import numpy as np
+
+    start = time.perf_counter()
+    user_ids, hero_ids = _load_favorites()
+    loaded = time.perf_counter()
+
+    heroes, indptr, columns = sparse_favorites(user_ids, hero_ids)
+    counts = co_favorite_counts(heroes, indptr, columns)
+    best, scores = top_similar(counts, per_hero, min_together)
+    computed = time.perf_counter()
+
+    np.fill_diagonal(counts, 0)
+    rows, others = np.nonzero(counts)
+    pairs = [{"hero_id": hero_id, "other_id": other_id, "together": together}
+             for hero_id, other_id, together
+             in zip(heroes[rows].tolist(), heroes[others].tolist(), counts[rows, others].tolist())]
+
+    recommendations = [
+        {"hero_id": int(heroes[h]), "rank": rank, "other_id": int(heroes[column]),
+         "score": round(float(score), 4)}
+        for h in range(len(heroes))
+        for rank, (column, score) in enumerate(zip(best[h], scores[h])) if column >= 0]
+
+    staging = _staging_table()
+    _write(staging, pairs)
+    db.session.commit()
+
+    _swap_in(staging)
+    db.session.execute(db.delete(HeroRecommendation))
+    _write(HeroRecommendation.__table__, recommendations)
+    db.session.commit()
+
+    return {
+        "favorites": len(user_ids),
+        "heroes": len(heroes),
+        "pairs": len(pairs),
+        "recommendations": len(recommendations),
+        "load_seconds": round(loaded - start, 3),
+        "compute_seconds": round(computed - loaded, 3),
+        "write_seconds": round(time.perf_counter() - computed, 3),
+    }
+
+
+def refresh(hero_ids, per_hero=PER_HERO, min_together=MIN_TOGETHER):
+    """Re-rank the stored lists of hero_ids from the current co_favorites counts"""
+
+    hero_ids = sorted(set(hero_ids))
+    if not hero_ids:
+        return
+
+    pairs = db.session.execute(
+        db.select(CoFavorite.hero_id, CoFavorite.other_id, CoFavorite.together)
+        .where(CoFavorite.hero_id.in_(hero_ids), CoFavorite.together >= min_together)).all()
+
+    involved = set(hero_ids) | {other_id for _, other_id, _ in pairs}
+    fans = dict(db.session.execute(
+        db.select(HeroPopularity.hero_id, HeroPopularity.favorites)
+        .where(HeroPopularity.hero_id.in_(involved))).all())
+
+    candidates = {hero_id: [] for hero_id in hero_ids}
+    for hero_id, other_id, together in pairs:
+        denominator = math.sqrt(fans.get(hero_id, 0) * fans.get(other_id, 0))
+        if denominator:
+            candidates[hero_id].append((together / denominator, together, -other_id))
+
+    rows = [{"hero_id": hero_id, "rank": rank, "other_id": -negative_id,
+             "score": round(score, 4)}
+            for hero_id, scored in candidates.items()
+            for rank, (score, _, negative_id) in enumerate(heapq.nlargest(per_hero, scored))]
+
+    # Upserted rank by rank rather than deleted and re-inserted, so two
+    # refreshes of the same hero at once wait on each other's rows instead
+    # of both inserting the same (hero_id, rank)
+    upsert(HeroRecommendation, rows, ["hero_id", "rank"], ["other_id", "score"])
+
+    # Then drop ranks past the end of each new list
+    by_length = {}
+    for hero_id, scored in candidates.items():
+        by_length.setdefault(min(len(scored), per_hero), []).append(hero_id)
+    for length, ids in sorted(by_length.items()):
+        db.session.execute(db.delete(HeroRecommendation)
+                           .where(HeroRecommendation.hero_id.in_(ids),
+                                  HeroRecommendation.rank >= length))
+
+
+def _refresh_job(hero_ids):
+    refresh(hero_ids)
+    db.session.commit()
+
+
+def favorites_changed(user_id, hero_ids):
+    """Re-rank after user's (un)favoriting of hero_ids has been committed.
+
+    The changed heroes' own lists are refreshed now. Every other favorite
+    of the user's had its counts change too; those are refreshed in the
+    background, or at the next rebuild if the background queue is full.
+
+    The favorites are already saved, so a failure here is logged and left
+    for the next refresh or rebuild rather than failing the request.
+    """
+
+    hero_ids = set(hero_ids)
+
+    try:
+        _refresh_job(hero_ids)
+        others = set(db.session.scalars(
+            db.select(Favorites.hero_id).where(Favorites.user_id == user_id))) - hero_ids
+    except Exception:
+        db.session.rollback()
+        logger.exception("refreshing recommendations for %r failed", sorted(hero_ids))
+        return
+
+    if others:
+        prefetcher.submit(current_app._get_current_object(), _refresh_job, sorted(others))
+
+
+def recommended_for_hero(hero_id, limit=PER_HERO):
+    """[(hero_id, score)] of heroes most often favorited with hero_id"""
+
+    return [tuple(row) for row in db.session.execute(
+        db.select(HeroRecommendation.other_id, HeroRecommendation.score)
+        .where(HeroRecommendation.hero_id == hero_id)
+        .order_by(HeroRecommendation.rank)
+        .limit(limit))]
+
+
+def recommended_for_user(favorite_ids, limit=PER_HERO):
+    """Hero ids to suggest to a user with favorite_ids, best first.
+
+    Adds up each candidate's scores from the lists of all the user's
+    favorites, leaving out heroes they've already favorited.
+    """
+
+    favorite_ids = set(favorite_ids)
+    if not favorite_ids:
+        return []
+
+    totals = {}
+    for other_id, score in db.session.execute(
+            db.select(HeroRecommendation.other_id, HeroRecommendation.score)
+            .where(HeroRecommendation.hero_id.in_(favorite_ids))):
+        if other_id not in favorite_ids:
+            totals[other_id] = totals.get(other_id, 0) + score
+
+    return [hero_id for hero_id, _ in
+            heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1], item[0]))]
+
+
+############################################################################
+# CLI commands, registered on the app as `flask recommendations ...`
+
+recommendations_cli = AppGroup("recommendations", help="Manage co-favorite recommendations.")
+
+
+@recommendations_cli.command("rebuild")
+def rebuild_command():
+    """Recount co-favorites and rebuild every hero's recommendations."""
+
+    db.create_all()
+    stats = rebuild()
+    click.echo(f"Rebuilt {stats['recommendations']} recommendations for {stats['heroes']} heroes "
+               f"from {stats['favorites']} favorites ({stats['pairs']} co-favorite pairs) in "
+               f"{stats['load_seconds'] + stats['compute_seconds'] + stats['write_seconds']:.2f}s")
@@ -0,0 +1,78 @@
+"""Bring an existing database up to the current models
+
+`db.create_all()` only creates missing tables, so a database from before
+these models needs a few more steps: duplicate favorites removed so the
+unique (user_id, hero_id) index can be built (favoriting relies on it for
+ON CONFLICT), and the counter tables filled from the favorites already
+there. Run it once before deploying, with the app stopped:
+
+    flask schema upgrade
+
+It's safe to run again.
+"""
+
+import click
+from flask.cli import AppGroup
+
+from models import db, Favorites
+from popularity import reconcile
+from ratings import reaggregate
+from recommendations import rebuild
+
+
+def remove_duplicate_favorites():
+    """Delete repeat favorites of a hero by the same user.
+
+    Keeps one row per (user, hero): the first one with a rating, or else
+    the first one. Returns the number of rows deleted.
+    """
+
+    pairs = db.session.execute(
+        db.select(Favorites.user_id, Favorites.hero_id)
+        .group_by(Favorites.user_id, Favorites.hero_id)
+        .having(db.func.count() > 1)).all()
+
+    removed = 0
+
+    for user_id, hero_id in pairs:
+        ids = db.session.scalars(
+            db.select(Favorites.id)
+            .where(Favorites.user_id == user_id, Favorites.hero_id == hero_id)
+            .order_by(Favorites.rating.is_(None), Favorites.id)).all()
+
+        db.session.execute(db.delete(Favorites).where(Favorites.id.in_(ids[1:])))
+        removed += len(ids) - 1
+
+    db.session.commit()
+    return removed
+
+
+def create_favorites_index():
+    """Build the unique (user_id, hero_id) index if it isn't there yet"""
+
+    index, = (index for index in Favorites.__table__.indexes
+              if index.name == "ix_favorites_user_hero")
+    index.create(db.engine, checkfirst=True)
+
+
+############################################################################
+# CLI commands, registered on the app as `flask schema ...`
+
+schema_cli = AppGroup("schema", help="Manage the database schema.")
+
+
+@schema_cli.command("upgrade")
+def upgrade_command():
+    """Create new tables and indexes and fill the counter tables."""
+
+    db.create_all()
+    click.echo("Created any missing tables")
+
+    click.echo(f"Removed {remove_duplicate_favorites()} duplicate favorites")
+    create_favorites_index()
+    click.echo("Created the unique favorites index")
+
+    click.echo(f"Corrected {reconcile()} hero counters")
+    click.echo(f"Corrected {reaggregate()} hero rating totals")
+    stats = rebuild()
+    click.echo(f"Rebuilt {stats['recommendations']} recommendations for {stats['heroes']} heroes")
@@ -0,0 +1,222 @@
+"""In-memory hero search
+
+An inverted index from word -> heroes, built from the local catalog the
+first time it's searched. Every SYNC_INTERVAL seconds it picks up catalog
+rows added or refreshed since the last sync, so typeahead never queries
+the database (or the API) per keystroke. Each sync re-reads the last
+SYNC_OVERLAP seconds before the newest row it has seen, since a row can
+commit after a row with a later timestamp, and rebuilds from scratch if
+the hero count still doesn't match the catalog's.
+
+Every word of the query has to match a word in one of the indexed fields,
+either exactly or as a prefix. Matches in the name rank above aliases,
+which rank above occupation, place of birth and first appearance.
+"""
+
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from models import db, Hero
+
+SYNC_INTERVAL = int(os.environ.get('SEARCH_SYNC_INTERVAL', 60))
+
+# How far back before the newest indexed row each sync looks again; should
+# be longer than any catalog write transaction takes to commit
+SYNC_OVERLAP = int(os.environ.get('SEARCH_SYNC_OVERLAP', 300))
+
+# How much a match in each field counts towards a hero's rank
+FIELD_WEIGHTS = {
+    "name": 10,
+    "aliases": 5,
+    "job": 2,
+    "birth_place": 1,
+    "first_appear": 1,
+}
+
+# Prefix matches count for less than whole words
+PREFIX_FACTOR = 0.5
+
+# Bonus for heroes whose name starts with the whole query
+NAME_PREFIX_BONUS = 20
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase words in text"""
+
+    return WORD_RE.findall(text.lower()) if text else []
+
+
+class HeroIndex:
+    """Inverted index of heroes by the words in their fields"""
+
+    def __init__(self):
+        self.postings = {}       # word -> {hero_id: weight}
+        self.words = []          # sorted postings keys, for prefix lookups
+        self.heroes = {}         # hero_id -> {"id", "name", "image"}
+        self.hero_words = {}     # hero_id -> words indexed for it
+        self.synced_to = None    # newest Hero.updated_at indexed
+        self.checked_at = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heroes)
+
+    def _remove(self, hero_id):
+        for word in self.hero_words.pop(hero_id, ()):
+            posting = self.postings[word]
+            posting.pop(hero_id, None)
+
+            if not posting:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+
+    def add(self, hero_id, name, aliases, job, birth_place, first_appear, image):
+        """Index (or re-index) one hero"""
+
+        weights = {}
+        fields = {"name": name, "aliases": " ".join(aliases or []), "job": job,
+                  "birth_place": birth_place, "first_appear": first_appear}
+
+        for field, text in fields.items():
+            for word in tokenize(text):
+                weights[word] = max(weights.get(word, 0), FIELD_WEIGHTS[field])
+
+        with self._lock:
+            self._remove(hero_id)
+
+            for word, weight in weights.items():
+                if word not in self.postings:
+                    self.postings[word] = {}
+                    insort(self.words, word)
+                self.postings[word][hero_id] = weight
+
+            self.hero_words[hero_id] = set(weights)
+            self.heroes[hero_id] = {"id": hero_id, "name": name, "image": image}
+
+    def _match(self, term):
+        """Scores of heroes with a word equal to or starting with term"""
+
+        scores = {}
+        i = bisect_left(self.words, term)
+
+        while i < len(self.words) and self.words[i].startswith(term):
+            word = self.words[i]
+            factor = 1 if word == term else PREFIX_FACTOR
+
+            for hero_id, weight in self.postings[word].items():
+                scores[hero_id] = max(scores.get(hero_id, 0), weight * factor)
+
+            i += 1
+
+        return scores
+
+    def search(self, query, limit=10):
+        """Best matching heroes for query, as dicts with id, name and image"""
+
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        with self._lock:
+            scores = None
+
+            # Every term has to match, so narrow the candidates term by term
+            for term in terms:
+                matches = self._match(term)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {hero_id: score + matches[hero_id]
+                              for hero_id, score in scores.items() if hero_id in matches}
+                if not scores:
+                    return []
+
+            phrase = " ".join(terms)
+            results = []
+            for hero_id, score in scores.items():
+                hero = self.heroes[hero_id]
+                if " ".join(tokenize(hero["name"])).startswith(phrase):
+                    score += NAME_PREFIX_BONUS
+                results.append((-score, hero["name"], hero))
+
+        results.sort(key=lambda result: result[:2])
+        return [hero for _, _, hero in results[:limit]]
+
+    def _index_rows(self, since):
+        query = db.select(Hero.id, Hero.name, Hero.aliases, Hero.job, Hero.birth_place,
+                          Hero.first_appear, Hero.image, Hero.updated_at)
+        if since is not None:
+            query = query.where(Hero.updated_at >= since)
+
+        count = 0
+        for row in db.session.execute(query):
+            self.add(row.id, row.name, row.aliases, row.job, row.birth_place,
+                     row.first_appear, row.image)
+            if self.synced_to is None or row.updated_at > self.synced_to:
+                self.synced_to = row.updated_at
+            count += 1
+
+        return count
+
+    def sync(self):
+        """Index catalog rows added or refreshed since the last sync (with overlap)"""
+
+        with self._sync_lock:
+            return self._sync()
+
+    def _sync(self):
+        since = None
+        if self.synced_to is not None:
+            since = self.synced_to - timedelta(seconds=SYNC_OVERLAP)
+        count = self._index_rows(since)
+
+        # A row that committed later than the overlap allows still shows up
+        # as a missing hero, so fall back to reading everything
+        if since is not None and len(self) != db.session.scalar(
+                db.select(db.func.count(Hero.id))):
+            count += self._index_rows(None)
+
+        self.checked_at = time.monotonic()
+        return count
+
+    def _stale(self):
+        return self.checked_at is None or time.monotonic() - self.checked_at >= SYNC_INTERVAL
+
+    def ensure_fresh(self):
+        """Build the index on first use, then sync at most every SYNC_INTERVAL.
+
+        Requests that arrive while the first build is running wait for it
+        rather than each building their own; once built, a sync already in
+        progress is left to finish while searches use the index as it is.
+        """
+
+        if not self._stale():
+            return
+
+        if not self._sync_lock.acquire(blocking=self.checked_at is None):
+            return
+
+        try:
+            # Someone else may have synced while we waited for the lock
+            if self._stale():
+                self._sync()
+        finally:
+            self._sync_lock.release()
+
+
+# Index shared by every request in this worker
+hero_index = HeroIndex()
+
+
+def search_heroes(query, limit=10):
+    """Search the catalog for heroes matching query"""
+
+    hero_index.ensure_fresh()
+    return hero_index.search(query, limit)
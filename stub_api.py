@@ -0,0 +1,160 @@
+"""Local stand-in for superheroapi.com
+
+Serves the same JSON shape as the real API for ids 1..max_id, with
+optional added latency and injected errors. Used by tests and benchmarks.
+
+Run it like:
+
+    python3 stub_api.py --port 5001 --latency 0.05 --error-rate 0.01
+
+then point the app at it with SUPERHERO_API_URL=http://127.0.0.1:5001/api
+(and any SUPERHERO_API_KEY; the stub ignores it)
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A few real heroes so pages and tests show familiar names
+KNOWN_HEROES = {
+    30: "Ant Man",
+    107: "Black Widow",
+    149: "Captain America",
+    213: "Deadpool",
+    303: "Groot",
+    332: "Hulk",
+    346: "Iron Man",
+    489: "Nick Fury",
+}
+
+
+def make_hero(hero_id):
+    """Build superhero JSON the same shape as the real API"""
+
+    name = KNOWN_HEROES.get(hero_id, f"Hero {hero_id}")
+
+    return {
+        "response": "success",
+        "id": str(hero_id),
+        "name": name,
+        "powerstats": {
+            stat: str((hero_id * (i + 7)) % 101)
+            for i, stat in enumerate(
+                ("intelligence", "strength", "speed", "durability", "power", "combat"))
+        },
+        "biography": {
+            "full-name": name,
+            "alter-egos": "No alter egos found.",
+            "aliases": [f"{name} alias"],
+            "place-of-birth": f"Planet {hero_id % 17}",
+            "first-appearance": f"Comic #{hero_id}",
+            "publisher": "Marvel Comics",
+            "alignment": "good",
+        },
+        "appearance": {"gender": "-", "race": "-"},
+        "work": {"occupation": f"Occupation {hero_id % 11}", "base": "-"},
+        "connections": {"group-affiliation": "-", "relatives": "-"},
+        "image": {"url": f"https://www.superherodb.com/pictures2/portraits/10/100/{hero_id}.jpg"},
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Handles /api/<key>/<hero_id>"""
+
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.request_count += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_response(502)
+            self.end_headers()
+            return
+
+        parts = self.path.strip("/").split("/")
+
+        try:
+            hero_id = int(parts[-1])
+        except ValueError:
+            hero_id = 0
+
+        if 1 <= hero_id <= server.max_id:
+            body = make_hero(hero_id)
+        else:
+            body = {"response": "error", "error": "invalid id"}
+
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Keep test and benchmark output quiet
+        pass
+
+
+class StubServer:
+    """Runs the stub API on a background thread.
+
+    Use as a context manager:
+
+        with StubServer(latency=0.01) as stub:
+            client = SuperheroClient(api_key="stub", base_url=stub.url)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, max_id=731):
+        self.httpd = ThreadingHTTPServer((host, port), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.error_rate = error_rate
+        self.httpd.max_id = max_id
+        self.httpd.request_count = 0
+        self.httpd.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    @property
+    def request_count(self):
+        return self.httpd.request_count
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that get a 502")
+    parser.add_argument("--max-id", type=int, default=731)
+    args = parser.parse_args()
+
+    stub = StubServer(args.host, args.port, args.latency, args.error_rate, args.max_id)
+    print(f"Stub superhero API on {stub.url}")
+    stub.httpd.serve_forever()
@@ -0,0 +1,445 @@
+"""API request tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_api_requests.py
+
+import asyncio
+import fcntl
+import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+import api_requests
+from api_requests import (get_many, get_many_async, HeroNotFound, Superhero, SuperheroClient,
+                          CircuitBreaker, SingleFlight, UpstreamUnavailable)
+from hero_cache import CacheEntry, HeroCache, SQLiteTier, NOT_FOUND
+from stub_api import StubServer, make_hero
+
+
+def fake_get_request(hero_id):
+    """Stand-in for get_request: 1 is slow, 2 doesn't exist"""
+
+    if hero_id == 1:
+        time.sleep(0.5)
+    if hero_id == 2:
+        raise HeroNotFound(hero_id)
+    return hero_id * 10
+
+
+class SuperheroTestCase(TestCase):
+    """Tests for the Superhero record"""
+
+    def test_from_json(self):
+        """Only the fields the app uses are kept"""
+
+        hero = Superhero.from_json(make_hero(303))
+
+        self.assertEqual(hero.id, 303)
+        self.assertEqual(hero.name, "Groot")
+        self.assertIsInstance(hero.aliases, tuple)
+        self.assertFalse(hasattr(hero, "__dict__"))
+        self.assertEqual(pickle.loads(pickle.dumps(hero)), hero)
+
+        with self.assertRaises(AttributeError):
+            hero.name = "Not Groot"
+
+
+class GetManyTestCase(TestCase):
+    """Tests for fetching several heroes at once"""
+
+    @patch.object(api_requests, "get_request", fake_get_request)
+    def test_keeps_input_order(self):
+        """Results line up with the ids that were asked for"""
+
+        self.assertEqual(get_many([5, 3, 4]), [50, 30, 40])
+
+    @patch.object(api_requests, "get_request", fake_get_request)
+    def test_partial_results(self):
+        """Slow and missing heroes come back as None instead of failing"""
+
+        self.assertEqual(get_many([3, 1, 2, 4], timeout=0.1), [30, None, None, 40])
+
+
+class SuperheroClientTestCase(TestCase):
+    """Tests for the API client against the local stub server"""
+
+    def test_fetch(self):
+        """Client returns hero JSON from the stub"""
+
+        with StubServer() as stub:
+            client = SuperheroClient(api_key="test", base_url=stub.url)
+            data = client.fetch(303)
+
+        self.assertEqual(data["name"], "Groot")
+
+    def test_unknown_id(self):
+        """Unknown ids come back as NOT_FOUND"""
+
+        with StubServer() as stub:
+            client = SuperheroClient(api_key="test", base_url=stub.url)
+            self.assertIs(client.fetch(99999), NOT_FOUND)
+
+    def test_retries_then_fails(self):
+        """Server errors are retried, then reported as UpstreamUnavailable"""
+
+        with StubServer(error_rate=1.0) as stub:
+            client = SuperheroClient(api_key="test", base_url=stub.url, retries=2, backoff=0)
+
+            with self.assertRaises(UpstreamUnavailable):
+                client.fetch(303)
+
+            self.assertEqual(stub.request_count, 3)
+
+    def test_timeout(self):
+        """A hung upstream doesn't hold the request past the read timeout"""
+
+        with StubServer(latency=1.0) as stub:
+            client = SuperheroClient(api_key="test", base_url=stub.url,
+                                     read_timeout=0.1, retries=0)
+            start = time.monotonic()
+
+            with self.assertRaises(UpstreamUnavailable):
+                client.fetch(303)
+
+            self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_circuit_breaker(self):
+        """Once the breaker opens, calls fail fast without hitting the API"""
+
+        with StubServer(error_rate=1.0) as stub:
+            breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+            client = SuperheroClient(api_key="test", base_url=stub.url, retries=0,
+                                     breaker=breaker)
+
+            for _ in range(2):
+                with self.assertRaises(UpstreamUnavailable):
+                    client.fetch(303)
+
+            self.assertEqual(breaker.state, "open")
+
+            with self.assertRaises(UpstreamUnavailable):
+                client.fetch(303)
+
+            self.assertEqual(stub.request_count, 2)
+
+
+class SingleFlightTestCase(TestCase):
+    """Tests for collapsing concurrent loads of the same key"""
+
+    def setUp(self):
+        self.calls = 0
+
+    def slow_load(self, value=None, error=None, seconds=0.2):
+        """Return a loader that counts calls, sleeps, then returns or raises"""
+
+        def load():
+            self.calls += 1
+            time.sleep(seconds)
+            if error is not None:
+                raise error
+            return value
+        return load
+
+    def run_concurrently(self, flight, load, count=8):
+        """Call flight.do(303, load) from count threads; returns results or exceptions"""
+
+        def call():
+            try:
+                return flight.do(303, load)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            futures = [pool.submit(call) for _ in range(count)]
+            return [future.result() for future in futures]
+
+    def test_concurrent_calls_share_one_load(self):
+        """Callers that arrive while a load is running get its result"""
+
+        flight = SingleFlight()
+        results = self.run_concurrently(flight, self.slow_load({"name": "Groot"}))
+
+        self.assertEqual(results, [{"name": "Groot"}] * 8)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(flight.stats()["collapsed"], 7)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_error_reaches_every_waiter(self):
+        """A failed load fails every caller waiting on it, without retrying"""
+
+        flight = SingleFlight()
+        error = UpstreamUnavailable("down")
+        results = self.run_concurrently(flight, self.slow_load(error=error))
+
+        self.assertTrue(all(result is error for result in results))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(flight.stats()["shared_errors"], 7)
+
+        # The failure isn't remembered; the next call loads again
+        self.assertEqual(flight.do(303, self.slow_load("ok", seconds=0)), "ok")
+
+    def test_wait_timeout(self):
+        """Waiters give up after the timeout; the leader carries on"""
+
+        flight = SingleFlight(timeout=0.1)
+        results = self.run_concurrently(flight, self.slow_load("slow", seconds=0.5), count=3)
+
+        self.assertEqual(results.count("slow"), 1)
+        self.assertEqual(sum(isinstance(result, UpstreamUnavailable) for result in results), 2)
+        self.assertEqual(flight.stats()["timeouts"], 2)
+
+    def test_cancelled_async_leader(self):
+        """Waiters on a cancelled async load get UpstreamUnavailable, not CancelledError"""
+
+        flight = SingleFlight()
+        started = threading.Event()
+
+        async def load():
+            started.set()
+            await asyncio.sleep(10)
+
+        async def lead():
+            task = asyncio.create_task(flight.do_async(303, load))
+            await asyncio.to_thread(started.wait)
+            waiters = asyncio.create_task(asyncio.to_thread(self.run_concurrently, flight, load, 2))
+            await asyncio.sleep(0.05)
+            task.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return await waiters
+
+        results = asyncio.run(lead())
+
+        self.assertTrue(all(isinstance(result, UpstreamUnavailable) for result in results))
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_lease_rechecks_cache(self):
+        """Leaders in other processes wait for the lease, then re-check the cache"""
+
+        cached = {}
+
+        def load():
+            self.calls += 1
+            time.sleep(0.2)
+            cached["value"] = "Groot"
+            return "Groot"
+
+        def recheck():
+            return CacheEntry("Groot", 0, 0) if cached else None
+
+        with tempfile.TemporaryDirectory() as lease_dir:
+            # Two SingleFlights stand in for two workers sharing lease_dir
+            first, second = SingleFlight(lease_dir=lease_dir), SingleFlight(lease_dir=lease_dir)
+            leader = threading.Thread(target=first.do, args=(303, load))
+            leader.start()
+            time.sleep(0.05)
+
+            self.assertEqual(second.do(303, load, recheck=recheck), "Groot")
+            leader.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.stats()["lease_waits"], 1)
+        self.assertEqual(second.stats()["lease_hits"], 1)
+
+    def test_get_hero_data_caches_inside_lease(self):
+        """The value is cached before the lease is released, not after"""
+
+        real_set = api_requests.hero_cache.set
+        api_requests.hero_cache.clear()
+        lease_held = []
+
+        def set_and_check(key, value):
+            lock_path = os.path.join(lease_dir, "303.lock")
+            with open(lock_path, "a") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    lease_held.append(False)
+                except BlockingIOError:
+                    lease_held.append(True)
+            return real_set(key, value)
+
+        try:
+            with tempfile.TemporaryDirectory() as lease_dir, \
+                    patch.object(api_requests, "single_flight",
+                                 SingleFlight(lease_dir=lease_dir)), \
+                    patch.object(api_requests.hero_cache, "set", side_effect=set_and_check), \
+                    patch.object(api_requests, "fetch_hero_data", return_value=make_hero(303)):
+                self.assertEqual(api_requests.get_hero_data(303)["name"], "Groot")
+
+            self.assertEqual(lease_held, [True])
+            self.assertIsNotNone(api_requests.hero_cache.peek(303))
+        finally:
+            api_requests.hero_cache.clear()
+
+    def two_workers(self, tmp, local, shared):
+        """Two workers' get_hero_data, each with its own cache and SingleFlight.
+
+        They share a cache file and lease directory. Both start with the
+        local entry `local`, and the shared tier holds `shared`. Returns
+        (first, second, first cache, second cache, shared tier).
+        """
+
+        tier = SQLiteTier(os.path.join(tmp, "cache.db"))
+        tier.set("303", shared)
+
+        def worker():
+            cache = HeroCache(shared=tier)
+            cache._store_local("303", local)
+            flight = SingleFlight(lease_dir=tmp)
+
+            def load():
+                self.calls += 1
+                time.sleep(0.2)
+                return cache.set(303, f"v{self.calls + 1}").value
+
+            def get():
+                return cache.get_or_load(303, lambda: flight.do(
+                    303, load, recheck=lambda: cache.peek(303)), store=False)
+            get.flight = flight
+            return get, cache
+
+        (first, first_cache), (second, second_cache) = worker(), worker()
+        return first, second, first_cache, second_cache, tier
+
+    def test_lease_collapses_expired_entries(self):
+        """After the lease, a worker whose copy expired takes the other's reload"""
+
+        old = CacheEntry("v1", 0, 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            first, second, _, _, _ = self.two_workers(tmp, old, old)
+
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                leader = pool.submit(first)
+                time.sleep(0.05)
+                self.assertEqual(second(), "v2")
+                self.assertEqual(leader.result(), "v2")
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.flight.stats()["lease_waits"], 1)
+        self.assertEqual(second.flight.stats()["lease_hits"], 1)
+
+    def test_lease_doesnt_write_back_stale_entries(self):
+        """A worker refreshing a stale copy doesn't count it as the other's reload"""
+
+        old = CacheEntry("v1", 0, time.time() + 60)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            first, second, first_cache, second_cache, tier = self.two_workers(tmp, old, old)
+
+            # Both serve v1 right away and refresh in the background
+            self.assertEqual(first(), "v1")
+            time.sleep(0.05)
+            self.assertEqual(second(), "v1")
+
+            for _ in range(100):
+                if first_cache.stats()["refreshes"] and second_cache.stats()["refreshes"]:
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual(self.calls, 1)
+            self.assertEqual(second.flight.stats()["lease_hits"], 1)
+            self.assertEqual(tier.get("303").value, "v2")
+            self.assertEqual(second_cache.peek(303).value, "v2")
+
+    def test_get_hero_data_collapses_upstream_calls(self):
+        """Concurrent cache misses for one hero make one API request"""
+
+        real_client = api_requests.client
+        api_requests.hero_cache.clear()
+
+        try:
+            with StubServer(latency=0.2) as stub:
+                api_requests.set_client(SuperheroClient(api_key="test", base_url=stub.url))
+
+                with ThreadPoolExecutor(max_workers=6) as pool:
+                    names = list(pool.map(lambda _: api_requests.get_request(303).name, range(6)))
+
+                self.assertEqual(names, ["Groot"] * 6)
+                self.assertEqual(stub.request_count, 1)
+        finally:
+            api_requests.set_client(real_client)
+            api_requests.hero_cache.clear()
+
+
+    def test_breaker_trial_settled_by_any_error(self):
+        """A half-open trial that fails in an unexpected way doesn't block the breaker"""
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        client = SuperheroClient(api_key="test", base_url="http://unused", breaker=breaker)
+
+        for error in (requests.exceptions.ChunkedEncodingError("cut off"),
+                      asyncio.CancelledError()):
+            with patch.object(client, "_fetch_with_retries", side_effect=error):
+                with self.assertRaises(type(error)):
+                    client.fetch(303)
+
+            # The next call gets its own trial
+            self.assertTrue(breaker.allow())
+            breaker.release_trial()
+
+    def test_non_object_response(self):
+        """A JSON body that isn't an object is a failed call, not a crash"""
+
+        with patch.object(requests.Session, "get") as get:
+            get.return_value.status_code = 200
+            get.return_value.json.return_value = ["not", "a", "hero"]
+            client = SuperheroClient(api_key="test", base_url="http://unused", retries=0)
+
+            with self.assertRaises(UpstreamUnavailable):
+                client.fetch(303)
+
+        self.assertEqual(client.breaker.failures, 1)
+
+    def test_error_responses(self):
+        """Only the unknown-id error means not found; other errors are failed calls"""
+
+        with patch.object(requests.Session, "get") as get:
+            get.return_value.status_code = 200
+            client = SuperheroClient(api_key="test", base_url="http://unused", retries=0)
+
+            get.return_value.json.return_value = {"response": "error", "error": "invalid id"}
+            self.assertIs(client.fetch(9999), NOT_FOUND)
+            self.assertEqual(client.breaker.failures, 0)
+
+            for error in ("access denied", "rate limit exceeded"):
+                get.return_value.json.return_value = {"response": "error", "error": error}
+                with self.assertRaises(UpstreamUnavailable):
+                    client.fetch(303)
+
+        self.assertEqual(client.breaker.failures, 2)
+
+
+class GetManyAsyncTestCase(TestCase):
+    """Tests for fetching several heroes at once on an event loop"""
+
+    def setUp(self):
+        self.real_client = api_requests.client
+        api_requests.hero_cache.clear()
+
+    def tearDown(self):
+        api_requests.set_client(self.real_client)
+
+    def test_overlapping_fetches(self):
+        """Fetches overlap, so the batch takes about one round-trip"""
+
+        with StubServer(latency=0.2, max_id=50) as stub:
+            api_requests.set_client(SuperheroClient(api_key="test", base_url=stub.url))
+
+            start = time.monotonic()
+            heroes = asyncio.run(get_many_async([10, 11, 12, 13, 9999]))
+
+            self.assertLess(time.monotonic() - start, 0.6)
+
+        self.assertEqual([hero.name if hero else None for hero in heroes],
+                         ["Hero 10", "Hero 11", "Hero 12", "Hero 13", None])
@@ -0,0 +1,104 @@
+"""Hero catalog tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_catalog.py
+
+import os
+import asyncio
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import api_requests
+from app import create_app
+from models import db, Hero
+from api_requests import SuperheroClient, HeroNotFound
+from catalog import (ingest, get_hero, get_heroes, get_hero_async, get_heroes_async, save_heroes,
+                     stale_hero_ids)
+from stub_api import StubServer, make_hero
+
+# Use test database and don't clutter tests with SQL
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'SQLALCHEMY_ECHO': False,
+    # Make Flask errors be real errors, not HTML pages with error info
+    'TESTING': True,
+})
+
+
+class CatalogTestCase(TestCase):
+    """Tests for the local superhero catalog"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Point the API client at a local stub server"""
+
+        cls.stub = StubServer(max_id=50).start()
+        cls.real_client = api_requests.client
+        api_requests.set_client(SuperheroClient(api_key="test", base_url=cls.stub.url))
+
+    @classmethod
+    def tearDownClass(cls):
+        api_requests.set_client(cls.real_client)
+        cls.stub.stop()
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        api_requests.hero_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_ingest(self):
+        """Ingest stores every known id and skips unknown ones"""
+
+        saved, failed = ingest(range(45, 56), workers=4, batch_size=3)
+
+        self.assertEqual((saved, failed), (6, 0))
+        self.assertEqual(Hero.query.count(), 6)
+        self.assertEqual(db.session.get(Hero, 50).name, "Hero 50")
+
+    def test_get_hero_reads_through(self):
+        """A hero missing from the catalog is fetched once and stored"""
+
+        self.assertEqual(get_hero(30).name, "Ant Man")
+        self.assertIsNotNone(db.session.get(Hero, 30))
+
+        with self.assertRaises(HeroNotFound):
+            get_hero(9999)
+
+    def test_get_heroes_order(self):
+        """get_heroes keeps the requested order and drops unknown ids"""
+
+        save_heroes([make_hero(2)])
+        heroes = get_heroes([3, 9999, 2, 1])
+
+        self.assertEqual([hero.id for hero in heroes], [3, 2, 1])
+
+    def test_async_lookups(self):
+        """Async lookups fetch missing heroes concurrently, like the sync ones"""
+
+        save_heroes([make_hero(2)])
+        heroes = asyncio.run(get_heroes_async([3, 9999, 2, 1]))
+
+        self.assertEqual([hero.id for hero in heroes], [3, 2, 1])
+        self.assertEqual(asyncio.run(get_hero_async(30)).name, "Ant Man")
+
+        with self.assertRaises(HeroNotFound):
+            asyncio.run(get_hero_async(9999))
+
+    def test_stale_hero_ids(self):
+        """Only rows older than the cutoff are picked for refresh"""
+
+        save_heroes([make_hero(1), make_hero(2)])
+        db.session.get(Hero, 1).updated_at = datetime.utcnow() - timedelta(days=30)
+        db.session.commit()
+
+        self.assertEqual(stale_hero_ids(timedelta(days=7)), [1])
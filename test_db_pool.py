@@ -0,0 +1,105 @@
+"""Connection pool tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_db_pool.py
+
+import gc
+import os
+import tempfile
+import weakref
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+import db_pool
+from db_pool import engine_options, watch_engine, pool_status, pool_stats, TimedQueuePool
+
+CONFIG = {
+    'SQLALCHEMY_DATABASE_URI': 'postgresql:///superheros_test',
+    'DB_POOL_SIZE': 3,
+    'DB_MAX_OVERFLOW': 2,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT_MS': 5000,
+}
+
+
+class DBPoolTestCase(TestCase):
+    """Tests for engine options and pool metrics"""
+
+    def test_engine_options(self):
+        """Postgres gets the configured pool and statement timeout"""
+
+        options = engine_options(CONFIG)
+
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=5000"})
+
+    def test_sqlite_defaults(self):
+        """SQLite keeps the default engine options"""
+
+        config = dict(CONFIG, SQLALCHEMY_DATABASE_URI='sqlite:///test.db')
+        self.assertEqual(engine_options(config), {})
+
+    def test_pool_metrics(self):
+        """Checkouts, checkins and wait time are recorded"""
+
+        pool_stats.reset()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'pool.db')}",
+                                   poolclass=TimedQueuePool, pool_size=2)
+            watch_engine(engine)
+
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                self.assertEqual(pool_status(engine)["checked_out"], 1)
+
+            status = pool_status(engine)
+            engine.dispose()
+
+        self.assertEqual(status["connects"], 1)
+        self.assertEqual(status["checkouts"], 1)
+        self.assertEqual(status["checkins"], 1)
+        self.assertEqual(status["checked_out"], 0)
+        self.assertGreater(status["wait_seconds_total"], 0)
+
+    def test_checkout_timeouts(self):
+        """Only pool timeouts count as checkout timeouts, not other connect errors"""
+
+        pool_stats.reset()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'pool.db')}",
+                                   poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+                                   pool_timeout=0.05)
+
+            with engine.connect():
+                with self.assertRaises(PoolTimeout):
+                    engine.connect()
+
+            engine.dispose()
+
+        bad = create_engine("sqlite:////nonexistent/dir/pool.db", poolclass=TimedQueuePool)
+        with self.assertRaises(Exception):
+            bad.connect()
+
+        self.assertEqual(pool_stats.snapshot()["checkout_timeouts"], 1)
+
+    def test_watched_engines_not_kept_alive(self):
+        """The fork hook doesn't hold on to engines nobody else uses"""
+
+        engine = create_engine("sqlite://")
+        watch_engine(engine)
+        self.assertIn(engine, db_pool._watched_engines)
+
+        ref = weakref.ref(engine)
+        del engine
+        gc.collect()
+
+        self.assertIsNone(ref())
@@ -0,0 +1,111 @@
+"""Hero cache tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_hero_cache.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from hero_cache import HeroCache, SQLiteTier, NOT_FOUND
+
+
+class HeroCacheTestCase(TestCase):
+    """Tests for the superhero response cache"""
+
+    def setUp(self):
+        self.calls = 0
+
+    def loader(self, value):
+        """Return a loader that counts how many times it was called"""
+
+        def load():
+            self.calls += 1
+            return value
+        return load
+
+    def test_hit_after_miss(self):
+        """Second lookup should be served from the cache"""
+
+        cache = HeroCache()
+        self.assertEqual(cache.get_or_load(303, self.loader({"name": "Groot"})), {"name": "Groot"})
+        self.assertEqual(cache.get_or_load(303, self.loader({"name": "Groot"})), {"name": "Groot"})
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        """Least recently used entry is evicted once maxsize is reached"""
+
+        cache = HeroCache(maxsize=2)
+        cache.get_or_load(1, self.loader("a"))
+        cache.get_or_load(2, self.loader("b"))
+        cache.get_or_load(1, self.loader("a"))
+        cache.get_or_load(3, self.loader("c"))
+
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["size"], 2)
+
+        # 2 was least recently used so it has to be loaded again
+        cache.get_or_load(2, self.loader("b"))
+        self.assertEqual(self.calls, 4)
+
+    def test_negative_caching(self):
+        """Unknown ids are cached so the API isn't asked again"""
+
+        cache = HeroCache()
+        self.assertIs(cache.get_or_load(9999, self.loader(NOT_FOUND)), NOT_FOUND)
+        self.assertIs(cache.get_or_load(9999, self.loader(NOT_FOUND)), NOT_FOUND)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()["negative_hits"], 1)
+
+    def test_stale_while_revalidate(self):
+        """Stale entries are served immediately and refreshed in background"""
+
+        cache = HeroCache(ttl=0, stale_ttl=60)
+        cache.get_or_load(303, self.loader("old"))
+
+        self.assertEqual(cache.get_or_load(303, self.loader("new")), "old")
+        self.assertEqual(cache.stats()["stale_hits"], 1)
+
+        # Wait for the background refresh to land
+        for _ in range(50):
+            if cache.stats()["refreshes"]:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(cache._entries["303"].value, "new")
+
+    def test_shared_tier(self):
+        """A second cache using the same SQLite file sees the first one's entries"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            first = HeroCache(shared=SQLiteTier(path))
+            second = HeroCache(shared=SQLiteTier(path))
+
+            first.get_or_load(303, self.loader({"name": "Groot"}))
+            self.assertEqual(second.get_or_load(303, self.loader(None)), {"name": "Groot"})
+
+            self.assertEqual(self.calls, 1)
+            self.assertEqual(second.stats()["shared_hits"], 1)
+
+    def test_shared_tier_bounded(self):
+        """The shared tier drops expired rows, then the soonest to expire past max_rows"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tier = SQLiteTier(os.path.join(tmp, "cache.db"), max_rows=3, purge_every=5)
+            cache = HeroCache(negative_ttl=0, shared=tier)
+
+            cache.set(9999, NOT_FOUND)
+            for hero_id in range(1, 5):
+                cache.set(hero_id, {"id": hero_id})
+
+            self.assertEqual(len(tier), 3)
+            self.assertIsNone(tier.get("9999"))
+            self.assertIsNone(tier.get("1"))
+            self.assertEqual(tier.get("4").value, {"id": 4})
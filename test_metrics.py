@@ -0,0 +1,85 @@
+"""Metrics tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_metrics.py
+
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from unittest import TestCase
+
+import metrics
+from metrics import Histogram, RequestTimings, current_timings
+
+
+class HistogramTestCase(TestCase):
+    """Tests for the latency histogram"""
+
+    def test_buckets_are_cumulative(self):
+        """Each bucket counts everything at or below its bound"""
+
+        histogram = Histogram("test_seconds", "Test", ("route",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "a")
+        histogram.observe(0.5, "a")
+        histogram.observe(5.0, "a")
+
+        lines = histogram.render()
+
+        self.assertIn('test_seconds_bucket{route="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="a",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{route="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{route="a"} 3', lines)
+        self.assertIn('test_seconds_sum{route="a"} 5.550000', lines)
+
+
+class RequestTimingsTestCase(TestCase):
+    """Tests for per-request timings"""
+
+    def tearDown(self):
+        current_timings.set(None)
+
+    def test_record_outside_request(self):
+        """Recording with no request in progress is a no-op"""
+
+        current_timings.set(None)
+        metrics.record("db", 0.1)
+
+    def test_timed(self):
+        """timed() adds to the current request and the histogram"""
+
+        timings = RequestTimings()
+        current_timings.set(timings)
+        histogram = Histogram("test_seconds", "Test")
+
+        with metrics.timed("cache", histogram):
+            pass
+        with metrics.timed("cache", histogram):
+            pass
+
+        self.assertEqual(timings.count("cache"), 2)
+        self.assertIn("test_seconds_count 2", histogram.render())
+
+    def test_timings_follow_worker_threads(self):
+        """Work in a copied context counts towards the request"""
+
+        timings = RequestTimings()
+        current_timings.set(timings)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            for _ in range(8):
+                pool.submit(contextvars.copy_context().run, metrics.record, "api", 0.01)
+
+        self.assertEqual(timings.count("api"), 8)
+
+    def test_gauges(self):
+        """Registered gauge sources are exported at render time"""
+
+        metrics.register_gauges("test_gauge", "Test", lambda: {"size": 3, "name": "skip"})
+
+        try:
+            text = metrics.render_prometheus()
+        finally:
+            metrics.GAUGE_SOURCES.pop()
+
+        self.assertIn('test_gauge{key="size"} 3', text)
+        self.assertNotIn("skip", text)
@@ -0,0 +1,89 @@
+"""Password hashing tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_passwords.py
+
+from unittest import TestCase
+
+from passwords import PasswordHasher, LoginRateLimiter
+
+
+class PasswordHasherTestCase(TestCase):
+    """Tests for hashing passwords on the process pool"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.hasher = PasswordHasher(rounds=4, workers=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.hasher.shutdown()
+
+    def test_hash_and_verify(self):
+        """Hashes are bcrypt and only match the right password"""
+
+        hashed = self.hasher.hash("password1")
+
+        self.assertTrue(hashed.startswith("$2b$04$"))
+        self.assertTrue(self.hasher.verify(hashed, "password1"))
+        self.assertFalse(self.hasher.verify(hashed, "password2"))
+        self.assertFalse(self.hasher.verify("not a hash", "password1"))
+
+    def test_empty_password(self):
+        """Empty passwords are rejected like before"""
+
+        with self.assertRaises(ValueError):
+            self.hasher.hash("")
+
+    def test_needs_rehash(self):
+        """Hashes made with another cost factor need re-hashing"""
+
+        stronger = PasswordHasher(rounds=5, workers=0)
+
+        self.assertFalse(self.hasher.needs_rehash(self.hasher.hash("password1")))
+        self.assertTrue(self.hasher.needs_rehash(stronger.hash("password1")))
+
+
+class LoginRateLimiterTestCase(TestCase):
+    """Tests for limiting failed logins"""
+
+    def test_blocks_after_max_attempts(self):
+        """Keys are blocked once they reach max failed attempts"""
+
+        limiter = LoginRateLimiter(max_attempts=2, window=60)
+        limiter.record_failure("user:a", "ip:1")
+        self.assertTrue(limiter.allow("user:a", "ip:1"))
+
+        limiter.record_failure("user:a", "ip:1")
+        self.assertFalse(limiter.allow("user:a", "ip:2"))
+        self.assertFalse(limiter.allow("user:b", "ip:1"))
+        self.assertTrue(limiter.allow("user:b", "ip:2"))
+
+    def test_window_expires(self):
+        """Old failures stop counting once the window passes"""
+
+        limiter = LoginRateLimiter(max_attempts=1, window=0)
+        limiter.record_failure("user:a")
+        self.assertTrue(limiter.allow("user:a"))
+
+    def test_bounded(self):
+        """Keys are forgotten once their failures leave the window, or past max_keys"""
+
+        limiter = LoginRateLimiter(max_attempts=2, window=0)
+        for i in range(100):
+            limiter.record_failure(f"user:{i}")
+        self.assertEqual(len(limiter), 0)
+
+        limiter = LoginRateLimiter(max_attempts=2, window=60, max_keys=10)
+        limiter.record_failure("user:a")
+        limiter.record_failure("user:a")
+        for i in range(100):
+            limiter.record_failure(f"user:{i}")
+
+        # The least recently failed key went first, so user:a's failures are forgotten
+        self.assertEqual(len(limiter), 10)
+        self.assertTrue(limiter.allow("user:a"))
+
+        limiter.record_failure("user:99")
+        self.assertFalse(limiter.allow("user:99"))
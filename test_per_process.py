@@ -0,0 +1,49 @@
+"""Per-process resource tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_per_process.py
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from per_process import PerProcess
+
+
+class PerProcessTestCase(TestCase):
+    """Tests for making resources once per process"""
+
+    def test_made_once_per_process(self):
+        """A process reuses its resource; a forked one makes its own"""
+
+        made = []
+        resource = PerProcess(lambda: made.append(object()) or made[-1])
+
+        first = resource.get()
+        self.assertIs(resource.get(), first)
+
+        with patch("per_process.os.getpid", return_value=os.getpid() + 1):
+            child = resource.get()
+            self.assertIsNot(child, first)
+            self.assertIs(resource.get(), child)
+
+        self.assertEqual(len(made), 2)
+
+    def test_starting_value(self):
+        """A value passed in is this process's, but not a forked child's"""
+
+        given = object()
+        resource = PerProcess(object, given)
+        self.assertIs(resource.get(), given)
+
+        with patch("per_process.os.getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(resource.get(), given)
+
+    def test_reset(self):
+        resource = PerProcess(object)
+        self.assertIsNone(resource.reset())
+
+        first = resource.get()
+        self.assertIs(resource.reset(), first)
+        self.assertIsNot(resource.get(), first)
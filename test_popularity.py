@@ -0,0 +1,124 @@
+"""Favorites leaderboard tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_popularity.py
+
+import os
+from unittest import TestCase
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Favorites, HeroPopularity
+from catalog import save_heroes
+from popularity import top_hero_counts, reconcile
+from stub_api import make_hero
+
+# Use test database and don't clutter tests with SQL
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'SQLALCHEMY_ECHO': False,
+    # Make Flask errors be real errors, not HTML pages with error info
+    'TESTING': True,
+})
+
+
+class PopularityTestCase(TestCase):
+    """Tests for the per-hero favorite counters"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        self.users = []
+        for i in range(3):
+            user = User(username=f"pop{i}", email=f"pop{i}@test.com", password="unused")
+            db.session.add(user)
+            self.users.append(user)
+        db.session.commit()
+
+        self.uids = [user.id for user in self.users]
+        save_heroes([make_hero(303), make_hero(489), make_hero(30)])
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_counters_follow_favorites(self):
+        """Adding, toggling and removing favorites keep the counts right"""
+
+        Favorites.add_many(self.uids[0], [303, 489])
+        Favorites.add_many(self.uids[1], [303, 303])
+        Favorites.add_many(self.uids[2], [303, 30])
+        # Already a favorite, so not counted again
+        Favorites.add_many(self.uids[0], [303])
+        db.session.commit()
+
+        self.assertEqual(top_hero_counts(), [(303, 3), (30, 1), (489, 1)])
+
+        Favorites.toggle(self.uids[2], 303)
+        Favorites.toggle(self.uids[1], 489)
+        Favorites.remove_many(self.uids[0], [489, 30])
+        db.session.commit()
+
+        self.assertEqual(top_hero_counts(), [(303, 2), (30, 1), (489, 1)])
+        self.assertEqual(top_hero_counts(limit=1), [(303, 2)])
+
+        Favorites.remove_all(self.uids[0])
+        db.session.commit()
+
+        self.assertEqual(top_hero_counts(), [(30, 1), (303, 1), (489, 1)])
+
+    def test_reconcile(self):
+        """Reconcile fixes counters that missed direct writes"""
+
+        Favorites.add_many(self.uids[0], [303])
+        db.session.add(Favorites(user_id=self.uids[1], hero_id=489))
+        db.session.add(HeroPopularity(hero_id=30, favorites=5))
+        db.session.commit()
+
+        self.assertEqual(reconcile(), 2)
+        self.assertEqual(top_hero_counts(), [(303, 1), (489, 1)])
+        self.assertEqual(reconcile(), 0)
+
+    def test_popular_views(self):
+        """Leaderboard page and API list heroes by favorites"""
+
+        Favorites.add_many(self.uids[0], [489, 30])
+        Favorites.add_many(self.uids[1], [489])
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uids[2]
+
+            resp = c.get("/api/superheros/popular?limit=5")
+            self.assertEqual(resp.json["heroes"][0]["name"], "Nick Fury")
+            self.assertEqual([hero["favorites"] for hero in resp.json["heroes"]], [2, 1])
+
+            # Negative limits would be an error in Postgres' LIMIT
+            resp = c.get("/api/superheros/popular?limit=-1")
+            self.assertEqual([hero["name"] for hero in resp.json["heroes"]], ["Nick Fury"])
+
+            resp = c.get("/superheros/popular")
+            html = resp.get_data(as_text=True)
+            self.assertIn("1. Nick Fury", html)
+            self.assertIn("2 favorites", html)
+
+    def test_delete_user_updates_counts(self):
+        """Deleting a user takes their favorites off the leaderboard"""
+
+        Favorites.add_many(self.uids[0], [303])
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uids[0]
+
+            c.post("/users/delete")
+
+        self.assertEqual(top_hero_counts(), [])
@@ -0,0 +1,206 @@
+"""Powerstats tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_powerstats.py
+
+import math
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from app import create_app, CURR_USER_KEY
+from models import db, User
+from catalog import save_heroes
+from stub_api import make_hero
+from powerstats import PowerStats, PowerStatsStore, parse_stats
+import powerstats
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+})
+
+
+def hero_with_stats(hero_id, *values):
+    """Stub hero JSON with the given powerstats (None for "null")"""
+
+    data = make_hero(hero_id)
+    data["powerstats"] = {stat: "null" if value is None else str(value)
+                          for stat, value in zip(powerstats.STATS, values)}
+    return data
+
+
+HEROES = [
+    hero_with_stats(1, 100, 100, 100, 100, 100, 100),
+    hero_with_stats(2, 50, 50, 50, 50, 50, 50),       # same mix as 1, half as strong
+    hero_with_stats(3, 100, 10, 10, 10, 10, 10),
+    hero_with_stats(4, 95, 95, 95, 95, 95, None),
+    hero_with_stats(5, None, None, None, None, None, None),
+]
+
+
+class PowerStatsTestCase(TestCase):
+    """Tests for the powerstats matrix"""
+
+    def setUp(self):
+        self.matrix = PowerStats.build([(int(data["id"]), data) for data in reversed(HEROES)])
+
+    def test_parse_stats(self):
+        """Unknown stats are NaN"""
+
+        stats = parse_stats(HEROES[3])
+        self.assertEqual(stats[:5], [95.0] * 5)
+        self.assertTrue(math.isnan(stats[5]))
+
+    def test_build(self):
+        """Rows are sorted by id; heroes without any stats are left out"""
+
+        self.assertEqual(self.matrix.ids.tolist(), [1, 2, 3, 4])
+        self.assertEqual(self.matrix.stats.dtype, np.float32)
+        self.assertIsNone(self.matrix.row(5))
+        self.assertAlmostEqual(float(np.linalg.norm(self.matrix.unit[0])), 1.0, places=5)
+
+    def test_similar_cosine(self):
+        """Cosine ranks heroes by mix of stats, ignoring scale"""
+
+        similar = self.matrix.similar(1, limit=2)
+
+        self.assertEqual(similar[0], (2, 1.0))
+        self.assertEqual(similar[1][0], 4)
+        self.assertNotIn(1, [hero_id for hero_id, _ in self.matrix.similar(1, limit=10)])
+
+    def test_similar_euclidean(self):
+        """Euclidean ranks heroes by distance between their stats"""
+
+        similar = self.matrix.similar(1, limit=3, metric="euclidean")
+
+        # 4's unknown combat counts as 0, which still leaves it nearest
+        self.assertEqual([hero_id for hero_id, _ in similar], [4, 2, 3])
+        self.assertEqual(similar[1][1], round(math.sqrt(6 * 50 ** 2), 4))
+
+    def test_similar_unknown(self):
+        self.assertIsNone(self.matrix.similar(5))
+        self.assertIsNone(self.matrix.similar(999))
+
+    def test_compare(self):
+        """Compare lists stats, totals and who leads each stat"""
+
+        comparison = self.matrix.compare([4, 3, 999])
+
+        self.assertEqual([hero["id"] for hero in comparison["heroes"]], [4, 3])
+        self.assertIsNone(comparison["heroes"][0]["powerstats"]["combat"])
+        self.assertEqual(comparison["heroes"][0]["total"], 475)
+        self.assertEqual(comparison["leaders"]["intelligence"], [3])
+        self.assertEqual(comparison["leaders"]["strength"], [4])
+        self.assertEqual(comparison["leaders"]["combat"], [3])
+        self.assertEqual(comparison["missing"], [999])
+        self.assertEqual(comparison["average"]["intelligence"], 86.2)
+
+
+class PowerStatsStoreTestCase(TestCase):
+    """Tests for building and sharing the matrix on disk"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        save_heroes(HEROES[:3])
+
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_shared_between_workers(self):
+        """The first store builds the matrix; another maps the same files"""
+
+        first = PowerStatsStore(self.tmp.name).sync()
+        second = PowerStatsStore(self.tmp.name).sync()
+
+        self.assertIsInstance(second.stats, np.memmap)
+        self.assertEqual(second.stats.filename, first.stats.filename)
+        self.assertEqual(second.ids.tolist(), [1, 2, 3])
+
+    def test_rebuilt_when_catalog_changes(self):
+        """A new catalog version gets a new matrix and old versions are removed"""
+
+        store = PowerStatsStore(self.tmp.name)
+        old = store.sync()
+        save_heroes([HEROES[3]])
+
+        self.assertEqual(store.sync().ids.tolist(), [1, 2, 3, 4])
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+        self.assertFalse(os.path.exists(old.stats.filename))
+
+
+class PowerStatsViewsTestCase(TestCase):
+    """Tests for the /similar and /compare endpoints"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        save_heroes(HEROES)
+
+        user = User.signup("test1", "password1", "email1@email.com", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.real_store = powerstats.powerstats
+        powerstats.powerstats = PowerStatsStore(self.tmp.name)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        powerstats.powerstats = self.real_store
+        self.tmp.cleanup()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_similar(self):
+        resp = self.client.get("/superheros/1/similar?limit=2")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([hero["id"] for hero in resp.json["heroes"]], [2, 4])
+        self.assertEqual(resp.json["heroes"][0]["name"], "Hero 2")
+
+    def test_similar_errors(self):
+        self.assertEqual(self.client.get("/superheros/5/similar").status_code, 404)
+        self.assertEqual(self.client.get("/superheros/1/similar?metric=manhattan").status_code,
+                         400)
+
+    def test_compare(self):
+        resp = self.client.get("/superheros/compare?ids=3,4")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([hero["name"] for hero in resp.json["heroes"]], ["Hero 3", "Hero 4"])
+        self.assertEqual(resp.json["leaders"]["strength"], [4])
+
+    def test_compare_errors(self):
+        self.assertEqual(self.client.get("/superheros/compare?ids=").status_code, 400)
+        self.assertEqual(self.client.get("/superheros/compare?ids=1,x").status_code, 400)
+        self.assertEqual(
+            self.client.get("/superheros/compare?ids=99999999999999999999").status_code, 400)
+        self.assertEqual(self.client.get("/superheros/compare?ids=1,-2").status_code, 400)
+        ids = ",".join(str(i) for i in range(30))
+        self.assertEqual(self.client.get(f"/superheros/compare?ids={ids}").status_code, 400)
+
+    def test_logged_out(self):
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+
+        self.assertEqual(self.client.get("/superheros/1/similar").status_code, 401)
+        self.assertEqual(self.client.get("/superheros/compare?ids=1").status_code, 401)
@@ -0,0 +1,104 @@
+"""Cache warming tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_prefetch.py
+
+import os
+import threading
+from unittest import TestCase
+
+import api_requests
+from app import create_app
+from models import db, User, Favorites, Hero
+from api_requests import SuperheroClient
+from prefetch import Prefetcher, warm_favorites
+from stub_api import StubServer
+
+# Use test database and don't clutter tests with SQL
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'SQLALCHEMY_ECHO': False,
+    # Make Flask errors be real errors, not HTML pages with error info
+    'TESTING': True,
+})
+
+
+class PrefetcherTestCase(TestCase):
+    """Tests for the background job runner"""
+
+    def test_runs_in_app_context(self):
+        """Jobs run in the app's context and are counted"""
+
+        prefetcher = Prefetcher(workers=2)
+        seen = []
+
+        prefetcher.submit(app, lambda: seen.append(db.engine.url.drivername))
+        prefetcher.submit(app, lambda: 1 / 0)
+        self.assertTrue(prefetcher.wait(5))
+
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(prefetcher.stats(),
+                         dict(submitted=2, completed=1, failed=1, dropped=0, pending=0))
+
+    def test_bounded(self):
+        """Jobs past max_pending are dropped instead of queued"""
+
+        prefetcher = Prefetcher(workers=1, max_pending=2)
+        release = threading.Event()
+
+        results = [prefetcher.submit(app, release.wait) for _ in range(4)]
+        release.set()
+        prefetcher.wait(5)
+
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual(prefetcher.stats()["dropped"], 2)
+
+    def test_off_switch(self):
+        """Nothing runs when warming is turned off"""
+
+        prefetcher = Prefetcher(enabled=False)
+
+        self.assertFalse(prefetcher.submit(app, lambda: None))
+        self.assertEqual(prefetcher.stats()["submitted"], 0)
+
+
+class WarmFavoritesTestCase(TestCase):
+    """Tests for warming a user's favorites"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        self.real_client = api_requests.client
+        api_requests.hero_cache.clear()
+
+    def tearDown(self):
+        api_requests.set_client(self.real_client)
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_fetches_missing_favorites(self):
+        """Favorites not in the catalog yet are fetched and stored"""
+
+        user = User(username="warm", email="warm@test.com", password="unused")
+        db.session.add(user)
+        db.session.flush()
+        Favorites.add_many(user.id, [10, 11, 12])
+        db.session.commit()
+
+        with StubServer(max_id=50) as stub:
+            api_requests.set_client(SuperheroClient(api_key="test", base_url=stub.url))
+
+            prefetcher = Prefetcher()
+            prefetcher.submit(app, warm_favorites, user.id)
+            prefetcher.wait(10)
+
+            self.assertEqual(stub.request_count, 3)
+
+        self.assertEqual(prefetcher.stats()["completed"], 1)
+        self.assertEqual(db.session.scalar(db.select(db.func.count(Hero.id))), 3)
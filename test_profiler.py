@@ -0,0 +1,145 @@
+"""Sampling profiler tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_profiler.py
+
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import create_app, CURR_USER_KEY
+from models import db, User
+import profiler
+from profiler import SamplingProfiler
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+    'ADMIN_USERS': {"admin"},
+})
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplingProfilerTestCase(TestCase):
+    """Tests for SamplingProfiler"""
+
+    def profile_busy_thread(self, rate=1.0):
+        profiler = SamplingProfiler(interval=0.001)
+        stop = threading.Event()
+
+        def handle_request():
+            profiler.begin_request("busy_route")
+            busy_loop(stop)
+            profiler.end_request()
+
+        profiler.start(0.2, rate=rate)
+        worker = threading.Thread(target=handle_request)
+        worker.start()
+        time.sleep(0.1)
+        stop.set()
+        worker.join()
+        profiler.stop()
+
+        return profiler
+
+    def test_collapsed_stacks(self):
+        """Samples are grouped by route, outermost frame first"""
+
+        profiler = self.profile_busy_thread()
+        lines = profiler.collapsed().splitlines()
+
+        self.assertTrue(lines)
+        stack, count = lines[-1].rsplit(" ", 1)
+        frames = stack.split(";")
+
+        self.assertEqual(frames[0], "busy_route")
+        self.assertTrue(any(frame.startswith("busy_loop (test_profiler.py:") for frame in frames))
+        self.assertGreater(int(count), 0)
+        self.assertEqual(profiler.collapsed(route="other"), "")
+
+    def test_speedscope(self):
+        """Speedscope output has one sampled profile per route"""
+
+        profiler = self.profile_busy_thread()
+        report = profiler.speedscope()
+
+        self.assertEqual(len(report["profiles"]), 1)
+        profile = report["profiles"][0]
+        self.assertEqual(profile["name"], "busy_route")
+        self.assertEqual(len(profile["samples"]), len(profile["weights"]))
+
+        names = {report["shared"]["frames"][i]["name"] for sample in profile["samples"] for i in sample}
+        self.assertIn("busy_loop", names)
+
+    def test_unsampled_requests(self):
+        """Requests not picked by the sample rate aren't profiled"""
+
+        profiler = self.profile_busy_thread(rate=0.0)
+
+        self.assertEqual(profiler.status()["samples"], 0)
+        self.assertFalse(profiler.running)
+
+    def test_restart(self):
+        """The profiler can be started again after it stops"""
+
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start(0.01)
+        profiler.stop()
+        profiler.start(5)
+
+        self.assertTrue(profiler.running)
+        profiler.stop()
+        self.assertFalse(profiler.running)
+
+
+class ProfilerRoutesTestCase(TestCase):
+    """Tests for the admin profiling routes"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        user = User(username="admin", email="admin@test.com", password="unused")
+        db.session.add(user)
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def tearDown(self):
+        profiler.profiler.stop()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_bad_numbers(self):
+        for value in ("nan", "inf", "ten"):
+            resp = self.client.get(f"/admin/profile/capture?seconds={value}")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = self.client.post(f"/admin/profile/start?seconds={value}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_capture_clamped(self):
+        """Captures can't go negative or outlast the worker timeout"""
+
+        # Not started, so the only sleeps are the captures' own
+        with patch.object(profiler.profiler, "start"), \
+                patch.object(profiler.time, "sleep") as sleep:
+            self.assertEqual(self.client.get("/admin/profile/capture?seconds=-1").status_code,
+                             200)
+            self.client.get("/admin/profile/capture?seconds=600")
+
+        self.assertEqual([call.args[0] for call in sleep.call_args_list],
+                         [0, profiler.MAX_CAPTURE_SECONDS])
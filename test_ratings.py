@@ -0,0 +1,221 @@
+"""Hero rating tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_ratings.py
+
+import os
+import random
+from unittest import TestCase
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Favorites, HeroRating
+from catalog import save_heroes
+from stub_api import make_hero
+from ratings import hero_rating, top_rated_counts, reaggregate
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+})
+
+HERO_IDS = [30, 303, 489]
+
+
+class RatingsTestCase(TestCase):
+    """Tests for keeping per-hero rating totals"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User(username=f"rate{i}", email=f"rate{i}@test.com", password="unused")
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.uids = [user.id for user in users]
+        save_heroes([make_hero(hero_id) for hero_id in HERO_IDS])
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def totals(self):
+        return {hero_id: (ratings, rating_sum, average) for hero_id, ratings, rating_sum, average
+                in db.session.execute(db.select(HeroRating.hero_id, HeroRating.ratings,
+                                                HeroRating.rating_sum, HeroRating.average))
+                if ratings}
+
+    def test_totals_follow_ratings(self):
+        """Rating, re-rating, clearing and un-favoriting keep the totals right"""
+
+        for user_id in self.uids[:3]:
+            Favorites.add_many(user_id, [303, 489])
+
+        self.assertTrue(Favorites.rate(self.uids[0], 303, 5))
+        self.assertTrue(Favorites.rate(self.uids[1], 303, 4))
+        self.assertTrue(Favorites.rate(self.uids[2], 303, 2))
+        self.assertTrue(Favorites.rate(self.uids[0], 489, 3))
+        db.session.commit()
+
+        self.assertEqual(hero_rating(303), (11 / 3, 3))
+        self.assertEqual(hero_rating(489), (3.0, 1))
+        self.assertEqual(hero_rating(30), (None, 0))
+
+        # Not a favorite, so can't be rated
+        self.assertFalse(Favorites.rate(self.uids[3], 303, 1))
+
+        Favorites.rate(self.uids[2], 303, 5)
+        Favorites.rate(self.uids[0], 489, None)
+        Favorites.toggle(self.uids[1], 303)
+        db.session.commit()
+
+        self.assertEqual(hero_rating(303), (5.0, 2))
+        self.assertEqual(hero_rating(489), (None, 0))
+
+        Favorites.remove_all(self.uids[0])
+        db.session.commit()
+
+        self.assertEqual(hero_rating(303), (5.0, 1))
+
+    def test_incremental_matches_reaggregate(self):
+        """Totals kept up by the Favorites helpers need no fixing"""
+
+        rand = random.Random(3)
+
+        for _ in range(80):
+            user_id = rand.choice(self.uids)
+            hero_id = rand.choice(HERO_IDS)
+            action = rand.random()
+
+            if action < 0.3:
+                Favorites.toggle(user_id, hero_id)
+            elif action < 0.85:
+                Favorites.rate(user_id, hero_id, rand.choice([None, 1, 2, 3, 4, 5]))
+            elif action < 0.95:
+                Favorites.remove_many(user_id, rand.sample(HERO_IDS, 2))
+            else:
+                Favorites.remove_all(user_id)
+        db.session.commit()
+
+        self.assertTrue(self.totals())
+        self.assertEqual(reaggregate(), 0)
+
+    def test_reaggregate(self):
+        """Reaggregate fixes totals that missed direct writes"""
+
+        Favorites.add_many(self.uids[0], [303, 489])
+        Favorites.rate(self.uids[0], 303, 4)
+        db.session.add(Favorites(user_id=self.uids[1], hero_id=303, rating=2))
+        db.session.execute(db.update(Favorites).where(Favorites.hero_id == 489).values(rating=5))
+        db.session.commit()
+
+        self.assertEqual(reaggregate(), 2)
+        self.assertEqual(self.totals(), {303: (2, 6, 3.0), 489: (1, 5, 5.0)})
+
+        db.session.execute(db.delete(Favorites).where(Favorites.hero_id == 489))
+        db.session.commit()
+
+        self.assertEqual(reaggregate(), 1)
+        self.assertEqual(hero_rating(489), (None, 0))
+
+    def test_top_rated(self):
+        """Best average first, ties by more ratings; heroes with too few left out"""
+
+        for user_id, stars in zip(self.uids, [5, 4, 3, 4]):
+            Favorites.add_many(user_id, HERO_IDS)
+            Favorites.rate(user_id, 303, stars)
+        for user_id in self.uids[:2]:
+            Favorites.rate(user_id, 489, 4)
+        Favorites.rate(self.uids[0], 30, 5)
+        db.session.commit()
+
+        self.assertEqual(top_rated_counts(min_ratings=2), [(303, 4.0, 4), (489, 4.0, 2)])
+        self.assertEqual(top_rated_counts(min_ratings=1)[0], (30, 5.0, 1))
+        self.assertEqual(top_rated_counts(limit=1, min_ratings=2), [(303, 4.0, 4)])
+
+
+class RatingViewsTestCase(TestCase):
+    """Tests for rating heroes and showing ratings"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        user = User(username="rater", email="rater@test.com", password="unused")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        save_heroes([make_hero(hero_id) for hero_id in HERO_IDS])
+        Favorites.add_many(self.user_id, [303])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_rate(self):
+        resp = self.client.post("/superheros/303/rate", data={"rating": "4"},
+                                follow_redirects=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("4.0 / 5 from 1 rating", resp.text)
+        self.assertIn('<option value="4" selected>', resp.text)
+
+        self.client.post("/superheros/303/rate", data={"rating": "0"})
+        self.assertEqual(hero_rating(303), (None, 0))
+
+    def test_rate_errors(self):
+        Favorites.rate(self.user_id, 303, 4)
+        db.session.commit()
+
+        for data in ({"rating": "9"}, {"rating": "abc"}, {}):
+            resp = self.client.post("/superheros/303/rate", data=data, follow_redirects=True)
+            self.assertIn("Ratings go from 1 to 5 stars", resp.text)
+
+        # None of those cleared the existing rating; an empty field does
+        self.assertEqual(hero_rating(303), (4.0, 1))
+        self.client.post("/superheros/303/rate", data={"rating": ""})
+        self.assertEqual(hero_rating(303), (None, 0))
+
+        resp = self.client.post("/superheros/489/rate", data={"rating": "3"},
+                                follow_redirects=True)
+        self.assertIn("Favorite a superhero to rate it", resp.text)
+        self.assertIn("Not rated yet", resp.text)
+        self.assertEqual(hero_rating(489), (None, 0))
+
+    def test_top_rated(self):
+        Favorites.rate(self.user_id, 303, 5)
+        db.session.commit()
+
+        resp = self.client.get("/api/superheros/top-rated")
+        self.assertEqual(resp.json["heroes"], [])
+        resp = self.client.get("/api/superheros/top-rated?limit=-1")
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get("/superheros/top-rated")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("No superhero has enough ratings yet", resp.text)
+
+    def test_logged_out(self):
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+
+        self.assertEqual(self.client.get("/api/superheros/top-rated").status_code, 401)
+        self.client.post("/superheros/303/rate", data={"rating": "4"})
+        self.assertEqual(hero_rating(303), (None, 0))
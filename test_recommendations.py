@@ -0,0 +1,264 @@
+"""Co-favorite recommendation tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_recommendations.py
+
+import os
+import random
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Favorites, CoFavorite, HeroRecommendation
+from catalog import save_heroes
+from stub_api import make_hero
+import recommendations
+from recommendations import (sparse_favorites, co_favorite_counts, top_similar, rebuild, refresh,
+                             recommended_for_hero, recommended_for_user)
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+})
+
+HERO_IDS = [30, 107, 149, 213, 303, 332, 346, 489]
+
+
+class CoFavoriteMatrixTestCase(TestCase):
+    """Tests for the numpy side of rebuilding"""
+
+    def test_counts_match_brute_force(self):
+        """Blocked sparse products count every pair's shared fans"""
+
+        rand = random.Random(1)
+        favorites = {user_id: set(rand.sample(HERO_IDS, rand.randint(1, 5)))
+                     for user_id in range(1, 40)}
+        user_ids = [user_id for user_id, heroes in favorites.items() for _ in heroes]
+        hero_ids = [hero_id for heroes in favorites.values() for hero_id in heroes]
+
+        heroes, indptr, columns = sparse_favorites(user_ids, hero_ids)
+        counts = co_favorite_counts(heroes, indptr, columns, block_users=7)
+
+        for a, first in enumerate(heroes):
+            for b, second in enumerate(heroes):
+                expected = sum(1 for heroes_ in favorites.values()
+                               if first in heroes_ and second in heroes_)
+                self.assertEqual(counts[a, b], expected)
+
+    def test_top_similar(self):
+        """Heroes rank by cosine of their fans; pairs under min_together are left out"""
+
+        counts = np.array([
+            [4, 3, 2, 1],
+            [3, 3, 0, 0],
+            [2, 0, 8, 1],
+            [1, 0, 1, 1],
+        ], dtype=np.int32)
+
+        best, scores = top_similar(counts, per_hero=3, min_together=2)
+
+        # 1 shares 3 of 0's fans and has no others; 2 shares 2 but has 8
+        self.assertEqual(best[0].tolist(), [1, 2, -1])
+        self.assertAlmostEqual(float(scores[0, 0]), 3 / np.sqrt(4 * 3), places=5)
+        self.assertEqual(best[3].tolist(), [-1, -1, -1])
+
+
+class RecommendationsTestCase(TestCase):
+    """Tests for keeping co-favorites and recommendations in the database"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User(username=f"rec{i}", email=f"rec{i}@test.com", password="unused")
+                 for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.uids = [user.id for user in users]
+        save_heroes([make_hero(hero_id) for hero_id in HERO_IDS])
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def co_favorites(self):
+        return set(db.session.execute(
+            db.select(CoFavorite.hero_id, CoFavorite.other_id, CoFavorite.together)
+            .where(CoFavorite.together > 0)).all())
+
+    def recommendations(self):
+        return db.session.execute(
+            db.select(HeroRecommendation.hero_id, HeroRecommendation.rank,
+                      HeroRecommendation.other_id, HeroRecommendation.score)
+            .order_by(HeroRecommendation.hero_id, HeroRecommendation.rank)).all()
+
+    def test_incremental_matches_rebuild(self):
+        """Counts kept up by the Favorites helpers match a full recount"""
+
+        rand = random.Random(2)
+
+        for _ in range(60):
+            user_id = rand.choice(self.uids)
+            action = rand.random()
+
+            if action < 0.5:
+                Favorites.toggle(user_id, rand.choice(HERO_IDS))
+            elif action < 0.8:
+                Favorites.add_many(user_id, rand.sample(HERO_IDS, 3))
+            elif action < 0.95:
+                Favorites.remove_many(user_id, rand.sample(HERO_IDS, 2))
+            else:
+                Favorites.remove_all(user_id)
+        db.session.commit()
+
+        incremental = self.co_favorites()
+        refresh(HERO_IDS)
+        refreshed = self.recommendations()
+        self.assertTrue(refreshed)
+
+        stats = rebuild()
+
+        self.assertEqual(self.co_favorites(), incremental)
+        self.assertEqual(self.recommendations(), refreshed)
+        self.assertEqual(stats["favorites"], db.session.scalar(
+            db.select(db.func.count()).select_from(Favorites)))
+
+    def test_rebuild_swaps_in_staging_table(self):
+        """Rebuilding replaces co_favorites whole and leaves no staging tables behind"""
+
+        for user_id in self.uids[:2]:
+            Favorites.add_many(user_id, [303, 489])
+        db.session.commit()
+        db.session.execute(db.update(CoFavorite).values(together=99))
+        db.session.commit()
+
+        rebuild()
+        rebuild()
+
+        self.assertEqual(self.co_favorites(), {(303, 489, 2), (489, 303, 2)})
+        tables = db.inspect(db.engine).get_table_names()
+        self.assertIn("co_favorites", tables)
+        self.assertFalse([name for name in tables if name.startswith("co_favorites_")])
+
+        # Favoriting still counts into the swapped-in table
+        Favorites.add_many(self.uids[2], [303, 489])
+        db.session.commit()
+        self.assertEqual(self.co_favorites(), {(303, 489, 3), (489, 303, 3)})
+
+    def test_refresh_drops_surplus_ranks(self):
+        """A shorter list after a refresh doesn't keep the old list's tail"""
+
+        for user_id in self.uids[:2]:
+            Favorites.add_many(user_id, [303, 489, 30])
+        db.session.commit()
+        refresh(HERO_IDS)
+        self.assertEqual([hero_id for hero_id, _ in recommended_for_hero(303)], [30, 489])
+
+        Favorites.remove_many(self.uids[0], [30])
+        refresh([303])
+        db.session.commit()
+
+        self.assertEqual([hero_id for hero_id, _ in recommended_for_hero(303)], [489])
+
+    def test_recommended(self):
+        """Fans of 303 mostly also like 489, then 30"""
+
+        for user_id in self.uids[:3]:
+            Favorites.add_many(user_id, [303, 489])
+        for user_id in self.uids[1:3]:
+            Favorites.add_many(user_id, [30])
+        Favorites.add_many(self.uids[3], [346])
+        db.session.commit()
+        rebuild()
+
+        self.assertEqual([hero_id for hero_id, _ in recommended_for_hero(303)], [489, 30])
+        self.assertEqual(recommended_for_hero(346), [])
+        self.assertEqual(recommended_for_user([303]), [489, 30])
+        self.assertEqual(recommended_for_user([303, 489]), [30])
+        self.assertEqual(recommended_for_user([]), [])
+
+
+class RecommendationViewsTestCase(TestCase):
+    """Tests for recommendations on pages"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User(username=f"rec{i}", email=f"rec{i}@test.com", password="unused")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.uids = [user.id for user in users]
+
+        save_heroes([make_hero(hero_id) for hero_id in HERO_IDS])
+        for user_id in self.uids[:2]:
+            Favorites.add_many(user_id, [303, 489])
+        db.session.commit()
+        rebuild()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.uids[2]
+
+        # Run background refreshes straight away
+        self.submit = patch.object(recommendations.prefetcher, "submit",
+                                   side_effect=lambda app, func, *args: func(*args))
+        self.submit.start()
+
+    def tearDown(self):
+        self.submit.stop()
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_hero_page(self):
+        resp = self.client.get("/superheros/303")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Fans of Groot also favorited", resp.text)
+        self.assertIn("/superheros/489", resp.text)
+
+    def test_favorites_page(self):
+        Favorites.add_many(self.uids[2], [303])
+        db.session.commit()
+
+        resp = self.client.get("/users/favorites")
+
+        self.assertIn("Fans of your favorites also like", resp.text)
+        self.assertIn("Nick Fury", resp.text)
+
+    def test_refresh_failure_keeps_favorite(self):
+        """The favorite is already saved, so a failed refresh is logged, not a 500"""
+
+        with patch.object(recommendations, "refresh", side_effect=RuntimeError("boom")), \
+                self.assertLogs("recommendations", "ERROR"):
+            resp = self.client.post("/superheros/303/fav")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn(303, User.query.get(self.uids[2]).favorite_ids())
+
+    def test_favoriting_updates_recommendations(self):
+        """A third fan of 303 and 30 makes 30 a recommendation for both right away"""
+
+        Favorites.add_many(self.uids[1], [30])
+        db.session.commit()
+        self.assertEqual([hero_id for hero_id, _ in recommended_for_hero(30)], [])
+
+        self.client.post("/superheros/303/fav")
+        self.client.post("/superheros/30/fav")
+
+        self.assertEqual([hero_id for hero_id, _ in recommended_for_hero(30)], [303])
+        self.assertIn(30, [hero_id for hero_id, _ in recommended_for_hero(303)])
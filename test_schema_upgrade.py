@@ -0,0 +1,72 @@
+"""Schema upgrade tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_schema_upgrade.py
+
+import os
+from unittest import TestCase
+
+from app import create_app
+from models import db, User, Favorites
+from popularity import top_hero_counts
+from ratings import hero_rating
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+})
+
+
+class SchemaUpgradeTestCase(TestCase):
+    """Tests for upgrading a database made before the unique favorites index"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        db.session.execute(db.text("DROP INDEX ix_favorites_user_hero"))
+
+        user = User(username="old", email="old@test.com", password="unused")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        # Rows as the old toggle could leave them, written around the helpers
+        db.session.add_all([Favorites(user_id=user.id, hero_id=303),
+                            Favorites(user_id=user.id, hero_id=303, rating=4),
+                            Favorites(user_id=user.id, hero_id=303),
+                            Favorites(user_id=user.id, hero_id=489)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_upgrade(self):
+        result = app.test_cli_runner().invoke(args=["schema", "upgrade"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Removed 2 duplicate favorites", result.output)
+
+        rows = db.session.execute(
+            db.select(Favorites.hero_id, Favorites.rating).order_by(Favorites.hero_id)).all()
+        self.assertEqual([tuple(row) for row in rows], [(303, 4), (489, None)])
+
+        # The counters now include favorites from before the upgrade
+        self.assertEqual(top_hero_counts(), [(303, 1), (489, 1)])
+        self.assertEqual(hero_rating(303), (4.0, 1))
+
+        # Favoriting relies on the index for ON CONFLICT
+        indexes = db.inspect(db.engine).get_indexes("favorites")
+        self.assertIn("ix_favorites_user_hero", [index["name"] for index in indexes])
+        Favorites.add_many(self.user_id, [303, 30])
+        db.session.commit()
+        self.assertEqual(User.query.get(self.user_id).favorite_ids(), {30, 303, 489})
+
+        result = app.test_cli_runner().invoke(args=["schema", "upgrade"])
+        self.assertIn("Removed 0 duplicate favorites", result.output)
@@ -0,0 +1,135 @@
+"""Hero search tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_search.py
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import create_app
+from models import db, Hero
+from search import HeroIndex, tokenize, SYNC_OVERLAP
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+})
+
+
+class HeroIndexTestCase(TestCase):
+    """Tests for the in-memory hero search index"""
+
+    def setUp(self):
+        self.index = HeroIndex()
+        self.index.add(346, "Iron Man", ["Tony Stark"], "Inventor, industrialist",
+                       "Long Island, New York", "Tales of Suspense #39", "iron.jpg")
+        self.index.add(345, "Iron Fist", ["Danny Rand"], "Adventurer",
+                       "K'un-Lun", "Marvel Premiere #15", "fist.jpg")
+        self.index.add(620, "Spider-Man", ["Spidey"], "Freelance photographer",
+                       "New York, New York", "Amazing Fantasy #15", "spidey.jpg")
+
+    def names(self, query):
+        return [hero["name"] for hero in self.index.search(query)]
+
+    def test_tokenize(self):
+        """Words are lowercased and split on punctuation"""
+
+        self.assertEqual(tokenize("Spider-Man #15"), ["spider", "man", "15"])
+
+    def test_prefix_match(self):
+        """Typeahead prefixes match whole words"""
+
+        self.assertEqual(self.names("ir"), ["Iron Fist", "Iron Man"])
+        self.assertEqual(self.names("spi"), ["Spider-Man"])
+
+    def test_all_terms_must_match(self):
+        """Each query word narrows the results"""
+
+        self.assertEqual(self.names("iron st"), ["Iron Man"])
+        self.assertEqual(self.names("iron spidey"), [])
+
+    def test_ranking(self):
+        """Name matches rank above aliases, which rank above other fields"""
+
+        self.index.add(1, "Steel", ["Man of Iron"], "Engineer", "-", "-", "steel.jpg")
+        self.index.add(2, "Forge", ["Smith"], "Iron worker", "-", "-", "forge.jpg")
+
+        self.assertEqual(self.names("iron"), ["Iron Fist", "Iron Man", "Steel", "Forge"])
+
+    def test_reindex(self):
+        """Re-adding a hero replaces its old words"""
+
+        self.index.add(345, "Iron Fist", ["Danny Rand"], "Kung fu master",
+                       "K'un-Lun", "Marvel Premiere #15", "fist.jpg")
+
+        self.assertEqual(self.names("adventurer"), [])
+        self.assertEqual(self.names("kung"), ["Iron Fist"])
+
+
+class HeroIndexSyncTestCase(TestCase):
+    """Tests for keeping the index in step with the catalog"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        self.now = datetime.utcnow()
+        self.add_hero(1, "Groot", self.now)
+        self.index = HeroIndex()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def add_hero(self, hero_id, name, updated_at):
+        db.session.add(Hero(id=hero_id, name=name, data={}, updated_at=updated_at))
+        db.session.commit()
+
+    def test_late_commits_are_indexed(self):
+        """Rows that commit after a newer row was indexed are still picked up"""
+
+        self.index.sync()
+
+        # Committed late, stamped just before the newest row already indexed
+        self.add_hero(2, "Nick Fury", self.now - timedelta(seconds=1))
+        self.index.sync()
+        self.assertEqual(len(self.index), 2)
+
+        # Even later than the overlap allows; the count check catches it
+        self.add_hero(3, "Iron Man", self.now - timedelta(seconds=SYNC_OVERLAP * 2))
+        self.index.sync()
+        self.assertEqual([hero["name"] for hero in self.index.search("iron")], ["Iron Man"])
+
+    def test_first_build_runs_once(self):
+        """Concurrent first searches wait for one build instead of each building"""
+
+        real_index_rows = self.index._index_rows
+        calls = []
+
+        def slow_index_rows(since):
+            calls.append(since)
+            time.sleep(0.1)
+            return real_index_rows(since)
+
+        def ensure_fresh():
+            with app.app_context():
+                self.index.ensure_fresh()
+
+        with patch.object(self.index, "_index_rows", side_effect=slow_index_rows):
+            threads = [threading.Thread(target=ensure_fresh) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(calls, [None])
+        self.assertEqual(len(self.index), 1)
@@ -0,0 +1,175 @@
+"""Thumbnail tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_thumbnails.py
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import create_app
+from models import db
+from catalog import save_heroes
+from stub_api import make_hero
+import thumbnails
+from thumbnails import ThumbnailStore, Thumbnailer, make_thumbnail, source_version
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'TESTING': True,
+})
+
+
+def portrait(width=480, height=640):
+    """JPEG bytes the size of a superherodb portrait"""
+
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), (226, 54, 54)).save(out, "JPEG")
+    return out.getvalue()
+
+
+class MakeThumbnailTestCase(TestCase):
+    """Tests for resizing portraits"""
+
+    def test_fills_size(self):
+        """Thumbnails are exactly the requested size, in the requested format"""
+
+        for fmt, name in (("jpeg", "JPEG"), ("webp", "WEBP")):
+            with Image.open(io.BytesIO(make_thumbnail(portrait(), (150, 150), fmt))) as img:
+                self.assertEqual(img.size, (150, 150))
+                self.assertEqual(img.format, name)
+
+
+class ThumbnailStoreTestCase(TestCase):
+    """Tests for the content-addressed disk cache"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ThumbnailStore(self.tmp.name, max_bytes=250)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_identical_thumbnails_share_a_file(self):
+        """Files are named by content, so the same bytes are stored once"""
+
+        first = self.store.put("1/sm/jpeg/a", b"x" * 100)
+        second = self.store.put("2/sm/jpeg/b", b"x" * 100)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.store.get("2/sm/jpeg/b"), first)
+        self.assertEqual(self.store.total_bytes(), 100)
+
+    def test_evicts_least_recently_used(self):
+        """Once over max_bytes, the oldest thumbnails are deleted"""
+
+        for i, fill in enumerate(b"abc"):
+            self.store.put(f"{i}/sm/jpeg/v", bytes([fill]) * 100)
+
+        path, _ = self.store.get("0/sm/jpeg/v")
+        self.assertEqual(self.store.evict(), 1)
+
+        self.assertIsNone(self.store.get("0/sm/jpeg/v"))
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNotNone(self.store.get("2/sm/jpeg/v"))
+
+
+class HeroImageViewTestCase(TestCase):
+    """Tests for /img/hero/<id>/<size>"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        save_heroes([make_hero(303)])
+        self.url = make_hero(303)["image"]["url"]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.thumbnailer = Thumbnailer(self.tmp.name)
+        self.patches = [
+            patch.object(thumbnails, "thumbnailer", self.thumbnailer),
+            patch.object(self.thumbnailer, "download", return_value=portrait()),
+        ]
+        for p in self.patches:
+            p.start()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        self.tmp.cleanup()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_serves_webp_thumbnail(self):
+        """Browsers that accept WebP get it, cacheable forever at a versioned URL"""
+
+        resp = self.client.get(f"/img/hero/303/sm?v={source_version(self.url)}",
+                               headers={"Accept": "image/webp,*/*"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/webp")
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertIn("Accept", resp.headers["Vary"])
+
+        with Image.open(io.BytesIO(resp.data)) as img:
+            self.assertEqual(img.size, (150, 150))
+
+        resp.close()
+
+    def test_downloads_portrait_once(self):
+        """Every size and format is made from one download"""
+
+        for size, accept in (("sm", "image/webp"), ("md", "image/webp"), ("md", "image/*")):
+            resp = self.client.get(f"/img/hero/303/{size}", headers={"Accept": accept})
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=3600")
+        self.assertEqual(self.thumbnailer.download.call_count, 1)
+        self.assertEqual(self.thumbnailer.stats()["hits"], 2)
+
+    def test_not_modified(self):
+        """A matching ETag gets a 304"""
+
+        resp = self.client.get("/img/hero/303/sm")
+        etag = resp.headers["ETag"]
+        resp.close()
+
+        resp = self.client.get("/img/hero/303/sm", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        resp.close()
+
+    def test_falls_back_to_original(self):
+        """Without Pillow, or if the portrait can't be fetched, redirect to the original"""
+
+        with patch.object(thumbnails, "formats", return_value=()):
+            resp = self.client.get("/img/hero/303/sm")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, self.url)
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+        self.thumbnailer.download.side_effect = OSError("unreachable")
+        resp = self.client.get("/img/hero/303/md")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.thumbnailer.stats()["failed"], 1)
+
+    def test_unknown(self):
+        """Unknown sizes and heroes not in the catalog are 404s"""
+
+        self.assertEqual(self.client.get("/img/hero/303/xl").status_code, 404)
+        self.assertEqual(self.client.get("/img/hero/999/sm").status_code, 404)
+        self.thumbnailer.download.assert_not_called()
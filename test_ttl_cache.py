@@ -0,0 +1,51 @@
+"""TTL cache tests"""
+
+# run these tests like:
+#
+#    python3 -m unittest test_ttl_cache.py
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from ttl_cache import TTLCache
+
+
+class TTLCacheTestCase(TestCase):
+    """Tests for the per-worker snapshot cache"""
+
+    def test_expiry(self):
+        """Entries are served until ttl passes, then never"""
+
+        cache = TTLCache(ttl=10)
+
+        with patch("ttl_cache.time.monotonic", return_value=100):
+            cache.set(1, "user")
+        with patch("ttl_cache.time.monotonic", return_value=109.9):
+            self.assertEqual(cache.get(1), "user")
+        with patch("ttl_cache.time.monotonic", return_value=110):
+            self.assertIsNone(cache.get(1))
+
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_lru_eviction(self):
+        """Least recently used entry goes once maxsize is reached"""
+
+        cache = TTLCache(maxsize=2)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "a")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        cache = TTLCache()
+        cache.set(1, "a")
+        cache.invalidate(1)
+        cache.invalidate(2)
+
+        self.assertIsNone(cache.get(1))
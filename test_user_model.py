@@ -5,25 +5,25 @@
 #    python3 -m unittest test_user_model.py
 
 
+import os
 from unittest import TestCase
 from sqlalchemy import exc
 from models import db, User, Favorites
+from passwords import hasher
 from flask import session
-from app import app
+from app import create_app
 
 
 # Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///superheros_test'
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, not HTML pages with error info
-app.config["TESTING"] = True
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-db.create_all()
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'SQLALCHEMY_ECHO': False,
+    # Make Flask errors be real errors, not HTML pages with error info
+    'TESTING': True,
+    # Don't req CSRF for testing
+    'WTF_CSRF_ENABLED': False,
+})
 
 
 class UserModelTestCase(TestCase):
@@ -32,6 +32,9 @@ class UserModelTestCase(TestCase):
     def setUp(self):
         """Create test user, add sample data."""
 
+        self.ctx = app.app_context()
+        self.ctx.push()
+
         db.drop_all()
         db.create_all()
 
@@ -68,6 +71,8 @@ class UserModelTestCase(TestCase):
         """Clean up fouled transactions."""
 
         db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
         
     
     def test_user_model(self):
@@ -156,6 +161,20 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(User.authenticate("nonuser", "password"))
 
+    def test_rehash_on_login(self):
+        """Test that logging in upgrades hashes made with an old cost factor"""
+
+        old_hash = self.u1.password
+        hasher.rounds += 1
+
+        try:
+            u = User.authenticate(self.u1.username, "password1")
+        finally:
+            hasher.rounds -= 1
+
+        self.assertNotEqual(u.password, old_hash)
+        self.assertTrue(User.authenticate(self.u1.username, "password1"))
+
     def test_wrong_password(self):
         """Test that invalid password fails"""
 
@@ -201,4 +220,50 @@ class UserModelTestCase(TestCase):
         fav_test = Favorites(user_id=invalid_uid, hero_id=self.hid2)
         
         # Should not be an instance as the user_id does not exist
-        self.assertNotIsInstance(fav_test.user, User)
\ No newline at end of file
+        self.assertNotIsInstance(fav_test.user, User)
+
+    def test_duplicate_favorite(self):
+        """The same hero can't be favorited twice by one user"""
+
+        fav_test = Favorites(user_id=self.uid1, hero_id=self.hid1)
+        db.session.add(fav_test)
+
+        with self.assertRaises(exc.IntegrityError) as context:
+            db.session.commit()
+
+    def test_toggle_favorite(self):
+        """Toggling removes an existing favorite and adds a new one"""
+
+        self.assertFalse(Favorites.toggle(self.uid1, self.hid1))
+        self.assertTrue(Favorites.toggle(self.uid1, self.hid2))
+        db.session.commit()
+
+        hero_ids = [fav.hero_id for fav in Favorites.query.filter_by(user_id=self.uid1)]
+        self.assertEqual(hero_ids, [self.hid2])
+
+    def test_add_remove_many_favorites(self):
+        """Bulk add skips existing favorites; bulk remove drops several at once"""
+
+        Favorites.add_many(self.uid1, [self.hid1, self.hid2, 30])
+        db.session.commit()
+        self.assertEqual(Favorites.query.filter_by(user_id=self.uid1).count(), 3)
+
+        Favorites.remove_many(self.uid1, [self.hid1, 30])
+        db.session.commit()
+
+        hero_ids = [fav.hero_id for fav in Favorites.query.filter_by(user_id=self.uid1)]
+        self.assertEqual(hero_ids, [self.hid2])
+
+    def test_has_favorite(self):
+        """Test checking a single favorite"""
+
+        self.assertTrue(self.u1.has_favorite(self.hid1))
+        self.assertFalse(self.u1.has_favorite(self.hid2))
+
+    def test_favorite_ids(self):
+        """Test getting the set of favorite hero ids"""
+
+        Favorites.add_many(self.uid1, [self.hid2])
+        db.session.commit()
+
+        self.assertEqual(self.u1.favorite_ids(), {self.hid1, self.hid2})
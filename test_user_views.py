@@ -4,22 +4,27 @@
 #
 #    python3 -m unittest test_user_views.py
 
+import os
 from unittest import TestCase
-from app import app, CURR_USER_KEY
+from unittest.mock import patch
+from app import create_app, CURR_USER_KEY
 from models import db, User, Favorites
 from flask import session
+from catalog import save_heroes
+from stub_api import make_hero
+import search
+from passwords import login_limiter
 
 # Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///superheros_test'
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
-
-db.create_all()
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ.get('TEST_DATABASE_URL',
+                                              'postgresql:///superheros_test'),
+    'SQLALCHEMY_ECHO': False,
+    # Make Flask errors be real errors, not HTML pages with error info
+    'TESTING': True,
+    # Don't req CSRF for testing
+    'WTF_CSRF_ENABLED': False,
+})
 
 class UserViewsTestCase(TestCase):
     """Tests for views of the Superhero Encyclopedia"""
@@ -27,6 +32,9 @@ class UserViewsTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data"""
 
+        self.ctx = app.app_context()
+        self.ctx.push()
+
         db.drop_all()
         db.create_all()
 
@@ -58,10 +66,15 @@ class UserViewsTestCase(TestCase):
         hid2 = 489
         self.hid2 = hid2
 
+        # Local catalog rows so hero pages don't need the live API
+        save_heroes([make_hero(hid1), make_hero(hid2), make_hero(107)])
+
     def tearDown(self):
         """Clean up fouled transactions."""
 
         db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
 
     def test_info_page(self):
         """Test that the main superhero encyclopedia page shows when logged in"""
@@ -152,4 +165,252 @@ class UserViewsTestCase(TestCase):
 
             # Test user should now have 0 favorites
             favs = Favorites.query.filter(Favorites.user_id==self.u1.id).all()
-            self.assertEqual(len(favs), 0)
\ No newline at end of file
+            self.assertEqual(len(favs), 0)
+
+    def test_user_loaded_lazily(self):
+        """Views that don't use g.user shouldn't query for it"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get("/")
+            self.assertEqual(resp.headers["X-DB-Queries"], "0")
+
+            # Own profile should only need the one query for g.user
+            db.session.expunge_all()
+            resp = c.get(f"/users/{self.u1.id}")
+            self.assertEqual(resp.headers["X-DB-Queries"], "1")
+
+    def test_server_timing(self):
+        """Responses break down where request time went"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            db.session.expunge_all()
+            resp = c.get(f"/users/{self.u1.id}")
+            timing = resp.headers["Server-Timing"]
+
+            self.assertTrue(timing.startswith("app;dur="))
+            self.assertIn('db;dur=', timing)
+            self.assertIn('desc="1 calls"', timing)
+
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('superheros_request_seconds_count{endpoint="views.show_details",method="GET",status="200"}', text)
+            self.assertIn("superheros_db_query_seconds_count", text)
+            self.assertIn('superheros_hero_cache{key="hits"}', text)
+
+    def test_profiler_admin_only(self):
+        """Only admins can use the profiler"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get("/admin/profile/capture?seconds=0")
+            self.assertEqual(resp.status_code, 404)
+
+            app.config['ADMIN_USERS'] = {"test1"}
+            try:
+                resp = c.get("/admin/profile/capture?seconds=0.1")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, "text/plain")
+
+                resp = c.get("/admin/profile?format=speedscope")
+                self.assertIn("profiles", resp.json)
+            finally:
+                app.config['ADMIN_USERS'] = set()
+
+    def test_sync_favorites(self):
+        """Test adding and removing many favorites at once"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.post("/api/users/favorites",
+                          json={"add": [self.hid2, 30], "remove": [self.hid1]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(sorted(resp.json["favorites"]), [30, self.hid2])
+
+    def test_sync_favorites_bad_body(self):
+        """Test that sync only takes lists of hero ids"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            for body in ([30], {"add": "12"}, {"add": [2 ** 31]}, {"remove": [0]},
+                         {"add": [30, "303"]}, {"add": [True]}, {"add": None}):
+                resp = c.post("/api/users/favorites", json=body)
+                self.assertEqual(resp.status_code, 400, body)
+
+            self.assertEqual(User.query.get(self.u1.id).favorite_ids(), {self.hid1})
+
+    def test_hero_page_favorite(self):
+        """Test that hero page shows whether the hero is a favorite"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get(f"/superheros/{self.hid1}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('fa-solid fa-star', resp.get_data(as_text=True))
+
+            resp = c.get(f"/superheros/{self.hid2}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('fa-regular fa-star', resp.get_data(as_text=True))
+
+    def test_info_page_not_modified(self):
+        """Test that revisiting the grid with its ETag gets a 304"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get("/superheros")
+            etag = resp.headers["ETag"]
+
+            resp = c.get("/superheros", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(as_text=True), "")
+
+    def test_not_modified_shows_flashes(self):
+        """Test that a pending flash gets the page rendered instead of a 304"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            etag = c.get("/superheros").headers["ETag"]
+
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("info", "Hello")]
+
+            resp = c.get("/superheros", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello", resp.get_data(as_text=True))
+            self.assertNotIn("ETag", resp.headers)
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+            resp = c.get("/users/favorites")
+            self.assertNotIn("Hello", resp.get_data(as_text=True))
+
+    def test_info_page_pagination(self):
+        """Test that grid pages only show their own heroes"""
+
+        save_heroes([make_hero(hero_id) for hero_id in range(1, 30)])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            html = c.get("/superheros?page=2").get_data(as_text=True)
+
+            self.assertIn('<span class="cell-name">Hero 22</span>', html)
+            self.assertNotIn('<span class="cell-name">Hero 21</span>', html)
+            self.assertIn('Previous', html)
+
+    def test_hero_page_not_modified(self):
+        """Test that a hero page is revalidated with its ETag instead of re-sent"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get(f"/superheros/{self.hid1}")
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = c.get(f"/superheros/{self.hid1}",
+                         headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+            # Un-favoriting changes the page, so the old ETag no longer matches
+            etag = resp.headers["ETag"]
+            c.post(f"/superheros/{self.hid1}/fav")
+            resp = c.get(f"/superheros/{self.hid1}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_cache_policies(self):
+        """Test that form pages aren't stored and fingerprinted assets are immutable"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get("/users/edit")
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+            html = c.get(f"/users/{self.u1.id}").get_data(as_text=True)
+            self.assertIn("/static/stylesheets/style.css?v=", html)
+
+            resp = c.get("/static/stylesheets/style.css?v=abc")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+
+    def test_search(self):
+        """Test searching superheros by name"""
+
+        search.hero_index = search.HeroIndex()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+
+            resp = c.get("/api/superheros/search?q=gro")
+            self.assertEqual(resp.json["heroes"][0]["name"], "Groot")
+
+            # A negative limit still returns the best match
+            resp = c.get("/api/superheros/search?q=gro&limit=-1")
+            self.assertEqual([hero["name"] for hero in resp.json["heroes"]], ["Groot"])
+
+            resp = c.get("/superheros/search?q=nick")
+            self.assertIn("Nick Fury", resp.get_data(as_text=True))
+
+    @patch("app.prefetch_favorites")
+    def test_login_prefetches_favorites(self, prefetch_favorites):
+        """A successful login starts warming the user's favorites"""
+
+        with app.test_client() as c:
+            resp = c.post("/", data={"username": "test1", "password": "password1"})
+            self.assertEqual(resp.status_code, 302)
+
+        prefetch_favorites.assert_called_once_with(self.uid1)
+
+    def test_login_rate_limit(self):
+        """Test that repeated failed logins are refused without checking the password"""
+
+        login_limiter.reset("user:test1", "ip:127.0.0.1")
+
+        with app.test_client() as c:
+            for _ in range(login_limiter.max_attempts):
+                resp = c.post("/", data={"username": "test1", "password": "wrongpass"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/", data={"username": "test1", "password": "password1"})
+            self.assertEqual(resp.status_code, 429)
+
+        login_limiter.reset("user:test1", "ip:127.0.0.1")
+
+    def test_login_rate_limit_behind_proxy(self):
+        """Test that with TRUSTED_PROXIES, failed logins count against the client's IP"""
+
+        proxied = create_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+                              'TESTING': True, 'WTF_CSRF_ENABLED': False,
+                              'TRUSTED_PROXIES': 1})
+
+        try:
+            with proxied.test_client() as c:
+                c.post("/", data={"username": "nobody", "password": "wrongpass"},
+                       headers={"X-Forwarded-For": "203.0.113.7"})
+
+            self.assertIn("ip:203.0.113.7", login_limiter._failures)
+            self.assertNotIn("ip:127.0.0.1", login_limiter._failures)
+        finally:
+            login_limiter.reset("user:nobody", "ip:203.0.113.7")
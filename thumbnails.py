@@ -0,0 +1,433 @@
+"""Hero portrait thumbnails
+
+Pages show portraits through /img/hero/<id>/<size> instead of hot-linking
+the full-size images on superherodb.com and shrinking them in the browser:
+
+- each portrait is downloaded once and every thumbnail size is made from
+  it on a background thread pool; a request that finds no thumbnail waits
+  up to THUMBNAIL_WAIT seconds for it, then redirects to the original
+- WebP goes to browsers that accept it (if Pillow can write it), JPEG to
+  the rest
+- thumbnail files are named by the hash of their contents, with a SQLite
+  index from (hero, size, format, source URL) to file, shared by every
+  worker on the box; once the files add up to more than
+  THUMBNAIL_CACHE_BYTES the least recently used are deleted
+- thumbnail URLs carry a hash of the source URL (?v=...), so browsers can
+  cache them forever as immutable
+
+Without Pillow installed the route just redirects to the original image.
+
+Settings (environment):
+    THUMBNAIL_DIR           where thumbnails are stored (default: a
+                            directory in the system temp dir)
+    THUMBNAIL_CACHE_BYTES   disk space for thumbnails (default 256 MB)
+    THUMBNAIL_WORKERS       background threads (default 2)
+    THUMBNAIL_WAIT          seconds a request waits for new thumbnails
+                            (default 3)
+"""
+
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import requests
+from flask import abort, redirect, request, send_file
+
+from http_cache import POLICIES
+from models import db, Hero
+from per_process import PerProcess
+
+logger = logging.getLogger(__name__)
+
+# (width, height) of each thumbnail size; portraits are cropped to fill them
+SIZES = {
+    "sm": (150, 150),   # round icons on the favorites, search and popular pages
+    "md": (150, 225),   # grid cells and the hero page
+}
+
+MIMETYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+# Largest portrait we'll download
+MAX_SOURCE_BYTES = 5 * 1024 * 1024
+
+# Seconds before retrying a portrait that couldn't be downloaded or decoded
+FAILURE_TTL = 300
+
+
+@lru_cache(maxsize=1)
+def pillow():
+    """(Image, ImageOps) from Pillow, or None if it isn't installed"""
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    return Image, ImageOps
+
+
+@lru_cache(maxsize=1)
+def formats():
+    """Formats thumbnails can be made in, preferred first"""
+
+    if pillow() is None:
+        return ()
+
+    from PIL import features
+    return ("webp", "jpeg") if features.check("webp") else ("jpeg",)
+
+
+def source_version(url):
+    """Short hash of a portrait's URL, to version thumbnail URLs with"""
+
+    return hashlib.sha1(url.encode()).hexdigest()[:12]
+
+
+def hero_image_url(hero_id, image, size):
+    """URL of a hero's portrait thumbnail, for templates"""
+
+    if not image:
+        return image
+
+    return f"/img/hero/{hero_id}/{size}?v={source_version(image)}"
+
+
+def make_thumbnail(data, size, fmt):
+    """Shrink image bytes to fill size, cropping any overflow; returns fmt bytes"""
+
+    Image, ImageOps = pillow()
+
+    with Image.open(io.BytesIO(data)) as img:
+        # Let JPEGs decode at a reduced scale; much faster than full size
+        img.draft("RGB", (size[0] * 2, size[1] * 2))
+        # Crop from a bit above the middle, where faces usually are
+        thumb = ImageOps.fit(img.convert("RGB"), size, Image.LANCZOS, centering=(0.5, 0.35))
+
+    out = io.BytesIO()
+
+    if fmt == "webp":
+        thumb.save(out, "WEBP", quality=80, method=4)
+    else:
+        thumb.save(out, "JPEG", quality=85, optimize=True, progressive=True)
+
+    return out.getvalue()
+
+
+class ThumbnailStore:
+    """Thumbnail files named by content hash, with an LRU index in SQLite.
+
+    Each call opens its own connection and files are written under a temp
+    name then renamed, so the store is safe to share across threads and
+    forked workers. Identical thumbnails (e.g. two heroes with the same
+    placeholder portrait) share one file.
+    """
+
+    # How often (seconds) a hit updates the entry's last-used time
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS thumbnails ("
+                " key TEXT PRIMARY KEY,"
+                " digest TEXT NOT NULL,"
+                " bytes INTEGER NOT NULL,"
+                " used_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS thumbnails_used_at ON thumbnails (used_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS thumbnails_digest ON thumbnails (digest)")
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        """(path, digest) of the thumbnail stored under key, or None"""
+
+        now = time.time()
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT digest, used_at FROM thumbnails WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            digest, used_at = row
+            # Only write on a hit now and then, so hot thumbnails don't
+            # have every request queueing for SQLite's write lock
+            if now - used_at > self.TOUCH_INTERVAL:
+                conn.execute("UPDATE thumbnails SET used_at = ? WHERE key = ?", (now, key))
+
+        return self.path_for(digest), digest
+
+    def put(self, key, data):
+        """Store data under key; returns (path, digest)"""
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?)",
+                         (key, digest, len(data), time.time()))
+
+        return path, digest
+
+    def total_bytes(self):
+        """Disk space used by thumbnail files"""
+
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM"
+                " (SELECT DISTINCT digest, bytes FROM thumbnails)").fetchone()[0]
+
+    def evict(self):
+        """Delete least recently used thumbnails until under max_bytes.
+
+        Frees down to 90% of max_bytes, so eviction doesn't run on every
+        put once the cache is full. Returns the number of entries removed.
+        """
+
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return 0
+
+        target = self.max_bytes * 0.9
+        removed = 0
+
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, digest, bytes FROM thumbnails ORDER BY used_at")
+
+            for key, digest, size in rows.fetchall():
+                if total <= target:
+                    break
+
+                conn.execute("DELETE FROM thumbnails WHERE key = ?", (key,))
+                removed += 1
+
+                # Files are shared by identical thumbnails; keep them while referenced
+                if conn.execute("SELECT 1 FROM thumbnails WHERE digest = ? LIMIT 1",
+                                (digest,)).fetchone() is None:
+                    try:
+                        os.remove(self.path_for(digest))
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+
+        return removed
+
+
+class Thumbnailer:
+    """Makes and serves thumbnails, generating them on a background pool"""
+
+    def __init__(self, root, max_bytes=256 * 1024 * 1024, workers=2, wait=3.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.wait = wait
+        self.counters = dict.fromkeys(
+            ("hits", "misses", "generated", "failed", "fallbacks", "evictions"), 0)
+
+        self._store = None
+        self._pool = PerProcess(self._new_pool)
+        self._pending = {}
+        self._failed = {}
+        self._session = PerProcess(requests.Session)
+        self._lock = threading.Lock()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    @property
+    def store(self):
+        """Disk store, opened on first use so importing doesn't touch the disk"""
+
+        if self._store is None:
+            self._store = ThumbnailStore(self.root, self.max_bytes)
+        return self._store
+
+    def _new_pool(self):
+        # Jobs pending in the parent won't finish in this process
+        self._pending = {}
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="thumbnail")
+
+    def download(self, url):
+        """Bytes of the portrait at url"""
+
+        with self._session.get().get(url, timeout=(2, 10), stream=True) as resp:
+            resp.raise_for_status()
+            data = resp.raw.read(MAX_SOURCE_BYTES + 1, decode_content=True)
+
+        if len(data) > MAX_SOURCE_BYTES:
+            raise ValueError(f"portrait larger than {MAX_SOURCE_BYTES} bytes: {url}")
+
+        return data
+
+    def _generate(self, hero_id, url):
+        """Download the portrait once and store every size and format of it"""
+
+        data = self.download(url)
+        version = source_version(url)
+
+        for size, dimensions in SIZES.items():
+            for fmt in formats():
+                self.store.put(f"{hero_id}/{size}/{fmt}/{version}",
+                               make_thumbnail(data, dimensions, fmt))
+
+        self._count("generated")
+        self._count("evictions", self.store.evict())
+
+    def _run(self, job, hero_id, url):
+        try:
+            self._generate(hero_id, url)
+        except Exception:
+            logger.warning("couldn't make thumbnails for hero %s from %s", hero_id, url,
+                           exc_info=True)
+            self._count("failed")
+            with self._lock:
+                self._failed[job] = time.monotonic() + FAILURE_TTL
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(job, None)
+
+    def _submit(self, hero_id, url):
+        """Future for the job making hero's thumbnails, or None if it recently failed"""
+
+        job = (hero_id, url)
+
+        with self._lock:
+            pool = self._pool.get()
+
+            if self._failed.get(job, 0) > time.monotonic():
+                return None
+
+            future = self._pending.get(job)
+            if future is None:
+                future = self._pending[job] = pool.submit(self._run, job, hero_id, url)
+
+        return future
+
+    def get(self, hero_id, url, size, fmt):
+        """(path, digest) of the thumbnail, or None if it isn't ready in time"""
+
+        key = f"{hero_id}/{size}/{fmt}/{source_version(url)}"
+        found = self.store.get(key)
+
+        if found is not None and os.path.exists(found[0]):
+            self._count("hits")
+            return found
+
+        self._count("misses")
+        future = self._submit(hero_id, url)
+
+        if future is not None:
+            try:
+                future.result(timeout=self.wait)
+                return self.store.get(key)
+            except Exception:
+                # Timed out (the job carries on and stores them for next
+                # time) or failed, which the job has logged
+                pass
+
+        self._count("fallbacks")
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=len(self._pending))
+
+
+thumbnailer = Thumbnailer(
+    root=os.environ.get('THUMBNAIL_DIR') or os.path.join(tempfile.gettempdir(),
+                                                         "superhero-thumbnails"),
+    max_bytes=int(os.environ.get('THUMBNAIL_CACHE_BYTES', 256 * 1024 * 1024)),
+    workers=int(os.environ.get('THUMBNAIL_WORKERS', 2)),
+    wait=float(os.environ.get('THUMBNAIL_WAIT', 3.0)),
+)
+
+
+def pick_format():
+    """Best format this request's browser accepts"""
+
+    # Only if asked for by name: browsers without WebP still send image/*
+    if "webp" in formats() and "image/webp" in request.accept_mimetypes.values():
+        return "webp"
+
+    return "jpeg"
+
+
+def fallback(url):
+    """Redirect to the original portrait, without letting it be cached"""
+
+    resp = redirect(url)
+    resp.headers["Cache-Control"] = POLICIES["no-store"]
+    return resp
+
+
+def hero_image(hero_id, size):
+    """A hero's portrait at one of SIZES"""
+
+    if size not in SIZES:
+        abort(404)
+
+    # Only heroes already in the catalog, so this never calls the API
+    url = db.session.scalar(db.select(Hero.image).where(Hero.id == hero_id))
+    if not url:
+        abort(404)
+
+    if not formats():
+        return fallback(url)
+
+    fmt = pick_format()
+    found = thumbnailer.get(hero_id, url, size, fmt)
+    if found is None:
+        return fallback(url)
+
+    path, digest = found
+
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        # Evicted by another worker since we looked it up
+        return fallback(url)
+
+    resp = send_file(f, mimetype=MIMETYPES[fmt], etag=digest, conditional=True)
+    resp.vary.add("Accept")
+
+    # Versioned URLs never change; others (or out of date ones) may, so
+    # only cache those for a while
+    versioned = request.args.get("v") == source_version(url)
+    resp.headers["Cache-Control"] = POLICIES["immutable" if versioned else "static"]
+
+    return resp
+
+
+def init_app(app):
+    """Register the thumbnail route and hero_image_url() template helper"""
+
+    app.add_url_rule("/img/hero/<int:hero_id>/<size>", "hero_image", hero_image)
+    app.jinja_env.globals["hero_image_url"] = hero_image_url
@@ -0,0 +1,63 @@
+"""Small in-process cache with a size bound and per-entry expiry
+
+For per-worker snapshots that are cheap to reload and must never be
+served once they expire (unlike hero_cache, which serves stale entries
+while it refreshes them and can share entries between workers).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire `ttl` seconds after being set"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # key -> (value, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.counters = dict.fromkeys(("hits", "misses", "evictions"), 0)
+
+    def get(self, key, default=None):
+        """Unexpired value for key, or default"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._entries[key]
+            self.counters["misses"] += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Snapshot of counters plus current size"""
+
+        with self._lock:
+            return dict(self.counters, size=len(self._entries), maxsize=self.maxsize)